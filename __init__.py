@@ -10,16 +10,26 @@ TO DO:
 """
 
 from utilities import parse_boolean, parse_codes, parse_dates, parse_nulls, \
-    parse_money, datetime_to_mssql_string, get_columns
+    parse_money, datetime_to_mssql_string, get_columns, FLAGS, pack_flags, \
+    unpack_flags, pack_flags_array, unpack_flags_array, zfill_series, \
+    parse_nulls_series, parse_dates_series, datetime_to_mssql_string_series
+import batch_policy, shared_dimensions, rows, transform, change_capture, \
+    surrogate_keys, versioned_dimensions, native_format, aggregates, \
+    external_sort, sketches, bloom, profiling, memory_budget, replica, \
+    audit, connections, dimension_stats, bulkloader
 import create_tables, stage_date_dimensions, stage_dbc_tarieventabel, \
     stage_dbc_typeringslijst, stage_dbc_zorgproduct,\
-    stage_vektis_codelijsten, load_staged_dimensions, load_fct_subtraject
+    stage_vektis_codelijsten, load_staged_dimensions, load_fct_subtraject, \
+    load_fct_zorgtraject
 
 __author__ = 'Daniel Kapitan'
 __maintainer__ = 'Daniel Kapitan'
 __version__ = '0.1'
 
 __all__ = ['parse_boolean', 'parse_codes', 'parse_dates', 'parse_nulls',
-           'parse_money', 'datetime_to_mssql_string', 'get_columns']
+           'parse_money', 'datetime_to_mssql_string', 'get_columns', 'FLAGS',
+           'pack_flags', 'unpack_flags', 'pack_flags_array',
+           'unpack_flags_array', 'zfill_series', 'parse_nulls_series',
+           'parse_dates_series', 'datetime_to_mssql_string_series']
 
 
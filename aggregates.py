@@ -0,0 +1,296 @@
+""" Aggregate cache of FCT.SUBTRAJECT rollups.
+
+The same group-bys over FCT.SUBTRAJECT (omzet per specialisme, per
+zorgproduct, per zorgtype, ...) are run over and over, each as a full
+scan on the server. The rollups configured in [aggregates] are computed
+during the fact load instead, with a NumPy group-by over the resolved
+*_id columns, and kept as compact cubes: one .npz file per rollup and
+loaded month, with the distinct id combinations, the number of rows and
+the sums of the measures in cents.
+
+When a month is loaded again, only its cubes are replaced. Months that
+are loaded with change data capture only see the changed rows, so their
+cubes are rebuilt from FCT.SUBTRAJECT with refresh_from_table().
+
+The six J/N flags can be used as dimension 'vlaggen', packed into one
+integer by pack_flags(); split_flags() unpacks them into one dimension
+per flag (1, 0 or -1 for null) only when a query needs them.
+
+Usage:
+    cache = AggregateCache(path, parse_rollups(config.get('aggregates',
+                                                          'rollups')))
+    cube = cache.query('zorgproduct', months=['201201', '201202'],
+                       mapping={'zpr_id': zpr_id_to_productgroep})
+    cube.to_frame()
+"""
+
+import os
+from array import array
+from collections import OrderedDict
+import numpy as np
+from wob_zz import FLAGS, pack_flags_array, unpack_flags_array
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+MEASURES = ['fct_omzet_ziekenhuis', 'fct_omzet_honorarium_totaal']
+
+
+def parse_rollups(text):
+    """Rollups from config, one per line as 'name: column, column'."""
+    rollups = OrderedDict()
+    for line in text.strip().splitlines():
+        if not line.strip():
+            continue
+        name, columns = line.split(':', 1)
+        rollups[name.strip()] = [column.strip() for column
+                                 in columns.split(',') if column.strip()]
+    return rollups
+
+
+def to_cents(value):
+    """Decimal money value as integer number of cents, None as 0."""
+    if value is None or value == '':
+        return 0
+    return int(round(value * 100))
+
+
+def _group(keys, counts, sums):
+    """Sum counts and sums of rows with the same key.
+
+    keys is an (n x d) int64 array, counts (n,) and sums (n x m) int64.
+    Sorting and np.add.reduceat keep the sums exact in int64.
+    """
+    if len(keys) == 0:
+        return keys, counts, sums
+    unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(inverse[order]) != 0])
+    return (unique, np.add.reduceat(counts[order], starts),
+            np.add.reduceat(sums[order], starts, axis=0))
+
+
+class Cube(object):
+    """Counts and measure sums per combination of dimension ids.
+
+    Attributes:
+    - dimensions: names of the key columns
+    - measures: names of the summed measures
+    - keys: (n x len(dimensions)) int64 array
+    - counts: (n,) int64 array with the number of fact rows
+    - sums: (n x len(measures)) int64 array with sums in cents
+    """
+
+    def __init__(self, dimensions, measures, keys, counts, sums):
+        self.dimensions = list(dimensions)
+        self.measures = list(measures)
+        self.keys = keys
+        self.counts = counts
+        self.sums = sums
+
+    def __len__(self):
+        return len(self.counts)
+
+    @classmethod
+    def from_columns(cls, dimensions, measures, columns):
+        """Group-by over a dict of equal length columns (id and cents)."""
+        n = len(columns[dimensions[0]]) if dimensions else 0
+        keys = np.empty((n, len(dimensions)), dtype=np.int64)
+        for i, dimension in enumerate(dimensions):
+            keys[:, i] = np.asarray(columns[dimension], dtype=np.int64)
+        sums = np.empty((n, len(measures)), dtype=np.int64)
+        for i, measure in enumerate(measures):
+            sums[:, i] = np.asarray(columns[measure], dtype=np.int64)
+        return cls(dimensions, measures,
+                   *_group(keys, np.ones(n, dtype=np.int64), sums))
+
+    @classmethod
+    def combine(cls, cubes):
+        """Sum cubes with the same dimensions, e.g. over months."""
+        cubes = list(cubes)
+        first = cubes[0]
+        return cls(first.dimensions, first.measures, *_group(
+            np.concatenate([cube.keys for cube in cubes]),
+            np.concatenate([cube.counts for cube in cubes]),
+            np.concatenate([cube.sums for cube in cubes])))
+
+    def rollup(self, dimensions=None, mapping=None, where=None):
+        """Aggregate to fewer dimensions or to coarser levels.
+
+        Arguments:
+        - dimensions: dimensions to keep, default all
+        - mapping: {dimension: {id: group id}} to roll ids up to a
+          higher level, e.g. zpr_id to productgroep; unmapped ids go to -1
+        - where: {dimension: id or list of ids} to select on before
+          aggregating, applied to the original ids
+        """
+        keys, counts, sums = self.keys, self.counts, self.sums
+        for dimension, values in (where or {}).items():
+            column = keys[:, self.dimensions.index(dimension)]
+            selected = np.isin(column, np.atleast_1d(values))
+            keys, counts, sums = keys[selected], counts[selected], sums[selected]
+        if mapping:
+            keys = keys.copy()
+            for dimension, groups in mapping.items():
+                i = self.dimensions.index(dimension)
+                keys[:, i] = [groups.get(key, -1) for key in keys[:, i]]
+        dimensions = dimensions or self.dimensions
+        keys = keys[:, [self.dimensions.index(dimension)
+                        for dimension in dimensions]]
+        return Cube(dimensions, self.measures, *_group(keys, counts, sums))
+
+    def to_frame(self):
+        """pandas DataFrame with the dimensions, aantal and measures in euros."""
+        import pandas as pd
+        data = pd.DataFrame(self.keys, columns=self.dimensions)
+        data['aantal'] = self.counts
+        for i, measure in enumerate(self.measures):
+            data[measure] = self.sums[:, i] / 100.0
+        return data
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path + '.tmp', 'wb') as cube:
+            np.savez(cube, dimensions=np.array(self.dimensions),
+                     measures=np.array(self.measures), keys=self.keys,
+                     counts=self.counts, sums=self.sums)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as cube:
+            return cls(cube['dimensions'].tolist(), cube['measures'].tolist(),
+                       cube['keys'], cube['counts'], cube['sums'])
+
+
+class AggregateCache(object):
+    """Rollup cubes of FCT.SUBTRAJECT per loaded month.
+
+    Arguments:
+    - path: directory with a subdirectory of .npz cubes per rollup
+    - rollups: {name: [dimension id columns]}, see parse_rollups()
+    - measures: measure columns, summed in cents
+
+    Usage during a load: add() for every fact row, then finish(month).
+    """
+
+    def __init__(self, path, rollups, measures=MEASURES):
+        self.path = path
+        self.rollups = OrderedDict(rollups)
+        self.measures = list(measures)
+        self.columns = sorted(set([column for columns in self.rollups.values()
+                                   for column in columns]))
+        self.__cubes = {}
+        self.reset()
+
+    def reset(self):
+        """Clear the rows collected for the current month."""
+        self.__buffers = dict([(column, array('q')) for column
+                               in self.columns + self.measures])
+
+    def add(self, row):
+        """Collect the ids and measures of one fact row, -1 for no id."""
+        buffers = self.__buffers
+        for column in self.columns:
+            value = row[column]
+            buffers[column].append(-1 if value is None else value)
+        for measure in self.measures:
+            buffers[measure].append(to_cents(row[measure]))
+
+    def finish(self, month):
+        """Replace the cubes of month by the collected rows."""
+        columns = dict([(column, np.frombuffer(buffer, dtype=np.int64))
+                        for column, buffer in self.__buffers.items()])
+        self.__store(month, columns)
+        self.reset()
+
+    def refresh_from_table(self, cursor, month):
+        """Rebuild the cubes of month from FCT.SUBTRAJECT.
+
+        FCT.SUBTRAJECT has no vlaggen column, it is packed from the six
+        flag columns with pack_flags_array().
+        """
+        ids = [column for column in self.columns if column != 'vlaggen']
+        flags = FLAGS if 'vlaggen' in self.columns else []
+        cursor.execute(
+            "select {} from FCT.SUBTRAJECT f join DIM.BRONBESTAND b "
+            "on f.bbs_id = b.bbs_id where b.bbs_jaar_maand = %s".
+            format(', '.join(['f.' + column for column
+                              in ids + flags + self.measures])), (month,))
+        rows = cursor.fetchall()
+        columns = {}
+        for i, column in enumerate(ids):
+            columns[column] = np.fromiter(
+                (-1 if row[i] is None else row[i] for row in rows),
+                dtype=np.int64, count=len(rows))
+        n = len(ids)
+        if flags:
+            values = np.array([[-1 if value is None else value
+                                for value in row[n:n + len(flags)]]
+                               for row in rows],
+                              dtype=np.int16).reshape(-1, len(flags))
+            columns['vlaggen'] = pack_flags_array(values).astype(np.int64)
+        n += len(flags)
+        for i, measure in enumerate(self.measures):
+            columns[measure] = np.fromiter(
+                (to_cents(row[n + i]) for row in rows),
+                dtype=np.int64, count=len(rows))
+        self.__store(month, columns)
+
+    def __store(self, month, columns):
+        for name, dimensions in self.rollups.items():
+            cube = Cube.from_columns(dimensions, self.measures, columns)
+            cube.save(self.__file(name, month))
+            self.__cubes[(name, month)] = cube
+
+    def __file(self, name, month):
+        return os.path.join(self.path, name, '{}.npz'.format(month))
+
+    def months(self, name):
+        """Months for which cubes of rollup name are available."""
+        directory = os.path.join(self.path, name)
+        if not os.path.exists(directory):
+            return []
+        return sorted([file[:-4] for file in os.listdir(directory)
+                       if file.endswith('.npz')])
+
+    def cube(self, name, month):
+        """Cube of rollup name for one month."""
+        key = (name, month)
+        if key not in self.__cubes:
+            self.__cubes[key] = Cube.load(self.__file(name, month))
+        return self.__cubes[key]
+
+    def query(self, name, months=None, dimensions=None, mapping=None,
+              where=None, by_month=False):
+        """Cube of rollup name over months (default all).
+
+        dimensions, mapping and where are passed to Cube.rollup(); with
+        by_month the month (YYYYMM) is kept as first dimension 'maand'.
+        """
+        cubes = []
+        for month in months or self.months(name):
+            cube = self.cube(name, month).rollup(dimensions, mapping, where)
+            if by_month:
+                keys = np.column_stack([
+                    np.full(len(cube), int(month), dtype=np.int64), cube.keys])
+                cube = Cube(['maand'] + cube.dimensions, cube.measures,
+                            keys, cube.counts, cube.sums)
+            cubes.append(cube)
+        if not cubes:
+            raise ValueError('no cubes of rollup {}'.format(name))
+        return Cube.combine(cubes)
+
+
+def split_flags(cube, dimension='vlaggen', flags=FLAGS):
+    """Replace the packed flags dimension of a cube by one per flag."""
+    i = cube.dimensions.index(dimension)
+    values = unpack_flags_array(cube.keys[:, i], len(flags))
+    keys = np.column_stack([cube.keys[:, :i], values.astype(np.int64),
+                            cube.keys[:, i + 1:]])
+    dimensions = cube.dimensions[:i] + list(flags) + cube.dimensions[i + 1:]
+    return Cube(dimensions, cube.measures, keys, cube.counts, cube.sums)
@@ -0,0 +1,166 @@
+""" Referential integrity and unknown-member audit of a loaded file.
+
+Unmapped codes only showed up weeks later in the reports, as facts on
+the unknown member (-1) or on members that dimension.ensure() added for
+codes missing from the reference lists. After each file the resolved
+keys of the loaded rows are audited per dimension key:
+- unknown: rows on a sentinel member (e.g. -1, or -1 and -3 for DIM.DAG)
+  or without key (NULL)
+- new: rows on members that were not in the dimension before the file,
+  and the number of such members
+- missing: keys that do not exist in the dimension after the load
+- the most frequent codes behind the unknown and new rows
+
+During the load the keys are appended to typed arrays (4 bytes per row
+and check); the codes are only counted for rows whose key is unknown or
+new, so memory does not grow with the codes of every row. The audit
+itself is done with NumPy over the whole file (np.isin against the
+dimension keys). Codes are the cleansed source codes, since the
+transform replaces the raw values.
+
+Thresholds that are exceeded raise AuditError after the report.
+"""
+
+from array import array
+from collections import Counter, namedtuple
+import numpy as np
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+# key: fact column, table/table_key: its dimension, codes: source columns
+# that were resolved to the key, sentinels: ids of unknown members
+Check = namedtuple('Check', ['key', 'table', 'table_key', 'codes',
+                             'sentinels'])
+Check.__new__.__defaults__ = ((), (-1,))
+
+# NULL keys in the typed key arrays
+NULL_KEY = -2 ** 31
+
+
+class AuditError(Exception):
+    """The audit of a loaded file exceeded a threshold."""
+    pass
+
+
+class FileAudit(object):
+    """Audit of the resolved keys of the rows of one file.
+
+    Arguments:
+    - checks: list of Check
+    - max_unknown: maximum share of rows with an unknown key per check
+    - max_new: maximum number of members added per check
+    - max_missing: maximum number of rows whose key is not in the dimension
+    - top: number of codes reported per check
+
+    Thresholds that are None are not checked.
+    """
+
+    def __init__(self, checks, max_unknown=None, max_new=None,
+                 max_missing=0, top=5):
+        self.checks = list(checks)
+        self.max_unknown = max_unknown
+        self.max_new = max_new
+        self.max_missing = max_missing
+        self.top = top
+        self.results = {}
+        self.__before = {}
+        self.__known = {}
+        self.__keys = {}
+        self.__flagged = {}
+
+    @staticmethod
+    def dimension_keys(cursor, table, table_key):
+        cursor.execute('select {} from {}'.format(table_key, table))
+        return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+    def begin(self, cursor):
+        """Read the dimension keys that exist before the file is loaded."""
+        self.__before = {}
+        for check in self.checks:
+            if check.table not in self.__before:
+                self.__before[check.table] = self.dimension_keys(
+                    cursor, check.table, check.table_key)
+        self.__known = dict([(table, set(keys.tolist())) for table, keys
+                             in self.__before.items()])
+        self.__keys = dict([(check.key, array('i')) for check in self.checks])
+        self.__flagged = dict([(check.key, Counter()) for check in self.checks])
+        self.results = {}
+
+    def add(self, row):
+        """Keep the keys of a loaded row, count the codes of unknown and
+        new keys."""
+        for check in self.checks:
+            key = row[check.key]
+            self.__keys[check.key].append(NULL_KEY if key is None else key)
+            if check.codes and (key is None or key in check.sentinels or
+                                key not in self.__known[check.table]):
+                self.__flagged[check.key]['/'.join(
+                    [str(row[code]) for code in check.codes])] += 1
+
+    def finish(self, cursor):
+        """Audit the rows of the file against the dimensions after the load."""
+        after = {}
+        for check in self.checks:
+            if check.table not in after:
+                after[check.table] = self.dimension_keys(
+                    cursor, check.table, check.table_key)
+            keys = self.__keys[check.key]
+            keys = np.frombuffer(keys, dtype=np.intc) if len(keys) else \
+                np.zeros(0, dtype=np.intc)
+            null = keys == NULL_KEY
+            unknown = null | np.isin(keys, check.sentinels)
+            known = ~unknown
+            new = known & ~np.isin(keys, self.__before[check.table])
+            missing = known & ~np.isin(keys, after[check.table])
+
+            self.results[check.key] = {
+                'rows': len(keys),
+                'unknown': int(unknown.sum()),
+                'null': int(null.sum()),
+                'new': int(new.sum()),
+                'new_members': len(np.unique(keys[new])),
+                'missing': int(missing.sum()),
+                'top': self.__flagged[check.key].most_common(self.top)}
+        self.__keys, self.__flagged, self.__known = {}, {}, {}
+        return self.results
+
+    def violations(self):
+        messages = []
+        for key in sorted(self.results):
+            result = self.results[key]
+            share = result['unknown'] / float(result['rows'] or 1)
+            if self.max_unknown is not None and share > self.max_unknown:
+                messages.append('{}: {:.2%} unknown > {:.2%}'.format(
+                    key, share, self.max_unknown))
+            if self.max_new is not None and \
+                    result['new_members'] > self.max_new:
+                messages.append('{}: {} new members > {}'.format(
+                    key, result['new_members'], self.max_new))
+            if self.max_missing is not None and \
+                    result['missing'] > self.max_missing:
+                messages.append('{}: {} keys not in dimension > {}'.format(
+                    key, result['missing'], self.max_missing))
+        return messages
+
+    def report(self):
+        lines = []
+        for check in self.checks:
+            result = self.results[check.key]
+            lines.append('{}: {} unknown ({} null), {} on {} new members, '
+                         '{} missing{}'.format(
+                             check.key, result['unknown'], result['null'],
+                             result['new'], result['new_members'],
+                             result['missing'],
+                             ', top ' + ', '.join(['{}={}'.format(code, count)
+                                                   for code, count
+                                                   in result['top']])
+                             if result['top'] else ''))
+        return lines
+
+    def check(self):
+        """Raise AuditError if a threshold is exceeded."""
+        messages = self.violations()
+        if messages:
+            raise AuditError('audit failed: ' + '; '.join(messages))
@@ -0,0 +1,114 @@
+""" Adaptive bulk batch sizing and commit policy for the fact load.
+
+pygrametl's bulk tables flush after a fixed number of rows and
+load_fct_subtraject only commits once per monthly file, which results in
+huge transactions and log growth on MS SQL Server. The policy in this
+module measures the insert throughput (rows/s) of every bulk batch,
+moves the batch size towards the measured optimum within configured
+bounds and commits every N batches.
+"""
+
+import time
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+
+class AdaptiveBulkPolicy(object):
+    """Hill-climbing batch size controller for pygrametl bulk tables.
+
+    Usage:
+    - pass policy.wrap(bulkloader) as bulkloader to the bulk table
+    - call policy.rowadded() after each insert and flush the bulk table
+      when it returns True
+
+    Arguments:
+    - bulksize: initial number of rows per bulk batch
+    - min_bulksize, max_bulksize: bounds for the batch size
+    - growth: factor by which the batch size is changed after a batch
+    - tolerance: relative drop in rows/s that reverses the search direction
+    - commit_every: commit after every N batches, 0 to disable
+    - commit: callable that commits the current transaction
+    """
+
+    def __init__(self, bulksize=50000, min_bulksize=10000,
+                 max_bulksize=500000, growth=1.5, tolerance=0.05,
+                 commit_every=0, commit=None):
+        if not 0 < min_bulksize <= max_bulksize:
+            raise ValueError('invalid bulksize bounds: {} - {}'.
+                             format(min_bulksize, max_bulksize))
+        if growth <= 1:
+            raise ValueError('growth must be larger than 1')
+        self.min_bulksize = min_bulksize
+        self.max_bulksize = max_bulksize
+        self.bulksize = self.__clamp(bulksize)
+        self.growth = growth
+        self.tolerance = tolerance
+        self.commit_every = commit_every
+        self.__commit = commit
+        self.__direction = 1
+        self.__last_rate = None
+        self.__pending = 0
+        self.batches = 0
+        self.commits = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.best_rate = 0.0
+        self.best_bulksize = self.bulksize
+
+    def __clamp(self, bulksize):
+        return max(self.min_bulksize, min(self.max_bulksize, int(bulksize)))
+
+    def rowadded(self):
+        """Register one inserted row; return True when the batch is full."""
+        self.__pending += 1
+        return self.__pending >= self.bulksize
+
+    def wrap(self, bulkloader):
+        """Return bulkloader that is timed and feeds back into the policy."""
+        def timed_bulkloader(*args, **kwargs):
+            start = time.time()
+            result = bulkloader(*args, **kwargs)
+            self.batchloaded(self.__pending, time.time() - start)
+            return result
+        return timed_bulkloader
+
+    def batchloaded(self, rows, seconds):
+        """Update batch size and commit after a bulk batch was loaded.
+
+        Only full batches are used to adapt the batch size, the partial
+        batch at the end of a file is dominated by fixed overhead.
+        """
+        self.__pending = 0
+        self.batches += 1
+        self.rows += rows
+        self.seconds += seconds
+
+        if rows >= self.bulksize and seconds > 0:
+            rate = rows / seconds
+            if rate > self.best_rate:
+                self.best_rate = rate
+                self.best_bulksize = self.bulksize
+            if self.__last_rate is not None and \
+                    rate < self.__last_rate * (1 - self.tolerance):
+                self.__direction = -self.__direction
+            self.__last_rate = rate
+            bulksize = self.__clamp(self.bulksize * self.growth ** self.__direction)
+            if bulksize == self.bulksize:
+                # stuck at one of the bounds, probe the other direction
+                self.__direction = -self.__direction
+            self.bulksize = bulksize
+
+        if self.commit_every and self.__commit is not None \
+                and self.batches % self.commit_every == 0:
+            self.__commit()
+            self.commits += 1
+
+    def report(self):
+        """Summary of batches, commits and throughput."""
+        rate = self.rows / self.seconds if self.seconds else 0.0
+        return ('{} batches, {} commits, {} rows at {:.0f} rows/s; '
+                'best {:.0f} rows/s at bulksize {}, current bulksize {}'.
+                format(self.batches, self.commits, self.rows, rate,
+                       self.best_rate, self.best_bulksize, self.bulksize))
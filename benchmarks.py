@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+""" Micro-benchmarks of the per-row operations of the fact load.
+
+Repeatable timings of the hot operations, to compare implementations
+and catch regressions:
+- parsers: every scalar parser in utilities on value distributions like
+  those of the DOT subtraject files (mostly valid, some blanks/nulls)
+- dates: DIM_DAG.lookup against alternative date resolvers
+- ensure: CachedDimension.ensure with a composite key (DIM.DIAGNOSE)
+  on a skewed stream of codes with a few new members
+- bulk: BulkFactTable.insert including writing the bulk files
+
+Everything runs offline: the dimensions live in an in-memory sqlite3
+database with DIM and FCT attached as schemas, and the bulkloader only
+counts the rows. The modules are imported by name, like in __init__,
+since importing the wob_zz package connects the loaders to the server.
+
+Results are stored as JSON with the environment they were measured in;
+compare exits with status 1 if a benchmark is slower than the baseline
+by more than the tolerance.
+
+Usage (from the package directory):
+    python benchmarks.py run --output baseline.json
+    python benchmarks.py run --output current.json --filter parse_
+    python benchmarks.py compare baseline.json current.json --tolerance 0.1
+"""
+
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+import timeit
+from collections import OrderedDict
+from decimal import Decimal
+import pygrametl as etl
+from pygrametl.tables import CachedDimension, BulkFactTable
+from utilities import parse_boolean, parse_codes, parse_dates, parse_nulls, \
+    parse_money, datetime_to_mssql_string, pack_flags
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+SEED = 20140410
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """Register a benchmark: a function returning (setup, run, ops).
+
+    setup() is called before every repeat and is not timed, run() is
+    timed and performs ops operations.
+    """
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def choose(rng, n, weighted):
+    """n values drawn from [(weight, function of rng)]."""
+    total = float(sum([weight for weight, value in weighted]))
+    values = []
+    for i in range(n):
+        pick = rng.random() * total
+        for weight, value in weighted:
+            pick -= weight
+            if pick < 0:
+                break
+        values.append(value(rng))
+    return values
+
+
+def source_dates(rng, n):
+    """Source dates 'YYYYMMDD' around the loaded years, some missing."""
+    start = datetime.date(2011, 1, 1).toordinal()
+    return choose(rng, n, [
+        (95, lambda rng: datetime.date.fromordinal(
+            start + rng.randint(0, 4 * 365)).strftime('%Y%m%d')),
+        (5, lambda rng: None)])
+
+
+def nothing():
+    pass
+
+
+# parsers
+
+@benchmark('parse_boolean')
+def bench_parse_boolean(n=100000):
+    values = choose(random.Random(SEED), n, [
+        (45, lambda rng: 'J'), (45, lambda rng: 'N'), (8, lambda rng: ''),
+        (2, lambda rng: None)])
+
+    def run():
+        for value in values:
+            parse_boolean(value)
+    return nothing, run, n
+
+
+@benchmark('parse_codes')
+def bench_parse_codes(n=100000):
+    values = choose(random.Random(SEED), n, [
+        (85, lambda rng: str(rng.randint(1, 9999))),
+        (5, lambda rng: 'c' + str(rng.randint(10, 99))),
+        (5, lambda rng: ''), (5, lambda rng: '0')])
+
+    def run():
+        for value in values:
+            parse_codes(value, 4, '_?_')
+    return nothing, run, n
+
+
+@benchmark('parse_dates')
+def bench_parse_dates(n=100000):
+    values = source_dates(random.Random(SEED), n)
+
+    def run():
+        for value in values:
+            parse_dates(value)
+    return nothing, run, n
+
+
+@benchmark('parse_nulls')
+def bench_parse_nulls(n=100000):
+    values = choose(random.Random(SEED), n, [
+        (90, lambda rng: str(rng.randint(1, 9999))),
+        (10, lambda rng: None)])
+
+    def run():
+        for value in values:
+            parse_nulls(value)
+    return nothing, run, n
+
+
+@benchmark('parse_money')
+def bench_parse_money(n=100000):
+    values = choose(random.Random(SEED), n, [
+        (90, lambda rng: str(rng.randint(0, 2500000))),
+        (3, lambda rng: '-' + str(rng.randint(1, 100000))),
+        (7, lambda rng: '')])
+
+    def run():
+        for value in values:
+            parse_money(value)
+    return nothing, run, n
+
+
+@benchmark('datetime_to_mssql_string')
+def bench_datetime_to_mssql_string(n=100000):
+    values = [None if value is None else
+              datetime.datetime.strptime(value, '%Y%m%d')
+              for value in source_dates(random.Random(SEED), n)]
+
+    def run():
+        for value in values:
+            datetime_to_mssql_string(value)
+    return nothing, run, n
+
+
+@benchmark('pack_flags')
+def bench_pack_flags(n=100000):
+    rng = random.Random(SEED)
+    values = [tuple(choose(rng, 6, [(45, lambda rng: 1), (45, lambda rng: 0),
+                                    (10, lambda rng: None)]))
+              for i in range(n)]
+
+    def run():
+        for value in values:
+            pack_flags(value)
+    return nothing, run, n
+
+
+# date resolvers
+
+DAG_START = datetime.date(2007, 1, 1)
+DAG_END = datetime.date(2020, 12, 31)
+DAG_SENTINELS = {'1000-01-01': -1, '1000-02-02': -2, '1000-03-03': -3,
+                 '1000-04-04': -4}
+
+
+def dag_members():
+    """(dag_id, dag_datum) as staged by stage_date_dimensions."""
+    members = [(dag_id, datum) for datum, dag_id in DAG_SENTINELS.items()]
+    for i in range((DAG_END - DAG_START).days + 1):
+        members.append((i + 1, (DAG_START + datetime.timedelta(i)).isoformat()))
+    return members
+
+
+def dag_rows(n):
+    """Rows with a parsed begindatum, unknown dates as 1000-01-01."""
+    return [{'begindatum_zorgtraject': parse_dates(value)}
+            for value in source_dates(random.Random(SEED), n)]
+
+
+def sqlite_connection():
+    """pygrametl connection to an in-memory database with DIM and FCT."""
+    cnx = sqlite3.connect(':memory:')
+    cnx.execute("attach database ':memory:' as DIM")
+    cnx.execute("attach database ':memory:' as FCT")
+    return etl.ConnectionWrapper(cnx)
+
+
+@benchmark('dag_cached_dimension')
+def bench_dag_cached_dimension(n=100000):
+    connection = sqlite_connection()
+    connection.execute('create table DIM.DAG (dag_id integer primary key, '
+                       'dag_datum text not null unique)')
+    connection.cursor().executemany('insert into DIM.DAG values (?, ?)',
+                                    dag_members())
+    DIM_DAG = CachedDimension(name='DIM.DAG', key='dag_id',
+                              attributes=['dag_datum'], size=0, prefill=True,
+                              targetconnection=connection)
+    rows = dag_rows(n)
+    mapping = {'dag_datum': 'begindatum_zorgtraject'}
+
+    def run():
+        for row in rows:
+            DIM_DAG.lookup(row, mapping)
+    return nothing, run, n
+
+
+@benchmark('dag_dict')
+def bench_dag_dict(n=100000):
+    ids = dict([(datum, dag_id) for dag_id, datum in dag_members()])
+    rows = dag_rows(n)
+
+    def run():
+        for row in rows:
+            ids.get(row['begindatum_zorgtraject'])
+    return nothing, run, n
+
+
+def dag_id_by_ordinal(datum, start=DAG_START.toordinal(),
+                      end=DAG_END.toordinal()):
+    """dag_id computed from the date, dag_id 1 is DAG_START."""
+    sentinel = DAG_SENTINELS.get(datum)
+    if sentinel is not None:
+        return sentinel
+    try:
+        ordinal = datetime.date(int(datum[0:4]), int(datum[5:7]),
+                                int(datum[8:10])).toordinal()
+    except ValueError:
+        return -3
+    if start <= ordinal <= end:
+        return ordinal - start + 1
+    return None
+
+
+@benchmark('dag_ordinal')
+def bench_dag_ordinal(n=100000):
+    rows = dag_rows(n)
+
+    def run():
+        for row in rows:
+            dag_id_by_ordinal(row['begindatum_zorgtraject'])
+    return nothing, run, n
+
+
+@benchmark('dag_ordinal_lru')
+def bench_dag_ordinal_lru(n=100000):
+    rows = dag_rows(n)
+    resolve = functools.lru_cache(maxsize=8192)(dag_id_by_ordinal)
+
+    def run():
+        for row in rows:
+            resolve(row['begindatum_zorgtraject'])
+    return resolve.cache_clear, run, n
+
+
+# composite key ensure
+
+@benchmark('diagnose_ensure')
+def bench_diagnose_ensure(n=50000, members=2000, new_share=0.03):
+    rng = random.Random(SEED)
+    codes = [('{:04d}'.format(rng.randint(300, 399)),
+              '{:04d}'.format(rng.randint(1, 9999))) for i in range(members)]
+    rows = []
+    for i in range(n):
+        if rng.random() < new_share:
+            code = ('{:04d}'.format(rng.randint(300, 399)), 'N{:03d}'.format(i))
+        else:
+            # skewed: a few diagnoses make up most subtrajecten
+            code = codes[min(int(rng.paretovariate(1.2)) - 1, members - 1)]
+        rows.append({'behandelend_specialisme': code[0],
+                     'typerende_diagnose': code[1]})
+    mapping = {'dia_dbc_specialisme_code': 'behandelend_specialisme',
+               'dia_dbc_diagnose_code': 'typerende_diagnose'}
+    state = {}
+
+    def setup():
+        # fresh dimension per repeat, so new codes are inserted every time
+        connection = sqlite_connection()
+        connection.execute('create table DIM.DIAGNOSE (dia_id integer '
+                           'primary key, dia_dbc_specialisme_code text, '
+                           'dia_dbc_diagnose_code text)')
+        connection.cursor().executemany(
+            'insert into DIM.DIAGNOSE values (?, ?, ?)',
+            [(i + 1,) + code for i, code in enumerate(sorted(set(codes)))])
+        state['dimension'] = CachedDimension(
+            name='DIM.DIAGNOSE', key='dia_id',
+            attributes=['dia_dbc_specialisme_code', 'dia_dbc_diagnose_code'],
+            size=0, prefill=True, targetconnection=connection)
+
+    def run():
+        dimension = state['dimension']
+        for row in rows:
+            dimension.ensure(row, mapping)
+    return setup, run, n
+
+
+# bulk writers
+
+FACT_KEYREFS = ['bbs_id', 'beh_id', 'dag_id_begindatum_zorgtraject',
+                'dag_id_einddatum_zorgtraject', 'dag_id_begindatum_subtraject',
+                'dag_id_einddatum_subtraject', 'dag_id_declaratiedatum',
+                'dia_id', 'stn_id', 'zgt_id', 'zgv_id', 'zpr_id',
+                'zvs_id_behandelend', 'zvs_id_verwijzend']
+FACT_MEASURES = ['geslacht', 'heeft_oranje_zorgactiviteit',
+                 'heeft_zorgactiviteit_met_machtiging', 'is_hoofdtraject',
+                 'is_aanspraak_zvw', 'is_aanspraak_zvw_toegepast',
+                 'is_zorgactiviteitvertaling_toegepast',
+                 'fct_omzet_ziekenhuis', 'fct_omzet_honorarium_totaal']
+
+
+def fact_rows(n):
+    rng = random.Random(SEED)
+    rows = []
+    for i in range(n):
+        row = dict([(keyref, rng.randint(-1, 5000)) for keyref in FACT_KEYREFS])
+        row['stn_id'] = i + 1
+        row.update(dict([(flag, rng.choice([1, 0, None]))
+                         for flag in FACT_MEASURES[1:7]]))
+        row['geslacht'] = rng.choice([0, 1, 2])
+        row['fct_omzet_ziekenhuis'] = Decimal(rng.randint(0, 2500000)) / 100
+        row['fct_omzet_honorarium_totaal'] = Decimal(rng.randint(0, 500000)) / 100
+        rows.append(row)
+    return rows
+
+
+@benchmark('fact_bulk_insert')
+def bench_fact_bulk_insert(n=100000, bulksize=50000):
+    rows = fact_rows(n)
+    loaded = []
+    state = {}
+
+    def bulkloader(tablename, attributes, fieldsep, rowsep, nullsubst,
+                   tempdest):
+        loaded.append(os.path.getsize(tempdest))
+
+    def setup():
+        # the new wrapper is pygrametl's default target connection
+        sqlite_connection()
+        loaded[:] = []
+        state['table'] = BulkFactTable(
+            name='FCT.SUBTRAJECT', keyrefs=FACT_KEYREFS,
+            measures=FACT_MEASURES, nullsubst='', fieldsep='\t',
+            rowsep='\r\n', usefilename=True, bulksize=bulksize,
+            bulkloader=bulkloader)
+
+    def run():
+        table = state['table']
+        for row in rows:
+            table.insert(row)
+        table._bulkloadnow()
+    return setup, run, n
+
+
+# running and comparing
+
+def environment():
+    """Python, platform and library versions of this run."""
+    info = OrderedDict([
+        ('time', time.strftime('%Y-%m-%d %H:%M:%S')),
+        ('python', platform.python_version()),
+        ('implementation', platform.python_implementation()),
+        ('platform', platform.platform()),
+        ('machine', platform.machine()),
+        ('processor', platform.processor()),
+        ('cpus', os.cpu_count()),
+        ('hostname', platform.node())])
+    for module in ['pygrametl', 'numpy', 'pandas']:
+        info[module] = getattr(sys.modules.get(module), '__version__', None)
+    try:
+        info['commit'] = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['commit'] = None
+    return info
+
+
+def run_benchmarks(names, repeat=5):
+    """Timings per benchmark in nanoseconds per operation."""
+    results = OrderedDict()
+    for name in names:
+        setup, run, ops = BENCHMARKS[name]()
+        times = timeit.Timer(run, setup).repeat(repeat=repeat, number=1)
+        per_op = sorted([seconds * 1e9 / ops for seconds in times])
+        results[name] = {'best_ns': round(per_op[0], 1),
+                         'median_ns': round(per_op[len(per_op) // 2], 1),
+                         'ops': ops, 'repeat': repeat}
+        print('{:<28} {:>10.1f} ns/op  (median {:.1f})'.format(
+            name, per_op[0], per_op[len(per_op) // 2]))
+    return results
+
+
+def compare(baseline, current, tolerance):
+    """Lines comparing best timings, and the names of the regressions."""
+    lines, regressions = [], []
+    for key in ['python', 'implementation', 'machine', 'processor']:
+        if baseline['environment'].get(key) != current['environment'].get(key):
+            lines.append('NB: {} differs: {} vs {}'.format(
+                key, baseline['environment'].get(key),
+                current['environment'].get(key)))
+    for name in current['results']:
+        if name not in baseline['results']:
+            lines.append('{:<28} new'.format(name))
+            continue
+        before = baseline['results'][name]['best_ns']
+        after = current['results'][name]['best_ns']
+        ratio = after / before
+        if ratio > 1 + tolerance:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - tolerance:
+            status = 'faster'
+        else:
+            status = ''
+        lines.append('{:<28} {:>10.1f} -> {:>10.1f} ns/op {:>+7.1%}  {}'.
+                     format(name, before, after, ratio - 1, status))
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks of the WOB ZZ fact load.')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='run the benchmarks')
+    run.add_argument('--output', help='JSON file for the results')
+    run.add_argument('--filter', default='',
+                     help='only benchmarks whose name contains this')
+    run.add_argument('--repeat', type=int, default=5)
+    commands.add_parser('list', help='list the benchmarks')
+    comparison = commands.add_parser(
+        'compare', help='compare results with a baseline')
+    comparison.add_argument('baseline')
+    comparison.add_argument('current')
+    comparison.add_argument('--tolerance', type=float, default=0.1,
+                            help='allowed slowdown as fraction, default 0.1')
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        for name in BENCHMARKS:
+            print(name)
+    elif args.command == 'run':
+        names = [name for name in BENCHMARKS if args.filter in name]
+        results = {'environment': environment(),
+                   'results': run_benchmarks(names, args.repeat)}
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(results, output, indent=1)
+    elif args.command == 'compare':
+        with open(args.baseline) as baseline, open(args.current) as current:
+            lines, regressions = compare(json.load(baseline),
+                                         json.load(current), args.tolerance)
+        for line in lines:
+            print(line)
+        if regressions:
+            print('{} regression(s) beyond {:.0%}: {}'.format(
+                len(regressions), args.tolerance, ', '.join(regressions)))
+            return 1
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
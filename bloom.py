@@ -0,0 +1,142 @@
+""" Bloom filter front end for dimensions with mostly new members.
+
+In a fresh load nearly every DIM_SUBTRAJECTNUMMER.ensure() is for a
+subtraject_id that was never seen before. While its key map is in
+memory, such a miss is a dict lookup, but once the memory budget has
+spilled the key map, every miss is a query on the sqlite spill file. A
+Bloom filter answers 'definitely new' for those keys in a few bit
+probes, so they go straight to insert; only possible hits are looked up.
+
+The filter has no false negatives, so it has to contain every member
+already in the dimension: prefill() adds the business keys before the
+load. False positives only cost the lookup that would have been done
+anyway. With the key map in memory the filter probe costs more than the
+lookup it skips, so the filter is off by default.
+"""
+
+import hashlib
+import math
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+
+class BloomFilter(object):
+    """Set membership with false positives at the given rate.
+
+    Arguments:
+    - capacity: expected number of members
+    - error_rate: false positive rate at capacity
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate)
+                                         / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / float(capacity)
+                                       * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.members = 0
+
+    def __positions(self, value):
+        digest = hashlib.blake2b(str(value).encode('utf-8'),
+                                 digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, value):
+        bits = self.bits
+        for position in self.__positions(value):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.members += 1
+
+    def __contains__(self, value):
+        bits = self.bits
+        for position in self.__positions(value):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+    def expected_error_rate(self):
+        """False positive rate at the current number of members."""
+        return (1 - math.exp(-self.hashes * self.members / float(self.size))) \
+            ** self.hashes
+
+
+class BloomFrontedDimension(object):
+    """Dimension wrapper that skips lookups of definitely new members.
+
+    Arguments:
+    - dimension: dimension with a single lookup attribute, e.g. a
+      KeyMapDimension
+    - capacity, error_rate: see BloomFilter
+
+    Statistics since the previous reset(): new (inserted without lookup),
+    hits (possible member that was found), false_positives (possible
+    member that was new after all).
+    """
+
+    def __init__(self, dimension, capacity, error_rate=0.01):
+        if len(dimension.lookupatts) != 1:
+            raise ValueError('BloomFrontedDimension needs one lookup attribute')
+        self.dimension = dimension
+        self.name = dimension.name
+        self.key = dimension.key
+        self.lookupatts = dimension.lookupatts
+        self.att = dimension.lookupatts[0]
+        self.filter = BloomFilter(capacity, error_rate)
+        self.new = 0
+        self.hits = 0
+        self.false_positives = 0
+
+    def prefill(self, values):
+        """Add business keys of existing members, e.g. of the key map."""
+        for value in values:
+            self.filter.add(value)
+
+    def lookup(self, row, namemapping={}):
+        if row[namemapping.get(self.att) or self.att] not in self.filter:
+            return None
+        return self.dimension.lookup(row, namemapping)
+
+    def insert(self, row, namemapping={}):
+        self.filter.add(row[namemapping.get(self.att) or self.att])
+        return self.dimension.insert(row, namemapping)
+
+    def ensure(self, row, namemapping={}):
+        value = row[namemapping.get(self.att) or self.att]
+        if value not in self.filter:
+            self.new += 1
+            self.filter.add(value)
+            return self.dimension.insert(row, namemapping)
+        keyvalue = self.dimension.lookup(row, namemapping)
+        if keyvalue is None:
+            self.false_positives += 1
+            self.filter.add(value)
+            return self.dimension.insert(row, namemapping)
+        self.hits += 1
+        return keyvalue
+
+    def reset(self):
+        """Start counting for the next file; the filter is kept."""
+        self.new = 0
+        self.hits = 0
+        self.false_positives = 0
+
+    def report(self):
+        checked = self.hits + self.false_positives
+        return ('{} new without lookup, {} hits, {} false positives '
+                '({:.1%} hit rate of lookups), filter {:.1f} MB for {} '
+                'members, expected error rate {:.2%}').format(
+            self.new, self.hits, self.false_positives,
+            self.hits / float(checked) if checked else 0.0,
+            self.filter.nbytes / 1048576.0, self.filter.members,
+            self.filter.expected_error_rate())
@@ -0,0 +1,72 @@
+""" MS SQL Server bulkloader for the pygrametl bulk tables of the fact loads.
+
+This works for the following setup:
+- Python 3 (anaconda) running on OSX
+- SQL Server 2014 running on Windows 7 Ultimate running on Parallels 9
+- pymssql / FreeTDS as python DB API
+- /var/library directory that has tempdest files is shared via Parallels
+
+NB:
+- rowterminator = '0x0a' due to differences Windows vs. UNIX
+- ms sql want full datetime, e.g. 2007-01-10 00:00:00, for dates
+- ms sql can't deal with text delimiters --> do without,
+    check no delimiters in fields
+- open statements with " or ''' and use single quotes
+    for strings in sql statements!!
+
+Usage:
+    bulkloader = mssql_bulkloader(cursor)
+    table = BulkFactTable(..., bulkloader=bulkloader)
+"""
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+
+def windows_path(tempdest):
+    """ Path of a temporary file as seen by SQL Server, \\psf is the
+    mountpoint for OSX."""
+    return '\\\\psf' + tempdest.replace('/', '\\')
+
+
+def bulk_insert(cursor, tablename, tempdest, native=False, order=None):
+    """ Bulk insert a tab separated or native file into tablename.
+
+    Arguments:
+    - native: file in native format, see native_format
+    - order: columns the file is sorted on, passed as ORDER hint
+    """
+    if native:
+        options = "datafiletype='native'"
+    else:
+        options = ("firstrow=1,\n"
+                   "               fieldterminator='\\t',\n"
+                   "               rowterminator='0x0a',\n"
+                   "               codepage='1252'")
+    if order:
+        options += ',\n               order({})'.format(', '.join(order))
+    stmt = ('''bulk insert {} from '{}'
+               with ({})
+             '''.format(tablename, windows_path(tempdest), options))
+    print("    sql> " + stmt)
+    cursor.execute(stmt)
+    print("    number of rows affected: {}".format(cursor.rowcount))
+    return cursor.rowcount
+
+
+def mssql_bulkloader(cursor, native=False, order=None):
+    """ pygrametl bulkloader that bulk inserts with cursor.
+
+    Arguments:
+    - native: files in native format; fieldsep, rowsep and nullsubst of
+      the table are then not used
+    - order: {tablename: columns} for tables whose files are sorted
+    """
+    order = order or {}
+
+    def bulkloader(tablename, attributes, fieldsep, rowsep, nullsubst,
+                   tempdest):
+        bulk_insert(cursor, tablename, tempdest, native,
+                    order.get(tablename))
+    return bulkloader
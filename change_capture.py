@@ -0,0 +1,149 @@
+""" Row-level change detection between DOT deliveries.
+
+Every delivery of the DOT subtraject files (e.g. _20140410_1) resends
+all months, although only a small share of the subtrajecten changed.
+For every monthly file a compact state is kept with a 64-bit content
+hash and the stn_id per subtraject_id of the previous load. Incoming
+rows are classified as new, changed or unchanged, so only the delta has
+to be applied to FCT.SUBTRAJECT. Rows that are no longer delivered are
+reported as deleted.
+
+State files are stored per month, i.e. per source file name without the
+delivery stamp, so each delivery is compared with the previous one. The
+state is pickled in chunks and held in SpillableDicts, so a memory
+budget can move it to disk during the load (see memory_budget).
+"""
+
+import hashlib
+import os
+import pickle
+import re
+from wob_zz.memory_budget import SpillableDict
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+CHUNK_SIZE = 100000
+NEW = 'new'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+
+def delivery_key(file):
+    """Source file name without directory and delivery stamp.
+
+    'DIS_RAP_SZG_WOB_STR_700_201201_20140410_1.csv.bz2'
+    -> 'DIS_RAP_SZG_WOB_STR_700_201201'
+    """
+    name = os.path.basename(file)
+    match = re.match(r'(.*)_\d{8}_\d+\.csv(\.bz2)?$', name)
+    if match:
+        return match.group(1)
+    return name.split('.')[0]
+
+
+def row_digest(row, columns):
+    """64-bit content hash of the source columns of a row."""
+    content = '\x1f'.join(['' if row[column] is None else row[column]
+                           for column in columns])
+    return int.from_bytes(hashlib.blake2b(content.encode('utf-8'),
+                                          digest_size=8).digest(), 'little')
+
+
+class ChangeCapture(object):
+    """Classify rows of one monthly file against the previous delivery.
+
+    Arguments:
+    - path: state file of this month
+    - columns: source columns that make up the content of a row
+    - key: business key of a row
+    - previous: compare with the stored state; False starts empty,
+      e.g. after FCT.SUBTRAJECT was truncated
+    - tempdir: directory for spilling the state to disk
+
+    Usage per row: classify(), then record() with the stn_id of the row
+    once it is inserted. pending_deletes() returns stn_ids whose fact
+    rows must be deleted before the new rows are bulk loaded.
+    """
+
+    def __init__(self, path, columns, key='subtraject_id', previous=True,
+                 tempdir=None):
+        self.path = path
+        self.columns = list(columns)
+        self.key = key
+        self.__previous = SpillableDict(tempdir=tempdir)
+        if previous and os.path.exists(path):
+            with open(path, 'rb') as state:
+                # one or more pickled chunks, older states are a single dict
+                while True:
+                    try:
+                        self.__previous.update(pickle.load(state))
+                    except EOFError:
+                        break
+        self.__current = SpillableDict(tempdir=tempdir)
+        self.__deletes = []
+        self.__digest = None
+        self.counts = {NEW: 0, CHANGED: 0, UNCHANGED: 0, 'deleted': 0}
+
+    def classify(self, row):
+        """Return (status, previous stn_id or None) for a source row."""
+        keyvalue = row[self.key]
+        digest = row_digest(row, self.columns)
+        self.__digest = digest
+        old = self.__previous.pop(keyvalue, None)
+        if old is None:
+            status = NEW
+        elif old[0] == digest:
+            status = UNCHANGED
+            self.__current[keyvalue] = old
+        else:
+            status = CHANGED
+            self.__deletes.append(old[1])
+        self.counts[status] += 1
+        return status, (old[1] if old is not None else None)
+
+    def record(self, row, stn_id):
+        """Store the hash of the last classified row with its stn_id."""
+        self.__current[row[self.key]] = (self.__digest, stn_id)
+
+    def finish(self):
+        """Mark all rows that were not delivered again as deleted."""
+        self.counts['deleted'] += len(self.__previous)
+        self.__deletes.extend([stn_id for digest, stn_id
+                               in self.__previous.values()])
+        self.__previous.close()
+
+    def pending_deletes(self):
+        """Return and clear the stn_ids whose fact rows must be deleted."""
+        deletes, self.__deletes = self.__deletes, []
+        return deletes
+
+    def save(self):
+        """Write the state of this delivery for the next comparison."""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.path + '.tmp', 'wb') as state:
+            chunk = {}
+            for keyvalue, value in self.__current.items():
+                chunk[keyvalue] = value
+                if len(chunk) >= CHUNK_SIZE:
+                    pickle.dump(chunk, state, pickle.HIGHEST_PROTOCOL)
+                    chunk = {}
+            if chunk or not len(self.__current):
+                pickle.dump(chunk, state, pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path + '.tmp', self.path)
+
+    def caches(self):
+        """The spillable state, for registering with a MemoryBudget."""
+        return {'cdc_previous': self.__previous, 'cdc_current': self.__current}
+
+    def close(self):
+        """Remove spilled state from disk."""
+        self.__previous.close()
+        self.__current.close()
+
+    def report(self):
+        return ', '.join(['{} {}'.format(self.counts[status], status) for status
+                          in [NEW, CHANGED, UNCHANGED, 'deleted']])
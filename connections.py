@@ -0,0 +1,164 @@
+""" Shared database connections and schema metadata for all ETL steps.
+
+Every step used to build its own login dict and open its own connection,
+and every stager queried information_schema per table for the column
+order of its dimension. get_pool(config) returns one ConnectionPool per
+database and process, so all steps of a run (see run_all) share the
+same connections, and its MetadataCache reads the columns and data
+types of all DIM and FCT tables in one query, the first time they are
+needed. create_tables invalidates the cache after changing the tables.
+
+Usage:
+    pool = get_pool(config)
+    cnx = pool.connect()
+    ...
+    pool.release(cnx)
+
+    columns = pool.metadata.columns('DIM', 'ZORGPRODUCT')
+"""
+
+import threading
+from contextlib import contextmanager
+import pymssql as sql
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+
+def login(config):
+    """ pymssql connection arguments from the config."""
+    return {
+        'user': config.get('local_mssql', 'user'),
+        'password': config.get('local_mssql', 'password'),
+        'server': config.get('local_mssql', 'server'),
+        'port': config.get('local_mssql', 'port'),
+        'database': config.get('wob_zz', 'database')}
+
+
+class MetadataCache(object):
+    """ Column order and data types of the tables in schemas.
+
+    Arguments:
+    - pool: ConnectionPool of the database
+    - schemas: schemas that are read in one query
+    """
+
+    def __init__(self, pool, schemas=('DIM', 'FCT')):
+        self.pool = pool
+        self.schemas = list(schemas)
+        self.loads = 0
+        self.__tables = None
+
+    def load(self):
+        """ Read the columns of all tables in schemas."""
+        stmt = ('''select table_schema, table_name, column_name, data_type
+                   from information_schema.columns
+                   where table_catalog = %s
+                   and   table_schema in ({})
+                   order by table_schema, table_name, ordinal_position
+                ''').format(', '.join(['%s'] * len(self.schemas)))
+        tables = {}
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor()
+            cursor.execute(stmt, tuple([self.pool.login['database']] +
+                                       self.schemas))
+            for schema, table, column, data_type in cursor.fetchall():
+                tables.setdefault((schema.upper(), table.upper()), []).\
+                    append((column, data_type))
+        self.__tables = tables
+        self.loads += 1
+
+    def invalidate(self):
+        """ Forget the metadata, e.g. after tables are (re)created."""
+        self.__tables = None
+
+    def table(self, schema, table):
+        """ (column, data type) of a table in column order."""
+        if self.__tables is None:
+            self.load()
+        try:
+            return self.__tables[(schema.upper(), table.upper())]
+        except KeyError:
+            raise KeyError('no table {}.{} in database {}'.format(
+                schema, table, self.pool.login['database']))
+
+    def columns(self, schema, table):
+        return [column for column, data_type in self.table(schema, table)]
+
+    def column_types(self, schema, table):
+        return [data_type for column, data_type in self.table(schema, table)]
+
+
+class ConnectionPool(object):
+    """ Connections to one database, shared by the steps of a run.
+
+    Arguments:
+    - login: pymssql connection arguments, see login()
+    - size: maximum number of idle connections kept open
+
+    Connections are returned with release(), which rolls back uncommitted
+    work and switches autocommit off again.
+    """
+
+    def __init__(self, login, size=4):
+        self.login = dict(login)
+        self.size = size
+        self.opened = 0
+        self.reused = 0
+        self.metadata = MetadataCache(self)
+        self.__idle = []
+        self.__lock = threading.Lock()
+
+    def connect(self):
+        """ An idle connection, or a new one if there is none."""
+        with self.__lock:
+            if self.__idle:
+                self.reused += 1
+                return self.__idle.pop()
+            self.opened += 1
+        return sql.connect(**self.login)
+
+    def release(self, cnx):
+        """ Return a connection to the pool."""
+        try:
+            cnx.rollback()
+            cnx.autocommit(False)
+        except sql.Error:
+            # broken connection, don't keep it
+            cnx.close()
+            return
+        with self.__lock:
+            if len(self.__idle) < self.size:
+                self.__idle.append(cnx)
+                return
+        cnx.close()
+
+    @contextmanager
+    def connection(self):
+        cnx = self.connect()
+        try:
+            yield cnx
+        finally:
+            self.release(cnx)
+
+    def close(self):
+        """ Close all idle connections."""
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for cnx in idle:
+            cnx.close()
+
+
+_pools = {}
+
+
+def get_pool(config):
+    """ The shared pool of the database in config."""
+    arguments = login(config)
+    name = (arguments['server'], arguments['port'], arguments['database'],
+            arguments['user'])
+    if name not in _pools:
+        _pools[name] = ConnectionPool(
+            arguments, config.getint('local_mssql', 'pool_size', fallback=4))
+    return _pools[name]
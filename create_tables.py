@@ -15,24 +15,30 @@ NB: no identity declaration for dimension IDs,
 since this is managed by pygrametl during load.
 """
 
-import _mssql as sql
+import pymssql as sql
 import configparser
+import re
+from wob_zz.connections import get_pool
 
 __author__ = 'Daniel Kapitan'
 __maintainer__ = 'Daniel Kapitan'
 __version__ = '0.1'
 
-def main():
-    config = configparser.ConfigParser()
-    config.read('/opt/projects/wob_zz/config.ini')
+def table_definitions(config):
+    """ DDL per table name 'SCHEMA.TABLE' for the current config."""
+
+    # hash-derived subtraject keys need 64 bits
+    if config.get('fct_subtraject', 'stn_key_mode', fallback='sequence') == 'hash':
+        stn_type = 'bigint'
+    else:
+        stn_type = 'int'
 
-    login = {
-        'user': config.get('local_mssql', 'user'),
-        'password': config.get('local_mssql', 'password'),
-        'server': config.get('local_mssql', 'server'),
-        'port': config.get('local_mssql', 'port'),
-        'database': config.get('wob_zz', 'database')
-    }
+    # historized dimensions keep every version of a code, the begin date
+    # is then part of the unique key
+    historize = config.getboolean('wob_zz', 'historize', fallback=False)
+
+    def versions(prefix):
+        return ', {}_dbc_begindatum'.format(prefix) if historize else ''
 
     # All columns that are part of unique key are non-nullable;
     # All other columns DEFAULT NULL
@@ -57,7 +63,18 @@ def main():
         beh_dbc_subgroep_omschrijving nvarchar(255) default null,
         beh_dbc_begindatum date default null,
         beh_dbc_einddatum date default null,
-        constraint UQ__BEH unique (beh_dbc_specialisme_code, beh_dbc_behandeling_code)
+        constraint UQ__BEH unique (beh_dbc_specialisme_code, beh_dbc_behandeling_code{})
+        )
+    ''').format(versions('beh'))
+
+    tables['DIM.BRONBESTAND'] = ('''
+        create table DIM.BRONBESTAND (
+        bbs_id smallint not null primary key,
+        bbs_bestandsnaam nvarchar(255) not null unique,
+        bbs_jaar_maand nvarchar(8) default null,
+        bbs_leverdatum date default null,
+        bbs_aantal_rijen int default null,
+        bbs_geladen_op datetime default null
         )
     ''')
 
@@ -77,15 +94,18 @@ def main():
     tables['DIM.DECLARATIE'] = ('''
         create table DIM.DECLARATIE (
         dcl_id smallint not null primary key,
-        dcl_dbc_declaratie_code nvarchar(6) default null unique,
+        dcl_dbc_declaratie_code nvarchar(6) not null,
         dcl_dbc_tarieftype_code nvarchar(2) default null,
         dcl_dbc_tarieftype_omschrijving nvarchar(255) default null,
         dcl_dbc_declaratie_eenheid_code nvarchar(3) default null,
         dcl_dbc_declaratie_eeheid_omschrijving nvarchar(255) default null,
         dcl_dbc_tariefsoort_code nvarchar(2) default null,
-        dcl_dbc_tariefsoort_omschrijving nvarchar(255) default null
+        dcl_dbc_tariefsoort_omschrijving nvarchar(255) default null,
+        dcl_dbc_begindatum date default null,
+        dcl_dbc_einddatum date default null,
+        constraint UQ__DCL unique (dcl_dbc_declaratie_code{})
         )
-    ''')
+    ''').format(versions('dcl'))
 
     tables['DIM.DIAGNOSE'] = ('''
         create table DIM.DIAGNOSE (
@@ -101,9 +121,9 @@ def main():
         dia_dbc_einddatum date default null,
         dia_dbc_zorgproductgroep_code nvarchar(6) default null,
         dia_dbc_zorgproductgroep_omschrijving nvarchar(255) default null,
-        constraint UQ__DIA unique (dia_dbc_specialisme_code, dia_dbc_diagnose_code)
+        constraint UQ__DIA unique (dia_dbc_specialisme_code, dia_dbc_diagnose_code{})
         )
-    ''')
+    ''').format(versions('dia'))
 
     tables['DIM.LAND'] = ('''
         create table DIM.LAND (
@@ -116,13 +136,13 @@ def main():
 
     tables['DIM.SUBTRAJECTNUMMER'] = ('''
         create table DIM.SUBTRAJECTNUMMER (
-        stn_id int not null primary key,
+        stn_id {} not null primary key,
         stn_subtraject_id nvarchar(40) not null unique,
         stn_subtrajectnummer nvarchar(30) default null,
         stn_zorgtrajectnummer nvarchar(15) default null,
         stn_zorgtrajectnummer_parent nvarchar(15) default null
         )
-    ''')
+    ''').format(stn_type)
 
     tables['DIM.ZORGPRODUCT'] = ('''
         create table DIM.ZORGPRODUCT (
@@ -155,9 +175,9 @@ def main():
         zgt_dbc_subgroep_omschrijving nvarchar(255) default null,
         zgt_dbc_begindatum date default null,
         zgt_dbc_einddatum date default null
-        constraint UQ__ZGT unique (zgt_dbc_specialisme_code,zgt_dbc_zorgtype_code)
+        constraint UQ__ZGT unique (zgt_dbc_specialisme_code,zgt_dbc_zorgtype_code{})
         )
-    ''')
+    ''').format(versions('zgt'))
 
     tables['DIM.ZORGVERLENERSOORT'] = ('''
         create table DIM.ZORGVERLENERSOORT (
@@ -189,9 +209,9 @@ def main():
         zgv_dbc_subgroep_omschrijving nvarchar(255) default null,
         zgv_dbc_begindatum date default null,
         zgv_dbc_einddatum date default null,
-        constraint UQ__ZGV unique (zgv_dbc_specialisme_code,zgv_dbc_zorgvraag_code)
+        constraint UQ__ZGV unique (zgv_dbc_specialisme_code,zgv_dbc_zorgvraag_code{})
         )
-    ''')
+    ''').format(versions('zgv'))
 
     """ not used; required when manually partitioning by year
     subtraject_tables = {'FCT.SUBTRAJECT_{}'.format(year): ('''
@@ -224,6 +244,7 @@ def main():
 
     tables['FCT.SUBTRAJECT'] = ('''
         create table FCT.SUBTRAJECT (
+        bbs_id smallint not null default -1,
         beh_id smallint not null default -1,
         dag_id_begindatum_zorgtraject smallint default -4,
         dag_id_einddatum_zorgtraject smallint default -4,
@@ -231,7 +252,7 @@ def main():
         dag_id_einddatum_subtraject smallint default -4,
         dag_id_declaratiedatum smallint default -4,
         dia_id smallint not null default -1,
-        stn_id int not null default -1,
+        stn_id {} not null default -1,
         zgt_id smallint not null default -1,
         zgv_id smallint not null default -1,
         zpr_id int not null default -1,
@@ -247,12 +268,100 @@ def main():
         fct_omzet_ziekenhuis decimal(9,2) default null,
         fct_omzet_honorarium_totaal decimal(9,2) default null
         )
+    ''').format(stn_type)
+
+    # zorgtraject grain, aggregated from FCT.SUBTRAJECT by load_fct_zorgtraject
+    tables['FCT.ZORGTRAJECT'] = ('''
+        create table FCT.ZORGTRAJECT (
+        ztr_zorgtrajectnummer nvarchar(15) not null primary key,
+        ztr_zorgtrajectnummer_parent nvarchar(15) default null,
+        ztr_zorgtrajectnummer_root nvarchar(15) default null,
+        ztr_ketendiepte smallint default null,
+        dag_id_eerste_begindatum_subtraject smallint default -4,
+        dag_id_laatste_einddatum_subtraject smallint default -4,
+        fct_aantal_subtrajecten int not null default 0,
+        fct_omzet_ziekenhuis decimal(13,2) default null,
+        fct_omzet_honorarium_totaal decimal(13,2) default null
+        )
+    ''')
+
+    return tables
+
+
+def index_definitions():
+    """ DDL of the nonclustered indexes per table name 'SCHEMA.TABLE'."""
+    indexes = {}
+
+    # reload_month and the cdc fallback delete the facts of a month by
+    # source file
+    indexes['FCT.SUBTRAJECT'] = ('''
+        create nonclustered index IX__SUBTRAJECT_BBS
+        on FCT.SUBTRAJECT (bbs_id)
     ''')
 
+    return indexes
+
+
+def table_columns(config):
+    """ Columns per table as (name, data type, nullable), in table order.
+
+    Parsed from the DDL in table_definitions(), e.g.
+    ('stn_id', 'int', False) or ('fct_omzet_ziekenhuis', 'decimal(9,2)', True)
+    """
+    column = re.compile(r'^\s*(\w+)\s+(\w+(?:\(\s*\d+\s*(?:,\s*\d+\s*)?\))?)(.*)$')
+    columns = {}
+    for name, ddl in table_definitions(config).items():
+        body = ddl[ddl.index('(') + 1:]
+        columns[name] = []
+        for line in body.split('\n'):
+            match = column.match(line)
+            if not match or match.group(1).lower() in ('constraint', 'create'):
+                continue
+            columns[name].append((match.group(1),
+                                  match.group(2).replace(' ', '').lower(),
+                                  'not null' not in match.group(3).lower()))
+    return columns
+
+
+def table_keys(config):
+    """ Surrogate key and business key per table, parsed from the DDL.
+
+    The business key is the unique constraint, e.g.
+    'DIM.DIAGNOSE': ('dia_id', ['dia_dbc_specialisme_code',
+                                'dia_dbc_diagnose_code'])
+    Tables without a unique business key are left out.
+    """
+    inline = re.compile(r'^\s*(\w+)\s.*\b(primary key|unique)\b', re.I)
+    constraint = re.compile(r'constraint\s+\w+\s+unique\s*\(([^)]*)\)', re.I)
+    keys = {}
+    for name, ddl in table_definitions(config).items():
+        primary, business = None, []
+        for line in ddl.split('\n'):
+            match = constraint.search(line)
+            if match:
+                business = [column.strip() for column
+                            in match.group(1).split(',')]
+                continue
+            match = inline.match(line)
+            if match and match.group(2).lower() == 'primary key':
+                primary = match.group(1)
+            elif match:
+                business = [match.group(1)]
+        if primary and business:
+            keys[name] = (primary, business)
+    return keys
+
 
+def main():
+    config = configparser.ConfigParser()
+    config.read('/opt/projects/wob_zz/config.ini')
 
+    tables = table_definitions(config)
+    indexes = index_definitions()
 
-    cnx = sql.connect(**login)
+    pool = get_pool(config)
+    cnx = pool.connect()
+    cursor = cnx.cursor()
 
     for name, ddl in tables.items():
         try:
@@ -261,15 +370,20 @@ def main():
                    "where table_schema = '{}' " \
                    "and table_name = '{}')) " \
                    "drop table {}"
-            cnx.execute_non_query(stmt.format(name.split('.')[0], name.split('.')[1], name))
-            cnx.execute_non_query(ddl)
-        except sql.MSSQLDatabaseException as error:
+            cursor.execute(stmt.format(name.split('.')[0], name.split('.')[1], name))
+            cursor.execute(ddl)
+            if name in indexes:
+                cursor.execute(indexes[name])
+            cnx.commit()
+        except sql.DatabaseError as error:
             raise
-            print(error.message)
+            print(error)
         else:
             print('OK')
 
-    cnx.close()
+    # column order and types cached by the stagers are outdated now
+    pool.metadata.invalidate()
+    pool.release(cnx)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,221 @@
+""" Instrumented and bounded caches for the dimensions of the fact load.
+
+The CachedDimensions of load_fct_subtraject are created with size=0 and
+prefill=True: unbounded caches without any figures on how well they
+work. InstrumentedDimension takes over the caching of a dimension and
+counts per file:
+- lookups: calls of lookup() and ensure()
+- hits: answered from the cache
+- fallbacks: misses looked up in the database
+- inserts: new members inserted by ensure()
+- members and bytes: size of the cache after the file
+- distinct: members used in this run (HyperLogLog estimate, see sketches)
+
+The wrapped pygrametl dimension must not cache itself (a plain
+Dimension), so every fallback is one query.
+
+With a size the cache is bounded: LFUCache evicts the least frequently
+used members, with counts halved at every eviction so members that
+were popular in earlier months age out. DimensionStats keeps the
+figures of earlier runs in a JSON file; recommended_size() derives a
+size from the largest working set seen.
+"""
+
+import json
+import math
+import os
+import sys
+import time
+from wob_zz.sketches import HyperLogLog, hash64
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+COUNTERS = ['lookups', 'hits', 'fallbacks', 'inserts']
+
+
+class LFUCache(object):
+    """Mapping with at most size items and frequency-aware eviction.
+
+    Arguments:
+    - size: maximum number of items, 0 for no limit
+    - evict_share: share of the items removed when the cache is full
+    """
+
+    def __init__(self, size=0, evict_share=0.1):
+        self.size = size
+        self.evict_share = evict_share
+        self.evictions = 0
+        self.__items = {}
+
+    def get(self, key):
+        """Return (value, first use) or (None, False) if not cached."""
+        item = self.__items.get(key)
+        if item is None:
+            return None, False
+        item[1] += 1
+        return item[0], item[1] == 1
+
+    def put(self, key, value, count=1):
+        if self.size and key not in self.__items and \
+                len(self.__items) >= self.size:
+            self.__evict()
+        self.__items[key] = [value, count]
+
+    def __evict(self):
+        n = max(1, int(self.size * self.evict_share))
+        coldest = sorted(self.__items.items(), key=lambda item: item[1][1])
+        for key, item in coldest[:n]:
+            del self.__items[key]
+        for item in self.__items.values():
+            item[1] //= 2
+        self.evictions += n
+
+    def __len__(self):
+        return len(self.__items)
+
+    def nbytes(self):
+        """Approximate memory of the keys, values and the table."""
+        total = sys.getsizeof(self.__items)
+        for key, item in self.__items.items():
+            total += sys.getsizeof(key) + sys.getsizeof(item) + \
+                sys.getsizeof(item[0])
+            if isinstance(key, tuple):
+                total += sum([sys.getsizeof(value) for value in key])
+        return total
+
+
+class InstrumentedDimension(object):
+    """Dimension wrapper with a counted, optionally bounded cache.
+
+    Arguments:
+    - dimension: pygrametl Dimension without cache of its own
+    - size: maximum number of cached members, 0 for no limit
+
+    prefill(cursor) fills the cache from the table.
+    """
+
+    def __init__(self, dimension, size=0):
+        self.dimension = dimension
+        self.name = dimension.name
+        self.key = dimension.key
+        self.lookupatts = dimension.lookupatts
+        self.cache = LFUCache(size)
+        self.distinct = HyperLogLog()
+        self.counts = dict([(counter, 0) for counter in COUNTERS])
+
+    def prefill(self, cursor):
+        """Cache the members of the table, up to the size of the cache."""
+        cursor.execute('select {}, {} from {}'.format(
+            self.key, ', '.join(self.lookupatts), self.name))
+        for row in cursor.fetchall():
+            if self.cache.size and len(self.cache) >= self.cache.size:
+                break
+            self.cache.put(tuple(row[1:]), row[0], count=0)
+
+    def __lookupkey(self, row, namemapping):
+        return tuple([row[namemapping.get(att) or att]
+                      for att in self.lookupatts])
+
+    def __cached(self, lookupkey):
+        self.counts['lookups'] += 1
+        keyvalue, first = self.cache.get(lookupkey)
+        if keyvalue is not None:
+            self.counts['hits'] += 1
+            if first:
+                self.distinct.add_hash(hash64(lookupkey))
+        return keyvalue
+
+    def __store(self, lookupkey, keyvalue):
+        self.cache.put(lookupkey, keyvalue)
+        self.distinct.add_hash(hash64(lookupkey))
+
+    def lookup(self, row, namemapping={}):
+        lookupkey = self.__lookupkey(row, namemapping)
+        keyvalue = self.__cached(lookupkey)
+        if keyvalue is None:
+            self.counts['fallbacks'] += 1
+            keyvalue = self.dimension.lookup(row.copy(), namemapping)
+            if keyvalue is not None:
+                self.__store(lookupkey, keyvalue)
+        return keyvalue
+
+    def ensure(self, row, namemapping={}):
+        lookupkey = self.__lookupkey(row, namemapping)
+        keyvalue = self.__cached(lookupkey)
+        if keyvalue is None:
+            self.counts['fallbacks'] += 1
+            row = row.copy()
+            keyvalue = self.dimension.lookup(row, namemapping)
+            if keyvalue is None:
+                self.counts['inserts'] += 1
+                keyvalue = self.dimension.insert(row, namemapping)
+            self.__store(lookupkey, keyvalue)
+        return keyvalue
+
+    def stats(self):
+        """Counters since the previous reset and the size of the cache."""
+        stats = dict(self.counts)
+        stats.update({'members': len(self.cache), 'bytes': self.cache.nbytes(),
+                      'size': self.cache.size,
+                      'evictions': self.cache.evictions,
+                      'distinct': self.distinct.count()})
+        return stats
+
+    def reset(self):
+        """Start counting for the next file; the cache is kept."""
+        self.counts = dict([(counter, 0) for counter in COUNTERS])
+
+    def report(self):
+        stats = self.stats()
+        return ('{} lookups, {:.1%} hits, {} database lookups, {} inserts, '
+                '{} members ({:.1f} MB){}').format(
+            stats['lookups'],
+            stats['hits'] / float(stats['lookups'] or 1),
+            stats['fallbacks'], stats['inserts'], stats['members'],
+            stats['bytes'] / 1048576.0,
+            ', size {}, {} evicted'.format(stats['size'], stats['evictions'])
+            if stats['size'] else '')
+
+
+class DimensionStats(object):
+    """Statistics of the dimension caches per loaded file, kept as JSON.
+
+    Arguments:
+    - path: JSON file with the statistics of earlier files
+    - history: number of files kept
+    """
+
+    def __init__(self, path, history=100):
+        self.path = path
+        self.history = history
+        self.files = []
+        if os.path.exists(path):
+            with open(path) as stats:
+                self.files = json.load(stats)
+
+    def add(self, file, dimensions):
+        """Record the statistics of the dimensions {name: wrapper}."""
+        self.files.append({
+            'file': file, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'dimensions': dict([(name, dimension.stats()) for name, dimension
+                                in dimensions.items()])})
+        self.files = self.files[-self.history:]
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.path + '.tmp', 'w') as stats:
+            json.dump(self.files, stats, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+    def recommended_size(self, name, headroom=1.2, minimum=1000):
+        """Cache size for a dimension from its largest working set, None
+        if there are no statistics of it."""
+        distinct = [file['dimensions'][name]['distinct']
+                    for file in self.files if name in file['dimensions']]
+        if not distinct:
+            return None
+        return max(minimum, int(math.ceil(max(distinct) * headroom)))
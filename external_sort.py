@@ -0,0 +1,164 @@
+""" External-memory sort of records on local disk.
+
+Records are collected in memory up to run_size, sorted and spilled to
+a temporary run file; iterating the sorter k-way merges all runs with
+heapq.merge. Memory use is bounded by run_size records plus one block
+per run, regardless of the total number of records.
+
+Runs are written as a stream of pickled blocks of records, so reading a
+run back needs one unpickle per block instead of one per record.
+"""
+
+import heapq
+import os
+import pickle
+import tempfile
+from wob_zz.memory_budget import sizeof_items
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+
+def _read_run(path):
+    """Records of one sorted run file."""
+    with open(path, 'rb', buffering=1 << 20) as run:
+        while True:
+            try:
+                block = pickle.load(run)
+            except EOFError:
+                return
+            for record in block:
+                yield record
+
+
+class ExternalSorter(object):
+    """Sort records that do not fit in memory.
+
+    Arguments:
+    - key: function of a record to sort on, default the record itself
+    - run_size: number of records kept in memory before spilling a run
+    - tempdir: directory for the run files, default the system temp dir
+    - blocksize: records per pickled block in a run file
+
+    Usage: add() or extend() all records, then iterate once over the
+    sorter; close() removes the run files.
+    """
+
+    def __init__(self, key=None, run_size=1000000, tempdir=None,
+                 blocksize=10000):
+        self.key = key
+        self.run_size = run_size
+        self.tempdir = tempdir
+        self.blocksize = blocksize
+        self.records = 0
+        self.__buffer = []
+        self.__runs = []
+
+    def add(self, record):
+        self.__buffer.append(record)
+        self.records += 1
+        if len(self.__buffer) >= self.run_size:
+            self.__spill()
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+
+    def __spill(self):
+        self.__buffer.sort(key=self.key)
+        if self.tempdir and not os.path.exists(self.tempdir):
+            os.makedirs(self.tempdir)
+        handle, path = tempfile.mkstemp(suffix='.run', dir=self.tempdir)
+        with os.fdopen(handle, 'wb', buffering=1 << 20) as run:
+            for i in range(0, len(self.__buffer), self.blocksize):
+                pickle.dump(self.__buffer[i:i + self.blocksize], run,
+                            pickle.HIGHEST_PROTOCOL)
+        self.__runs.append(path)
+        self.__buffer = []
+
+    @property
+    def runs(self):
+        return len(self.__runs)
+
+    def nbytes(self):
+        """Estimated memory of the records not yet spilled."""
+        return sizeof_items(self.__buffer)
+
+    def __iter__(self):
+        """Merge the runs and the records still in memory in key order."""
+        self.__buffer.sort(key=self.key)
+        if not self.__runs:
+            return iter(self.__buffer)
+        sources = [_read_run(path) for path in self.__runs]
+        sources.append(iter(self.__buffer))
+        return heapq.merge(*sources, key=self.key)
+
+    def close(self):
+        """Remove the run files and clear the records in memory."""
+        for path in self.__runs:
+            if os.path.exists(path):
+                os.remove(path)
+        self.__runs = []
+        self.__buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SortingFactTable(object):
+    """Fact table wrapper that sorts each bulk batch by a key.
+
+    Rows are spilled through an ExternalSorter and written to the wrapped
+    bulk fact table in key order when the batch is loaded, so the bulk
+    file arrives sorted on e.g. the clustered index of the table.
+
+    Arguments:
+    - table: bulk fact table with insert() and _bulkloadnow(), e.g. a
+      pygrametl BulkFactTable with a bulksize above the batch size
+    - attributes: names of the columns of the table
+    - key: names of the columns to sort on; None sorts before any value
+    - run_size, tempdir: see ExternalSorter
+    """
+
+    def __init__(self, table, attributes, key, run_size=1000000,
+                 tempdir=None):
+        self.table = table
+        self.name = table.name
+        self.attributes = list(attributes)
+        self.sortkey = list(key)
+        positions = [self.attributes.index(att) for att in self.sortkey]
+        self.__key = lambda record: tuple([(record[i] is not None, record[i])
+                                           for i in positions])
+        self.run_size = run_size
+        self.tempdir = tempdir
+        self.__sorter = None
+
+    def insert(self, row, namemapping={}):
+        if self.__sorter is None:
+            self.__sorter = ExternalSorter(self.__key, self.run_size,
+                                           self.tempdir)
+        self.__sorter.add(tuple([row[namemapping.get(att) or att]
+                                 for att in self.attributes]))
+
+    def nbytes(self):
+        """Estimated memory of the batch, see ExternalSorter.nbytes()."""
+        return 0 if self.__sorter is None else self.__sorter.nbytes()
+
+    def _bulkloadnow(self):
+        if self.__sorter is None:
+            return
+        sorter, self.__sorter = self.__sorter, None
+        try:
+            attributes = self.attributes
+            for record in sorter:
+                self.table.insert(dict(zip(attributes, record)))
+        finally:
+            sorter.close()
+        self.table._bulkloadnow()
+
+    def endload(self):
+        self._bulkloadnow()
@@ -16,66 +16,117 @@ NNB:    tempdest is stored in /var/folders/ ...
 import bz2
 import csv
 import configparser
-import pymssql as sql
+import os
+import re
+import sys
 import time
 import pygrametl as etl
-from pygrametl.tables import CachedDimension, BulkFactTable, BulkDimension
+from pygrametl.tables import CachedDimension, BulkFactTable, \
+    Dimension
 from wob_zz import *
+from wob_zz.batch_policy import AdaptiveBulkPolicy
+from wob_zz import shared_dimensions
+from wob_zz.rows import make_row_class, Latin1Reader
+from wob_zz.transform import Column, compile_plan
+from wob_zz.surrogate_keys import HashKeyFinder, KeyMapDimension
+from wob_zz.versioned_dimensions import VersionedLookup, VersionedDimension
+from wob_zz.native_format import NativeBulkFactTable
+from wob_zz.aggregates import AggregateCache, parse_rollups
+from wob_zz.sketches import SourceProfile
+from wob_zz.bloom import BloomFrontedDimension
+from wob_zz.external_sort import SortingFactTable
+from wob_zz.profiling import SamplingProfiler
+from wob_zz.memory_budget import MemoryBudget, SpillableDict, \
+    SizeEstimate, sizeof_items
+from wob_zz.replica import Replica
+from wob_zz.audit import Check, FileAudit
+from wob_zz.dimension_stats import InstrumentedDimension, DimensionStats
+from wob_zz.create_tables import table_columns
+from wob_zz.connections import get_pool
+from wob_zz.bulkloader import mssql_bulkloader
+from wob_zz.change_capture import ChangeCapture, CHANGED, UNCHANGED, \
+    delivery_key
 
-# import cProfile, pstats, StringIO
 
 __author__ = 'Daniel Kapitan'
 __maintainer__ = 'Daniel Kapitan'
 __version__ = '0.1'
 
 
-def mssql_bulkloader(tablename, attributes, fieldsep, rowsep, nullsubst, tempdest):
-    """Bulkloader using MS SQL Server bulk insert.
-
-    This works for the following setup:
-    - Python 3 (anaconda) running on OSX
-    - SQL Server 2014 running on Windows 7 Ultimate running on Parallels 9
-    - pymssql / FreeTDS as python DB API
-    - /var/library directory that has tempdest files is shared via Parallels
-
-    NB:
-    - rowterminator = '0x0a' due to differences Windows vs. UNIX
-    - ms sql want full datetime, e.g. 2007-01-10 00:00:00, for dates
-    - ms sql can't deal with text delimiters --> do without,
-        check no delimiters in fields
-    - open statements with " or ''' and use single quotes
-        for strings in sql statements!!
-    """
-    global cur
-    win_temp = '\\\\psf' + tempdest.replace('/','\\')
-    stmt = ('''bulk insert {} from '{}'
-               with (firstrow=1,
-               fieldterminator='\\t',
-               rowterminator='0x0a',
-               codepage='1252')
-             '''.format(tablename, win_temp))
-    print("    sql> " + stmt)
-    cur.execute(stmt)
-    print("    number of rows affected: {}".format(cur.rowcount))
-
-
 # setup connection to database
 config = configparser.ConfigParser()
 config.read('/opt/projects/wob_zz/config.ini')
 
-login = {
-    'user': config.get('local_mssql', 'user'),
-    'password': config.get('local_mssql', 'password'),
-    'server': config.get('local_mssql', 'server'),
-    'port': config.get('local_mssql', 'port'),
-    'database': config.get('wob_zz', 'database')
-    }
+# columns to sort each FCT.SUBTRAJECT bulk batch on, e.g. the clustered key
+sort_key = config.get('fct_subtraject', 'sort_key', fallback='').\
+    replace(',', ' ').split()
 
-cnx = sql.connect(**login)
+pool = get_pool(config)
+cnx = pool.connect()
 cur = cnx.cursor()
 connection = etl.ConnectionWrapper(cnx)
 connection.setasdefault()
 
+# bulk insert of text and native bulk files, FCT.SUBTRAJECT with an ORDER
+# hint when its batches are sorted
+bulk_order = {'FCT.SUBTRAJECT': sort_key} if sort_key else {}
+mssql_text_bulkloader = mssql_bulkloader(cur, order=bulk_order)
+mssql_native_bulkloader = mssql_bulkloader(cur, native=True, order=bulk_order)
+
+
+def commit_batches():
+    """Intermediate commit of the fact load, called after a fact batch.
+
+    The new subtrajectnummers of the batch are still in the bulk file of
+    DIM_SUBTRAJECTNUMMER, so they are loaded first: committed facts must
+    not refer to stn_ids that are not in the database. connection.commit()
+    can't be used here, it would load the fact batch that is being loaded.
+    """
+    stn_table._bulkloadnow()
+    cnx.commit()
+
+
+# adaptive bulk batch size for FCT.SUBTRAJECT with a commit every N batches
+# to keep the transaction log of MS SQL Server flat
+bulk_policy = AdaptiveBulkPolicy(
+    bulksize=config.getint('fct_subtraject', 'bulksize', fallback=50000),
+    min_bulksize=config.getint('fct_subtraject', 'bulksize_min', fallback=10000),
+    max_bulksize=config.getint('fct_subtraject', 'bulksize_max', fallback=500000),
+    commit_every=config.getint('fct_subtraject', 'commit_every', fallback=0),
+    commit=commit_batches)
+
+# name prefix of shared-memory dimension lookups for multi-process loads;
+# workers attach to the published lookups instead of prefilling caches
+shared_prefix = config.get('fct_subtraject', 'shared_dimensions', fallback='')
+
+# 'off' keeps the pygrametl caches, 'instrumented' replaces them by caches
+# with statistics per file, 'bounded' also limits them to the size derived
+# from the statistics of earlier runs
+cache_mode = config.get('dimension_cache', 'mode', fallback='off')
+prefill = not shared_prefix and cache_mode == 'off'
+
+# 'sequence' numbers stn_id after the highest in the table, 'hash' derives
+# stn_id from stn_subtraject_id so keys are stable and need no shared key
+# state
+stn_key_mode = config.get('fct_subtraject', 'stn_key_mode', fallback='sequence')
+
+# resident size in MB above which the per-subtraject caches (subtraject
+# key map, issued hash keys, change capture state) are spilled to
+# spill_path; 0 for no limit.
+# The dimension caches and bulk buffers are tracked, see track_caches()
+memory_budget = MemoryBudget(
+    config.getint('fct_subtraject', 'memory_budget', fallback=0) * 1048576)
+spill_path = config.get('fct_subtraject', 'spill_path', fallback=None)
+
+# historized dimensions resolve the version valid on declaratiedatum
+historize = config.getboolean('wob_zz', 'historize', fallback=False)
+
+# 'full' truncates and reloads FCT.SUBTRAJECT, 'cdc' only applies new,
+# changed and deleted subtrajecten compared with the previous delivery;
+# the per-month change state is kept in cdc_path
+load_mode = config.get('fct_subtraject', 'load_mode', fallback='full')
+cdc_path = config.get('fct_subtraject', 'cdc_path', fallback='')
+
 
 # define dimension object for ETL
 # Note that:
@@ -86,7 +137,7 @@ name='DIM.AFSLUITREDEN',
 key='afs_id',
 attributes=['afs_afsluitreden_code'],
 size=0,
-prefill=True
+prefill=prefill
 )
 
 DIM_BEHANDELING = CachedDimension(
@@ -94,7 +145,16 @@ DIM_BEHANDELING = CachedDimension(
     key='beh_id',
     attributes=['beh_dbc_specialisme_code', 'beh_dbc_behandeling_code'],
     size=0,
-    prefill=True
+    prefill=prefill
+)
+
+DIM_BRONBESTAND = CachedDimension(
+    name='DIM.BRONBESTAND',
+    key='bbs_id',
+    attributes=['bbs_bestandsnaam', 'bbs_jaar_maand', 'bbs_leverdatum'],
+    lookupatts=['bbs_bestandsnaam'],
+    size=0,
+    prefill=prefill
 )
 
 DIM_DAG = CachedDimension(
@@ -102,7 +162,7 @@ DIM_DAG = CachedDimension(
     key='dag_id',
     attributes=['dag_datum'],
     size=0,
-    prefill=True
+    prefill=prefill
 )
 
 DIM_DECLARATIE = CachedDimension(
@@ -110,7 +170,7 @@ DIM_DECLARATIE = CachedDimension(
     key='dcl_id',
     attributes=['dcl_dbc_declaratie_code'],
     size=0,
-    prefill=True
+    prefill=prefill
 )
 
 DIM_DIAGNOSE = CachedDimension(
@@ -118,7 +178,7 @@ DIM_DIAGNOSE = CachedDimension(
     key='dia_id',
     attributes=['dia_dbc_specialisme_code', 'dia_dbc_diagnose_code'],
     size=0,
-    prefill=True
+    prefill=prefill
 )
 
 DIM_LAND = CachedDimension(
@@ -126,20 +186,40 @@ DIM_LAND = CachedDimension(
     key='lnd_id',
     attributes=['lnd_iso_land_code'],
     size=0,
-    prefill=True
+    prefill=prefill
 )
 
-DIM_SUBTRAJECTNUMMER = BulkDimension(
+stn_key_finder = None
+if stn_key_mode == 'hash':
+    stn_key_finder = HashKeyFinder('stn_subtraject_id',
+                                   SpillableDict(tempdir=spill_path))
+    memory_budget.register('stn_hash_keys', stn_key_finder.issued)
+
+# one member per subtraject: the subtraject_id -> stn_id map can be
+# spilled to spill_path, new members are bulk loaded without a cache
+stn_keys = SpillableDict(tempdir=spill_path)
+memory_budget.register('DIM_SUBTRAJECTNUMMER', stn_keys)
+
+stn_table = BulkFactTable(
     name='DIM.SUBTRAJECTNUMMER',
-    key='stn_id',
-    attributes=['stn_subtraject_id', 'stn_subtrajectnummer',
-                'stn_zorgtrajectnummer', 'stn_zorgtrajectnummer_parent'],
-    lookupatts=['stn_subtraject_id'],
+    keyrefs=['stn_id'],
+    measures=['stn_subtraject_id', 'stn_subtrajectnummer',
+              'stn_zorgtrajectnummer', 'stn_zorgtrajectnummer_parent'],
     nullsubst='',
     fieldsep='\t',
     rowsep='\r\n',
     usefilename=True,
-    bulkloader=mssql_bulkloader
+    bulkloader=mssql_text_bulkloader
+)
+
+DIM_SUBTRAJECTNUMMER = KeyMapDimension(
+    stn_table,
+    key='stn_id',
+    attributes=['stn_subtraject_id', 'stn_subtrajectnummer',
+                'stn_zorgtrajectnummer', 'stn_zorgtrajectnummer_parent'],
+    lookupatt='stn_subtraject_id',
+    keys=stn_keys,
+    idfinder=stn_key_finder
 )
 
 DIM_ZORGPRODUCT = CachedDimension(
@@ -147,7 +227,7 @@ DIM_ZORGPRODUCT = CachedDimension(
     key='zpr_id',
     attributes=['zpr_dbc_zorgproduct_code'],
     size=0,
-    prefill=True
+    prefill=prefill
 )
 
 DIM_ZORGTYPE = CachedDimension(
@@ -155,7 +235,7 @@ DIM_ZORGTYPE = CachedDimension(
     key='zgt_id',
     attributes=['zgt_dbc_specialisme_code', 'zgt_dbc_zorgtype_code'],
     size=0,
-    prefill=True
+    prefill=prefill
 )
 
 DIM_ZORGVERLENERSOORT = CachedDimension(
@@ -163,7 +243,7 @@ DIM_ZORGVERLENERSOORT = CachedDimension(
     key='zvs_id',
     attributes=['zvs_vektis_zorgverlenersoort_code'],
     size=0,
-    prefill=True
+    prefill=prefill
 )
 
 DIM_ZORGVRAAG = CachedDimension(
@@ -171,174 +251,724 @@ DIM_ZORGVRAAG = CachedDimension(
     key='zgv_id',
     attributes=['zgv_dbc_specialisme_code', 'zgv_dbc_zorgvraag_code'],
     size=0,
-    prefill=True
+    prefill=prefill
 )
 
-FCT_SUBTRAJECT = BulkFactTable(
-    name='FCT.SUBTRAJECT',
-    keyrefs=['beh_id', 'dag_id_begindatum_zorgtraject',
-             'dag_id_einddatum_zorgtraject', 'dag_id_begindatum_subtraject',
-             'dag_id_einddatum_subtraject', 'dag_id_declaratiedatum',
-             'dia_id', 'stn_id', 'zgt_id', 'zgv_id', 'zpr_id',
-             'zvs_id_behandelend', 'zvs_id_verwijzend'],
-    measures=['geslacht', 'heeft_oranje_zorgactiviteit',
-              'heeft_zorgactiviteit_met_machtiging',
-              'is_hoofdtraject', 'is_aanspraak_zvw',
-              'is_aanspraak_zvw_toegepast',
-              'is_zorgactiviteitvertaling_toegepast', 'fct_omzet_ziekenhuis',
-              'fct_omzet_honorarium_totaal'],
-    nullsubst='',
-    fieldsep='\t',
-    rowsep='\r\n',
-    usefilename=True,
-    bulkloader=mssql_bulkloader
-)
+# rollups of FCT.SUBTRAJECT kept as cubes per loaded month
+aggregates = None
+if config.get('aggregates', 'rollups', fallback='').strip():
+    aggregates = AggregateCache(
+        config.get('aggregates', 'path'),
+        parse_rollups(config.get('aggregates', 'rollups')))
+# the six J/N flags packed into one integer, only for rollups that use it
+pack_vlaggen = aggregates is not None and 'vlaggen' in aggregates.columns
+
+# local Parquet replica of the star schema, empty path to disable
+replica = None
+if config.get('replica', 'path', fallback=''):
+    replica = Replica(config.get('replica', 'path'), table_columns(config),
+                      batch_size=config.getint('replica', 'batch_size',
+                                               fallback=100000))
+
+# text bulk files or typed native files for FCT.SUBTRAJECT
+bulk_format = config.get('fct_subtraject', 'bulk_format', fallback='text')
+if bulk_format == 'native':
+    FCT_SUBTRAJECT = NativeBulkFactTable(
+        name='FCT.SUBTRAJECT',
+        columns=table_columns(config)['FCT.SUBTRAJECT'],
+        bulksize=bulk_policy.max_bulksize + 1,
+        bulkloader=bulk_policy.wrap(mssql_native_bulkloader)
+    )
+else:
+    FCT_SUBTRAJECT = BulkFactTable(
+        name='FCT.SUBTRAJECT',
+        keyrefs=['bbs_id', 'beh_id', 'dag_id_begindatum_zorgtraject',
+                 'dag_id_einddatum_zorgtraject', 'dag_id_begindatum_subtraject',
+                 'dag_id_einddatum_subtraject', 'dag_id_declaratiedatum',
+                 'dia_id', 'stn_id', 'zgt_id', 'zgv_id', 'zpr_id',
+                 'zvs_id_behandelend', 'zvs_id_verwijzend'],
+        measures=['geslacht', 'heeft_oranje_zorgactiviteit',
+                  'heeft_zorgactiviteit_met_machtiging',
+                  'is_hoofdtraject', 'is_aanspraak_zvw',
+                  'is_aanspraak_zvw_toegepast',
+                  'is_zorgactiviteitvertaling_toegepast', 'fct_omzet_ziekenhuis',
+                  'fct_omzet_honorarium_totaal'],
+        nullsubst='',
+        fieldsep='\t',
+        rowsep='\r\n',
+        usefilename=True,
+        bulksize=bulk_policy.max_bulksize + 1,
+        bulkloader=bulk_policy.wrap(mssql_text_bulkloader)
+    )
+
+# sort the fact batches on local disk before they are bulk loaded
+if sort_key:
+    FCT_SUBTRAJECT = SortingFactTable(
+        FCT_SUBTRAJECT, FCT_SUBTRAJECT.all, sort_key,
+        run_size=config.getint('fct_subtraject', 'sort_run_size',
+                               fallback=1000000),
+        tempdir=config.get('fct_subtraject', 'sort_path', fallback=None))
+
+# columns of DOT subtraject files (STR) and the derived dimension ids
+names_STR = ['datum_aanmaak', 'landcode', 'geslacht',
+             'verwijzend_specialisme', 'zorgtrajectnummer',
+             'zorgtrajectnummer_parent', 'begindatum_zorgtraject',
+             'einddatum_zorgtraject', 'declaratiedatasetnummer',
+             'subtrajectnummer', 'subtraject_id', 'declaratiecode',
+             'behandelend_specialisme', 'zorgtypecode', 'zorgvraagcode',
+             'typerende_diagnose', 'icd10_vertaling_diagnose',
+             'hoofdtraject_indicatie', 'zorgproductcode',
+             'dbc_reden_sluiten', 'aanspraak_zvw',
+             'aanspraak_zvw_toegepast', 'zorgact_met_machtiging',
+             'oranje_zorgactiviteit', 'zorgactiviteitvertaling_toegepast',
+             'begindatum_subtraject', 'einddatum_subtraject',
+             'declaratiedatum', 'dbc_ziekenhuiskosten',
+             'honorarium_totaal']
+ids_STR = ['bbs_id', 'beh_id', 'dag_id_begindatum_zorgtraject',
+           'dag_id_einddatum_zorgtraject', 'dag_id_begindatum_subtraject',
+           'dag_id_einddatum_subtraject', 'dag_id_declaratiedatum',
+           'dia_id', 'stn_id', 'zgt_id', 'zgv_id', 'zpr_id',
+           'zvs_id_behandelend', 'zvs_id_verwijzend']
+
+# cleansing per source column: parser, pad width, default and the
+# dimension attributes and fact measures the value is copied to
+columns_STR = [
+    Column('begindatum_zorgtraject', 'date'),
+    Column('einddatum_zorgtraject', 'date'),
+    Column('begindatum_subtraject', 'date'),
+    Column('einddatum_subtraject', 'date'),
+    Column('declaratiedatum', 'date'),
+    # ensure DBC codes are filled to right length
+    Column('verwijzend_specialisme', 'code', 4, '_?_'),
+    Column('behandelend_specialisme', 'code', 4, '_?_',
+           ['dia_dbc_specialisme_code', 'zgt_dbc_specialisme_code',
+            'zgv_dbc_specialisme_code']),
+    Column('zorgtypecode', 'code', 2, '??', ['zgt_dbc_zorgtype_code']),
+    Column('zorgvraagcode', 'code', 4, '_?_', ['zgv_dbc_zorgvraag_code']),
+    Column('typerende_diagnose', 'code', 4, '_?_', ['dia_dbc_diagnose_code']),
+    Column('zorgproductcode', 'code', 9, '_?_', ['zpr_dbc_zorgproduct_code']),
+    # geslacht as int conform COD046_NEN / Vektis
+    Column('geslacht', 'int', default=0),
+    Column('hoofdtraject_indicatie', 'boolean', targets=['is_hoofdtraject']),
+    Column('aanspraak_zvw', 'boolean', targets=['is_aanspraak_zvw']),
+    Column('aanspraak_zvw_toegepast', 'boolean',
+           targets=['is_aanspraak_zvw_toegepast']),
+    Column('oranje_zorgactiviteit', 'boolean',
+           targets=['heeft_oranje_zorgactiviteit']),
+    Column('zorgact_met_machtiging', 'boolean',
+           targets=['heeft_zorgactiviteit_met_machtiging']),
+    Column('zorgactiviteitvertaling_toegepast', 'boolean',
+           targets=['is_zorgactiviteitvertaling_toegepast']),
+    # money values from cents into decimals
+    Column('dbc_ziekenhuiskosten', 'money', targets=['fct_omzet_ziekenhuis']),
+    Column('honorarium_totaal', 'money',
+           targets=['fct_omzet_honorarium_totaal']),
+    Column('subtraject_id', targets=['stn_subtraject_id']),
+    Column('subtrajectnummer', targets=['stn_subtrajectnummer']),
+    Column('zorgtrajectnummer', targets=['stn_zorgtrajectnummer']),
+    Column('zorgtrajectnummer_parent',
+           targets=['stn_zorgtrajectnummer_parent']),
+    ]
+
+# row representation: 'dict' (csv.DictReader) or 'slots' (positional rows
+# read as latin-1 bytes)
+row_format = config.get('fct_subtraject', 'row_format', fallback='dict')
+plan_STR = compile_plan(columns_STR, row_format)
+SubtrajectRow = make_row_class('SubtrajectRow', names_STR,
+                               ids_STR + plan_STR.targets + ['vlaggen'])
+
+# false positive rate of the Bloom filter in front of the subtraject key
+# map, 0 = off
+bloom_error_rate = config.getfloat('fct_subtraject', 'bloom_error_rate',
+                                   fallback=0)
+
+# sampling profiler of load_str_dot(), bounded by rows and/or seconds;
+# also switched on from the command line with 'profile YYYYMM'
+sampling = config.getboolean('fct_subtraject', 'sampling', fallback=False)
+
+# source columns profiled with sketches during the load, saved per file
+profile_path = config.get('fct_subtraject', 'profile_path', fallback='')
+profile_names = config.get('fct_subtraject', 'profile_columns',
+                           fallback='').split()
+
+
+# audit of the resolved keys after each file; DIM.SUBTRAJECTNUMMER is not
+# audited, reading all its keys per file would not be negligible
+AUDIT_CHECKS = [
+    Check('dag_id_begindatum_zorgtraject', 'DIM.DAG', 'dag_id',
+          ['begindatum_zorgtraject'], (-1, -3)),
+    Check('dag_id_einddatum_zorgtraject', 'DIM.DAG', 'dag_id',
+          ['einddatum_zorgtraject'], (-1, -3)),
+    Check('dag_id_begindatum_subtraject', 'DIM.DAG', 'dag_id',
+          ['begindatum_subtraject'], (-1, -3)),
+    Check('dag_id_einddatum_subtraject', 'DIM.DAG', 'dag_id',
+          ['einddatum_subtraject'], (-1, -3)),
+    Check('dag_id_declaratiedatum', 'DIM.DAG', 'dag_id',
+          ['declaratiedatum'], (-1, -3)),
+    Check('dia_id', 'DIM.DIAGNOSE', 'dia_id',
+          ['behandelend_specialisme', 'typerende_diagnose']),
+    Check('zgt_id', 'DIM.ZORGTYPE', 'zgt_id',
+          ['behandelend_specialisme', 'zorgtypecode']),
+    Check('zgv_id', 'DIM.ZORGVRAAG', 'zgv_id',
+          ['behandelend_specialisme', 'zorgvraagcode']),
+    Check('zpr_id', 'DIM.ZORGPRODUCT', 'zpr_id', ['zorgproductcode']),
+    Check('zvs_id_behandelend', 'DIM.ZORGVERLENERSOORT', 'zvs_id',
+          ['behandelend_specialisme']),
+    Check('zvs_id_verwijzend', 'DIM.ZORGVERLENERSOORT', 'zvs_id',
+          ['verwijzend_specialisme'])]
+
+
+def audit_threshold(option):
+    """Threshold from [audit] as float, None if empty (not checked)."""
+    value = config.get('audit', option, fallback='').strip()
+    return float(value) if value else None
+
+
+def profile_columns(names):
+    """Raw values per source column that fall back to the column default."""
+    specs = dict([(column.source, column) for column in columns_STR])
+    columns = {}
+    for name in names:
+        spec = specs.get(name)
+        if spec is not None and spec.parser == 'code':
+            columns[name] = ('', '0')
+        elif spec is not None and spec.default is not None:
+            columns[name] = ('',)
+        else:
+            columns[name] = ()
+    return columns
+
+
+# dimensions that can be served from shared memory
+SHARED_DIMENSIONS = ['DIM_DAG', 'DIM_DIAGNOSE', 'DIM_ZORGPRODUCT',
+                     'DIM_ZORGTYPE', 'DIM_ZORGVERLENERSOORT', 'DIM_ZORGVRAAG']
+
+
+def publish_dimension_caches(prefix):
+    """Publish lookup tables of SHARED_DIMENSIONS into shared memory.
+
+    Run once before starting the worker processes; the segments remain
+    available until unpublish_dimension_caches() is called.
+    """
+    for name in SHARED_DIMENSIONS:
+        segment = shared_dimensions.publish_dimension(
+            globals()[name], cur, prefix + name)
+        print('Published {} as {} ({} bytes)'.
+              format(name, segment.name, segment.size))
+        segment.close()
+
+
+def unpublish_dimension_caches(prefix):
+    """Remove the shared-memory lookup tables."""
+    for name in SHARED_DIMENSIONS:
+        shared_dimensions.unlink(prefix + name)
+
+
+def attach_dimension_caches(prefix):
+    """Replace SHARED_DIMENSIONS by read-only shared-memory lookups."""
+    for name in SHARED_DIMENSIONS:
+        globals()[name] = shared_dimensions.SharedDimension(
+            globals()[name], prefix + name)
 
-def load_str_dot(file, config):
+
+def delete_facts(stn_ids):
+    """Delete fact rows of changed or deleted subtrajecten by stn_id."""
+    global cur
+    if not stn_ids:
+        return
+    cur.execute("if object_id('tempdb..#stn_delete') is null "
+                "create table #stn_delete (stn_id bigint not null)")
+    cur.execute("truncate table #stn_delete")
+    cur.executemany("insert into #stn_delete values (%d)",
+                    [(stn_id,) for stn_id in stn_ids])
+    cur.execute("delete f from FCT.SUBTRAJECT f "
+                "join #stn_delete d on f.stn_id = d.stn_id")
+    print("    number of rows deleted: {}".format(cur.rowcount))
+
+
+def update_members(rows):
+    """Update DIM.SUBTRAJECTNUMMER attributes of changed subtrajecten."""
+    global cur
+    if not rows:
+        return
+    cur.executemany("update DIM.SUBTRAJECTNUMMER "
+                    "set stn_subtrajectnummer = %s, "
+                    "stn_zorgtrajectnummer = %s, "
+                    "stn_zorgtrajectnummer_parent = %s "
+                    "where stn_id = %d", rows)
+    print("    number of members updated: {}".format(len(rows)))
+
+
+# historized dimensions with their validity columns
+VERSIONED_DIMENSIONS = {
+    'DIM_DIAGNOSE': ('dia_dbc_begindatum', 'dia_dbc_einddatum'),
+    'DIM_ZORGTYPE': ('zgt_dbc_begindatum', 'zgt_dbc_einddatum'),
+    'DIM_ZORGVRAAG': ('zgv_dbc_begindatum', 'zgv_dbc_einddatum')}
+
+
+def attach_versioned_dimensions():
+    """Replace VERSIONED_DIMENSIONS by point-in-time lookups."""
+    for name, (fromatt, toatt) in VERSIONED_DIMENSIONS.items():
+        dimension = globals()[name]
+        versions = VersionedLookup.from_table(
+            cur, dimension.name, dimension.key, dimension.lookupatts,
+            fromatt, toatt)
+        print('Versioned lookup {}: {} versions'.format(name, versions.size))
+        globals()[name] = VersionedDimension(dimension, versions,
+                                             'declaratiedatum')
+
+
+def attach_bloom_filter():
+    """Put a Bloom filter in front of the DIM_SUBTRAJECTNUMMER key map."""
+    global DIM_SUBTRAJECTNUMMER
+    DIM_SUBTRAJECTNUMMER = BloomFrontedDimension(
+        DIM_SUBTRAJECTNUMMER,
+        capacity=config.getint('fct_subtraject', 'bloom_capacity',
+                               fallback=20000000),
+        error_rate=bloom_error_rate)
+    DIM_SUBTRAJECTNUMMER.prefill(stn_keys.keys())
+    memory_budget.register('stn_bloom_filter', SizeEstimate(
+        lambda: DIM_SUBTRAJECTNUMMER.filter.nbytes))
+    print('Bloom filter {}: {} members, {:.1f} MB'.format(
+        DIM_SUBTRAJECTNUMMER.name, DIM_SUBTRAJECTNUMMER.filter.members,
+        DIM_SUBTRAJECTNUMMER.filter.nbytes / 1048576.0))
+
+
+# dimensions with instrumented caches, and their statistics per file
+INSTRUMENTED_DIMENSIONS = ['DIM_AFSLUITREDEN', 'DIM_BEHANDELING',
+                           'DIM_BRONBESTAND', 'DIM_DAG', 'DIM_DECLARATIE',
+                           'DIM_DIAGNOSE', 'DIM_LAND', 'DIM_ZORGPRODUCT',
+                           'DIM_ZORGTYPE', 'DIM_ZORGVERLENERSOORT',
+                           'DIM_ZORGVRAAG']
+instrumented = {}
+dimension_stats = None
+if cache_mode != 'off':
+    dimension_stats = DimensionStats(config.get(
+        'dimension_cache', 'stats_path',
+        fallback='/opt/data/wob_zz/dimension_stats.json'))
+
+
+def attach_instrumented_dimensions():
+    """Replace the pygrametl caches by instrumented (bounded) caches.
+
+    Dimensions that are already replaced by shared or versioned lookups
+    are left as they are.
+    """
+    for name in INSTRUMENTED_DIMENSIONS:
+        dimension = globals()[name]
+        if not isinstance(dimension, CachedDimension):
+            continue
+        size = 0
+        if cache_mode == 'bounded':
+            size = dimension_stats.recommended_size(
+                name,
+                headroom=config.getfloat('dimension_cache', 'headroom',
+                                         fallback=1.2),
+                minimum=config.getint('dimension_cache', 'min_size',
+                                      fallback=1000)) or 0
+        instrumented[name] = InstrumentedDimension(
+            Dimension(name=dimension.name, key=dimension.key,
+                      attributes=dimension.attributes,
+                      lookupatts=dimension.lookupatts),
+            size)
+        instrumented[name].prefill(cur)
+        globals()[name] = instrumented[name]
+
+
+def cache_nbytes(dimension):
+    """Estimated memory of the cache of a dimension or its wrapper."""
+    if isinstance(dimension, InstrumentedDimension):
+        return dimension.cache.nbytes()
+    if isinstance(dimension, VersionedDimension):
+        return cache_nbytes(dimension.dimension)
+    # pygrametl keeps lookup values -> key and, for full rows, key -> row
+    # in private dicts of CachedDimension
+    total = 0
+    for name in ['_CachedDimension__vals2key', '_CachedDimension__key2row']:
+        cache = getattr(dimension, name, None)
+        if isinstance(cache, dict):
+            total += sizeof_items(cache)
+    return total
+
+
+def track_caches():
+    """Register dimension caches and bulk buffers with the memory budget.
+
+    They can't be spilled, but they are tracked so the report shows where
+    the memory goes. pygrametl writes the bulk files of BulkFactTable
+    straight to disk; only sorted fact batches and replica batches are
+    buffered in memory. The key map of DIM_SUBTRAJECTNUMMER is spillable
+    and registered where it is created.
+    """
+    memory_budget.register('dimension_caches', SizeEstimate(
+        lambda: sum([cache_nbytes(globals()[name])
+                     for name in INSTRUMENTED_DIMENSIONS])))
+    if sort_key:
+        memory_budget.register('fct_subtraject_batch', FCT_SUBTRAJECT)
+    if replica is not None:
+        memory_budget.register('replica_batches', replica)
+
+
+def attach_dimensions():
+    """Set up the dimension lookups configured for this run."""
+    DIM_SUBTRAJECTNUMMER.prefill(cur)
+    if stn_key_finder is not None:
+        # hash keys must not collide with the stn_ids in the table
+        stn_key_finder.prefill(cur, DIM_SUBTRAJECTNUMMER.name,
+                              DIM_SUBTRAJECTNUMMER.key)
+    if bloom_error_rate:
+        attach_bloom_filter()
+    memory_budget.check()
+    if shared_prefix:
+        attach_dimension_caches(shared_prefix)
+    if historize:
+        attach_versioned_dimensions()
+    if cache_mode != 'off':
+        attach_instrumented_dimensions()
+    track_caches()
+
+
+def source_files():
+    """DOT subtraject files per month, relative to data_path."""
+    files = []
+    for year in range(2012, 2015, 1):
+        for month in range(1, 13, 1):
+            files.append('{}/DIS_RAP_SZG_WOB_STR_700_{}_20140410_1.csv.bz2'
+                        .format(year, (str(year)+str(month).zfill(2))))
+    return files
+
+
+def source_file_row(file):
+    """Lineage attributes of a source file for DIM.BRONBESTAND.
+
+    The month and delivery date are taken from the file name, e.g.
+    DIS_RAP_SZG_WOB_STR_700_201201_20140410_1.csv.bz2
+    """
+    row = {'bbs_bestandsnaam': file, 'bbs_jaar_maand': None,
+           'bbs_leverdatum': None}
+    match = re.search(r'_(\d{6})_(\d{8})_\d+\.csv', file)
+    if match:
+        row['bbs_jaar_maand'] = match.group(1)
+        row['bbs_leverdatum'] = parse_dates(match.group(2)) + ' 00:00:00'
+    return row
+
+
+def cdc_state(file):
+    """Path of the change state of the month of a source file."""
+    return os.path.join(cdc_path, delivery_key(file) + '.pkl')
+
+
+def load_str_dot(file, config, apply_changes=None):
     """Method for loading one subtraject file of WOB ZZ DOT
 
     Main ETL method for WOB ZZ subtrajecten.
     Requires active pygrametl connection as global.
+
+    Arguments:
+    - apply_changes: compare with the previous delivery of this month,
+      defaults to load_mode == 'cdc'
     """
     global connection
     paths = {'data_path': config.get('wob_zz', 'data_path'),
              'staging_path': config.get('wob_zz', 'staging_path')}
-    names_STR = ['datum_aanmaak', 'landcode', 'geslacht',
-                 'verwijzend_specialisme', 'zorgtrajectnummer',
-                 'zorgtrajectnummer_parent', 'begindatum_zorgtraject',
-                 'einddatum_zorgtraject', 'declaratiedatasetnummer',
-                 'subtrajectnummer', 'subtraject_id', 'declaratiecode',
-                 'behandelend_specialisme', 'zorgtypecode', 'zorgvraagcode',
-                 'typerende_diagnose', 'icd10_vertaling_diagnose',
-                 'hoofdtraject_indicatie', 'zorgproductcode',
-                 'dbc_reden_sluiten', 'aanspraak_zvw',
-                 'aanspraak_zvw_toegepast', 'zorgact_met_machtiging',
-                 'oranje_zorgactiviteit', 'zorgactiviteitvertaling_toegepast',
-                 'begindatum_subtraject', 'einddatum_subtraject',
-                 'declaratiedatum', 'dbc_ziekenhuiskosten',
-                 'honorarium_totaal']
-
-    source_file = bz2.open(paths['data_path'] + '/' + file, mode='rt')
-    source = csv.DictReader(source_file, delimiter=';',
-                            quotechar='"', fieldnames=names_STR)
+    if row_format == 'slots':
+        source_file = bz2.open(paths['data_path'] + '/' + file, mode='rb')
+        source = Latin1Reader(source_file, SubtrajectRow)
+    else:
+        source_file = bz2.open(paths['data_path'] + '/' + file, mode='rt')
+        source = csv.DictReader(source_file, delimiter=';',
+                                quotechar='"', fieldnames=names_STR)
 
     starttime = time.localtime()
     start_s = time.time()
     print('{} - Start processing file: {}'.
           format(time.strftime('%H:%M:%S', starttime), file))
 
-    name_mapping = {
-        'afl_afsluitreden_code'         : 'dbc_reden_sluiten',
-        #'beh_dbc_specialisme_code'      : 'behandelend_specialisme',
-        #'beh_dbc_behandeling_code'      : 'behandelcode',
-        'dcl_declaratie_code'           : 'declaratiecode',
-        'dia_dbc_specialisme_code'      : 'behandelend_specialisme',
-        'dia_dbc_diagnose_code'         : 'typerende_diagnose',
-        'geslacht'                      : 'geslacht',
-        'heeft_zorgactiviteit_met_machtiging': 'zorgact_met_machtiging',
-        'heeft_oranje_zorgactiviteit'   : 'oranje_zorgactiviteit',
-        'is_aanspraak_zvw'              : 'aanspraak_zvw',
-        'is_aanspraak_zvw_toegepast'    : 'aanspraak_zvw_toegepast',
-        'is_hoofdtraject'               : 'hoofdtraject_indicatie',
-        'is_zorgactiviteitvertaling_toegepast': 'zorgactiviteitvertaling_toegepast',
-        'lnd_land_code'                 : 'landcode',
-        'stn_subtraject_id'             : 'subtraject_id',
-        'stn_subtrajectnummer'          : 'subtrajectnummer',
-        'stn_zorgtrajectnummer'         : 'zorgtrajectnummer',
-        'stn_zorgtrajectnummer_parent'  : 'zorgtrajectnummer_parent',
-        'zgt_dbc_specialisme_code'      : 'behandelend_specialisme',
-        'zgt_dbc_zorgtype_code'         : 'zorgtypecode',
-        'zgv_dbc_specialisme_code'      : 'behandelend_specialisme',
-        'zgv_dbc_zorgvraag_code'        : 'zorgvraagcode',
-        'zpr_dbc_zorgproduct_code'      : 'zorgproductcode',
-        'fct_omzet_ziekenhuis'          : 'dbc_ziekenhuiskosten',
-        'fct_omzet_honorarium_totaal'   : 'honorarium_totaal',
-
-        }
-
-    for row in source:
-
-        # convert datecolumns to appropriate format
-        row['begindatum_zorgtraject'] = parse_dates(row['begindatum_zorgtraject'])
-        row['einddatum_zorgtraject'] = parse_dates(row['einddatum_zorgtraject'])
-        row['begindatum_subtraject'] = parse_dates(row['begindatum_subtraject'])
-        row['einddatum_subtraject'] = parse_dates(row['einddatum_subtraject'])
-        row['declaratiedatum'] = parse_dates(row['declaratiedatum'])
-
-        # ensure DBC codes are filled to right length
-        row['verwijzend_specialisme'] = \
-            parse_codes(row['verwijzend_specialisme'], 4, '_?_')
-        row['behandelend_specialisme'] = \
-            parse_codes(row['behandelend_specialisme'], 4, '_?_')
-        row['zorgtypecode'] = parse_codes(row['zorgtypecode'], 2, '??')
-        row['zorgvraagcode'] = parse_codes(row['zorgvraagcode'], 4, '_?_')
-        row['typerende_diagnose'] = parse_codes(row['typerende_diagnose'], 4, '_?_')
-        row['zorgproductcode'] = parse_codes(row['zorgproductcode'], 9, '_?_')
-
-        # convert geslacht into int conform COD046_NEN / Vektis
-        row['geslacht'] = etl.getint(row['geslacht'], default=0)
-
-        # convert booleans
-        row['hoofdtraject_indicatie'] = parse_boolean(row['hoofdtraject_indicatie'])
-        row['aanspraak_zvw'] = parse_boolean(row['aanspraak_zvw'])
-        row['aanspraak_zvw_toegepast'] = parse_boolean(row['aanspraak_zvw_toegepast'])
-        row['oranje_zorgactiviteit'] = parse_boolean(row['oranje_zorgactiviteit'])
-        row['zorgact_met_machtiging'] = parse_boolean(row['zorgact_met_machtiging'])
-        row['zorgactiviteitvertaling_toegepast'] = parse_boolean(row['zorgactiviteitvertaling_toegepast'])
-
-        # convert money values into decimals
-        row['dbc_ziekenhuiskosten'] = parse_money(row['dbc_ziekenhuiskosten'])
-        row['honorarium_totaal'] = parse_money(row['honorarium_totaal'])
-
-        # derive dimension_ids
-        row['beh_id'] = -1 # no behandelcodes in DOT per 2012-01-01
-        row['dag_id_begindatum_zorgtraject'] = DIM_DAG.lookup(row, {'dag_datum': 'begindatum_zorgtraject'})
-        row['dag_id_einddatum_zorgtraject'] = DIM_DAG.lookup(row, {'dag_datum': 'einddatum_zorgtraject'})
-        row['dag_id_begindatum_subtraject'] = DIM_DAG.lookup(row, {'dag_datum': 'begindatum_subtraject'})
-        row['dag_id_einddatum_subtraject'] = DIM_DAG.lookup(row, {'dag_datum': 'einddatum_subtraject'})
-        row['dag_id_declaratiedatum'] = DIM_DAG.lookup(row, {'dag_datum': 'declaratiedatum'})
-        row['dia_id'] = DIM_DIAGNOSE.ensure(row, name_mapping)
-        row['stn_id'] = DIM_SUBTRAJECTNUMMER.ensure(row, name_mapping)
-        row['zgt_id'] = DIM_ZORGTYPE.ensure(row, name_mapping)
-        row['zgv_id'] = DIM_ZORGVRAAG.ensure(row, name_mapping)
-        row['zpr_id'] = DIM_ZORGPRODUCT.ensure(row, name_mapping)
-        row['zvs_id_behandelend'] = \
-            DIM_ZORGVERLENERSOORT.ensure(row, {'zvs_vektis_zorgverlenersoort_code': 'behandelend_specialisme'})
-        row['zvs_id_verwijzend'] = \
-            DIM_ZORGVERLENERSOORT.ensure(row, {'zvs_vektis_zorgverlenersoort_code': 'verwijzend_specialisme'})
-
-        # insert fact table
-        FCT_SUBTRAJECT.insert(row, name_mapping)
-
+    transform = plan_STR.transform
+
+    # lineage: every fact row refers to its source file
+    bronbestand = source_file_row(file)
+    bbs_id = DIM_BRONBESTAND.ensure(bronbestand)
+    rows = 0
+
+    # state of the previous delivery of this month; after a full reload
+    # the state is rebuilt from scratch
+    if apply_changes is None:
+        apply_changes = (load_mode == 'cdc')
+    cdc = None
+    changed_members = []
+    if cdc_path:
+        if apply_changes and not os.path.exists(cdc_state(file)):
+            raise ValueError('no change state of {} in {}, reload the month '
+                             'first'.format(file, cdc_path))
+        cdc = ChangeCapture(cdc_state(file),
+                            names_STR, previous=apply_changes,
+                            tempdir=spill_path)
+        for name, cache in cdc.caches().items():
+            memory_budget.register(name, cache)
+
+    # facts and subtrajectnummers of this month for the replica; after
+    # applying changes the month is copied from the warehouse instead
+    write_replica = (replica is not None and not apply_changes and
+                     bronbestand['bbs_jaar_maand'] is not None)
+    if write_replica:
+        replica.begin(bronbestand['bbs_jaar_maand'])
+
+    audit = None
+    if config.getboolean('audit', 'enabled', fallback=False):
+        max_new = audit_threshold('max_new_members')
+        audit = FileAudit(AUDIT_CHECKS,
+                          max_unknown=audit_threshold('max_unknown_share'),
+                          max_new=None if max_new is None else int(max_new),
+                          max_missing=audit_threshold('max_missing'),
+                          top=config.getint('audit', 'top', fallback=5))
+        audit.begin(cur)
+
+    profile = None
+    if profile_path:
+        profile = SourceProfile(profile_columns(profile_names))
+
+    profiler = None
+    if sampling:
+        profiler = SamplingProfiler(
+            interval=config.getfloat('fct_subtraject', 'sampling_interval',
+                                     fallback=0.005),
+            max_rows=config.getint('fct_subtraject', 'sampling_rows',
+                                   fallback=500000),
+            max_seconds=config.getfloat('fct_subtraject', 'sampling_seconds',
+                                        fallback=0))
+        profiler.start()
+
+    # the profiling timer and signal handler are reset even when a row fails
+    try:
+        for row in source:
+            rows += 1
+            if rows % 10000 == 0:
+                memory_budget.check()
+            if profiler is not None and profiler.active:
+                profiler.row()
+            if profile is not None:
+                profile.add(row)
+
+            # skip subtrajecten that are unchanged since the previous delivery
+            if cdc is not None:
+                status, stn_id = cdc.classify(row)
+                if status == UNCHANGED:
+                    continue
+
+            # cleanse source columns and fill dimension and measure names
+            transform(row)
+            if pack_vlaggen:
+                row['vlaggen'] = pack_flags([row[flag] for flag in FLAGS])
+
+            # derive dimension_ids
+            row['bbs_id'] = bbs_id
+            row['beh_id'] = -1 # no behandelcodes in DOT per 2012-01-01
+            row['dag_id_begindatum_zorgtraject'] = DIM_DAG.lookup(row, {'dag_datum': 'begindatum_zorgtraject'})
+            row['dag_id_einddatum_zorgtraject'] = DIM_DAG.lookup(row, {'dag_datum': 'einddatum_zorgtraject'})
+            row['dag_id_begindatum_subtraject'] = DIM_DAG.lookup(row, {'dag_datum': 'begindatum_subtraject'})
+            row['dag_id_einddatum_subtraject'] = DIM_DAG.lookup(row, {'dag_datum': 'einddatum_subtraject'})
+            row['dag_id_declaratiedatum'] = DIM_DAG.lookup(row, {'dag_datum': 'declaratiedatum'})
+            row['dia_id'] = DIM_DIAGNOSE.ensure(row)
+            if cdc is not None and status == CHANGED:
+                # changed subtrajecten keep their stn_id, with new attributes
+                row['stn_id'] = stn_id
+                changed_members.append((row['stn_subtrajectnummer'],
+                                        row['stn_zorgtrajectnummer'],
+                                        row['stn_zorgtrajectnummer_parent'],
+                                        stn_id))
+            else:
+                row['stn_id'] = DIM_SUBTRAJECTNUMMER.ensure(row)
+            row['zgt_id'] = DIM_ZORGTYPE.ensure(row)
+            row['zgv_id'] = DIM_ZORGVRAAG.ensure(row)
+            row['zpr_id'] = DIM_ZORGPRODUCT.ensure(row)
+            row['zvs_id_behandelend'] = \
+                DIM_ZORGVERLENERSOORT.ensure(row, {'zvs_vektis_zorgverlenersoort_code': 'behandelend_specialisme'})
+            row['zvs_id_verwijzend'] = \
+                DIM_ZORGVERLENERSOORT.ensure(row, {'zvs_vektis_zorgverlenersoort_code': 'verwijzend_specialisme'})
+
+            # insert fact table, flush when the adaptive batch is full
+            FCT_SUBTRAJECT.insert(row)
+            if cdc is not None:
+                cdc.record(row, row['stn_id'])
+            if aggregates is not None and not apply_changes:
+                aggregates.add(row)
+            if audit is not None:
+                audit.add(row)
+            if write_replica:
+                replica.add('FCT.SUBTRAJECT', row)
+                replica.add('DIM.SUBTRAJECTNUMMER', row)
+            if bulk_policy.rowadded():
+                # old versions of changed rows go before the new ones are loaded
+                if cdc is not None:
+                    delete_facts(cdc.pending_deletes())
+                    update_members(changed_members)
+                    changed_members = []
+                FCT_SUBTRAJECT._bulkloadnow()
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+    if cdc is not None:
+        cdc.finish()
+        delete_facts(cdc.pending_deletes())
+        update_members(changed_members)
+
+    cur.execute("update DIM.BRONBESTAND set bbs_aantal_rijen = %d, "
+                "bbs_geladen_op = getdate() where bbs_id = %d", (rows, bbs_id))
+    # the native fact table is not flushed by pygrametl on commit
+    FCT_SUBTRAJECT._bulkloadnow()
     connection.commit()
+    if audit is not None:
+        audit.finish(cur)
+    if cdc is not None:
+        cdc.save()
+        cdc.close()
+        for name in cdc.caches():
+            memory_budget.unregister(name)
+
+    # cubes of this month, from the facts when only changes were loaded
+    if aggregates is not None and bronbestand['bbs_jaar_maand']:
+        if apply_changes:
+            aggregates.refresh_from_table(cur, bronbestand['bbs_jaar_maand'])
+        else:
+            aggregates.finish(bronbestand['bbs_jaar_maand'])
+
+    # the replica follows the warehouse once the month is committed
+    if replica is not None and bronbestand['bbs_jaar_maand']:
+        if write_replica:
+            replica.finish()
+        else:
+            replica.refresh_month(cur, bronbestand['bbs_jaar_maand'])
+        replica.copy_dimensions(cur)
 
     end_s = time.time()
     endtime = time.localtime()
     print('{} - Finished processing {}'.
           format(time.strftime('%H:%M:%S', endtime), file))
     print('           Processing time: %0.2f seconds ' % (end_s - start_s))
+    print('           Bulk load: ' + bulk_policy.report())
+    if cdc is not None:
+        print('           Changes: ' + cdc.report())
+    print('           Memory: ' + memory_budget.report())
+    if isinstance(DIM_SUBTRAJECTNUMMER, BloomFrontedDimension):
+        print('           Subtrajectnummers: ' + DIM_SUBTRAJECTNUMMER.report())
+        DIM_SUBTRAJECTNUMMER.reset()
+    if profiler is not None:
+        report = profiler.write(
+            config.get('fct_subtraject', 'sampling_path',
+                       fallback='/opt/data/wob_zz/profiling'),
+            os.path.basename(file).split('.')[0])
+        print('           Sampled {} rows: {}'.format(profiler.rows,
+                                                      profiler.summary()))
+        print('           Sampling reports: ' + report + '.*')
+    if profile is not None:
+        profile.save(os.path.join(
+            profile_path, os.path.basename(file).split('.')[0] + '.json'))
+        for line in profile.report():
+            print('           Profile ' + line)
+    if instrumented:
+        for name in sorted(instrumented):
+            print('           Cache {}: {}'.format(
+                name, instrumented[name].report()))
+        dimension_stats.add(file, instrumented)
+        dimension_stats.save()
+        for dimension in instrumented.values():
+            dimension.reset()
+    # the file is committed; a failed audit stops the load of further files
+    if audit is not None:
+        for line in audit.report():
+            print('           Audit ' + line)
+        audit.check()
 
 
 def main():
     """ Main routine for loading WOB ZZ subtrajecten."""
     global cnx, cur
 
-    # trunctate FCT.SUBTRAJECT
-    cur.execute("truncate table FCT.SUBTRAJECT")
-    cnx.commit()
+    # months without change state (e.g. after a full load without
+    # cdc_path) can't be compared, they are reloaded instead
+    reloads = []
+    if load_mode == 'cdc':
+        if not cdc_path:
+            raise ValueError('load_mode cdc requires cdc_path in config')
+        reloads = [file for file in source_files()
+                   if not os.path.exists(cdc_state(file))]
+        for file in reloads:
+            print('No change state of {}, the month is reloaded'.format(file))
+
+    attach_dimensions()
+
+    # trunctate FCT.SUBTRAJECT, unless only changes are applied
+    if load_mode != 'cdc':
+        cur.execute("truncate table FCT.SUBTRAJECT")
+        cnx.commit()
 
     # loop to load per file: DOT
-    files = []
-    for year in range(2012, 2015, 1):
-        for month in range(1, 13, 1):
-            files.append('{}/DIS_RAP_SZG_WOB_STR_700_{}_20140410_1.csv.bz2'
-                        .format(year, (str(year)+str(month).zfill(2))))
+    for file in source_files():
+        if file in reloads:
+            delete_month(source_file_row(file)['bbs_jaar_maand'])
+            load_str_dot(file, config, apply_changes=False)
+        else:
+            load_str_dot(file, config)
+
+    pool.release(cnx)
+
+
+def delete_month(yearmonth, rows_per_delete=500000):
+    """Delete the facts of one month (YYYYMM).
 
+    Fact rows are found by their source file in DIM.BRONBESTAND and are
+    deleted in slices, committing each slice to keep the transaction log
+    small. The subtrajectnummers of the month are kept: they are in the
+    key map of DIM_SUBTRAJECTNUMMER, so a reload refers to the same stn_ids
+    instead of inserting them again.
+    """
+    global cnx, cur
+
+    cur.execute("select bbs_id from DIM.BRONBESTAND where bbs_jaar_maand = %s",
+                (yearmonth,))
+    for (bbs_id,) in cur.fetchall():
+        print('Deleting facts of {} from source file {}'.format(yearmonth, bbs_id))
+        while True:
+            cur.execute("delete top ({}) from FCT.SUBTRAJECT "
+                        "where bbs_id = %d".format(rows_per_delete), (bbs_id,))
+            deleted = cur.rowcount
+            cnx.commit()
+            print("    number of rows affected: {}".format(deleted))
+            if deleted < rows_per_delete:
+                break
+
+
+def reload_month(yearmonth, rows_per_delete=500000):
+    """Delete the facts of one month (YYYYMM) and reload its source file."""
+    global cnx
+
+    files = [file for file in source_files()
+             if source_file_row(file)['bbs_jaar_maand'] == yearmonth]
+    if not files:
+        raise ValueError('no source file for month {}'.format(yearmonth))
+
+    attach_dimensions()
+    delete_month(yearmonth, rows_per_delete)
     for file in files:
-            load_str_dot(file, config)
+        load_str_dot(file, config, apply_changes=False)
 
-    cnx.close()
+    pool.release(cnx)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # publish / unpublish shared dimension lookups for worker processes
+    if len(sys.argv) > 1 and sys.argv[1] == 'publish':
+        publish_dimension_caches(shared_prefix)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'unpublish':
+        unpublish_dimension_caches(shared_prefix)
+    # reload one month, e.g. load_fct_subtraject.py reload 201203
+    elif len(sys.argv) > 2 and sys.argv[1] == 'reload':
+        reload_month(sys.argv[2])
+    # reload one month with the sampling profiler switched on
+    elif len(sys.argv) > 2 and sys.argv[1] == 'profile':
+        sampling = True
+        reload_month(sys.argv[2])
+    else:
+        main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+""" Script to aggregate fact-subtraject to zorgtraject level.
+
+FCT.ZORGTRAJECT has one row per zorgtrajectnummer with the number of
+subtrajecten, total revenue and first begin / last end date of its
+subtrajecten. The subtrajecten of a zorgtraject are spread over several
+monthly files, so the aggregate is built over all of FCT.SUBTRAJECT:
+rows are streamed from the database, spilled into sorted runs on local
+disk keyed by zorgtrajectnummer (see external_sort) and k-way merged, so
+each zorgtraject is aggregated from consecutive rows in bounded memory.
+
+The parent chain via zorgtrajectnummer_parent is resolved afterwards
+with a recursive query on FCT.ZORGTRAJECT, which sets the root of the
+chain and the depth of each zorgtraject in it.
+
+NB: dates are aggregated on dag_id, which increases with dag_datum for
+real dates; negative ids (unknown, open) are only used if a zorgtraject
+has no real date at all.
+"""
+
+import configparser
+import time
+from itertools import groupby
+from operator import itemgetter
+import pygrametl as etl
+from pygrametl.tables import BulkFactTable
+from wob_zz.external_sort import ExternalSorter
+from wob_zz.replica import Replica
+from wob_zz.create_tables import table_columns
+from wob_zz.connections import get_pool
+from wob_zz.bulkloader import mssql_bulkloader
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+
+# setup config; the connection is opened in main(), so importing this
+# module does not connect or change pygrametl's default connection
+config = configparser.ConfigParser()
+config.read('/opt/projects/wob_zz/config.ini')
+
+
+def zorgtraject_table(cursor):
+    """Bulk fact table of FCT.ZORGTRAJECT, loaded with cursor."""
+    return BulkFactTable(
+        name='FCT.ZORGTRAJECT',
+        keyrefs=['ztr_zorgtrajectnummer', 'ztr_zorgtrajectnummer_parent',
+                 'ztr_zorgtrajectnummer_root', 'ztr_ketendiepte',
+                 'dag_id_eerste_begindatum_subtraject',
+                 'dag_id_laatste_einddatum_subtraject'],
+        measures=['fct_aantal_subtrajecten', 'fct_omzet_ziekenhuis',
+                  'fct_omzet_honorarium_totaal'],
+        nullsubst='',
+        fieldsep='\t',
+        rowsep='\r\n',
+        usefilename=True,
+        bulksize=config.getint('fct_zorgtraject', 'bulksize', fallback=500000),
+        bulkloader=mssql_bulkloader(cursor)
+    )
+
+
+# subtraject rows in the order of the sort records
+SOURCE_QUERY = '''
+    select s.stn_zorgtrajectnummer, s.stn_zorgtrajectnummer_parent,
+           f.dag_id_begindatum_subtraject, f.dag_id_einddatum_subtraject,
+           f.fct_omzet_ziekenhuis, f.fct_omzet_honorarium_totaal
+    from FCT.SUBTRAJECT f
+    join DIM.SUBTRAJECTNUMMER s on f.stn_id = s.stn_id
+    '''
+
+# root and depth of every zorgtraject in its parent chain; chains start
+# at zorgtrajecten without a (known) parent, so cycles are never entered
+CHAIN_UPDATE = '''
+    with chain (ztr_zorgtrajectnummer, root, depth) as (
+        select z.ztr_zorgtrajectnummer, z.ztr_zorgtrajectnummer, 0
+        from FCT.ZORGTRAJECT z
+        where not exists (select 1 from FCT.ZORGTRAJECT p
+                          where p.ztr_zorgtrajectnummer =
+                                z.ztr_zorgtrajectnummer_parent)
+        union all
+        select z.ztr_zorgtrajectnummer, c.root, c.depth + 1
+        from FCT.ZORGTRAJECT z
+        join chain c on z.ztr_zorgtrajectnummer_parent = c.ztr_zorgtrajectnummer
+    )
+    update z set ztr_zorgtrajectnummer_root = c.root,
+                 ztr_ketendiepte = c.depth
+    from FCT.ZORGTRAJECT z
+    join chain c on z.ztr_zorgtrajectnummer = c.ztr_zorgtrajectnummer
+    option (maxrecursion 0)
+    '''
+
+
+def source_records(cursor, arraysize=10000):
+    """Subtraject rows as tuples, zorgtrajectnummer first."""
+    cursor.execute(SOURCE_QUERY)
+    while True:
+        rows = cursor.fetchmany(arraysize)
+        if not rows:
+            return
+        for row in rows:
+            yield (row[0] or '',) + tuple(row[1:])
+
+
+def aggregate_zorgtrajecten(records):
+    """One fact row per zorgtrajectnummer from records sorted on it."""
+    for zorgtrajectnummer, group in groupby(records, key=itemgetter(0)):
+        parent = None
+        begins, ends = [], []
+        count = 0
+        omzet_ziekenhuis = omzet_honorarium = None
+        for record in group:
+            count += 1
+            parent = parent or record[1] or None
+            if record[2] is not None:
+                begins.append(record[2])
+            if record[3] is not None:
+                ends.append(record[3])
+            if record[4] is not None:
+                omzet_ziekenhuis = (omzet_ziekenhuis or 0) + record[4]
+            if record[5] is not None:
+                omzet_honorarium = (omzet_honorarium or 0) + record[5]
+        known_begins = [dag_id for dag_id in begins if dag_id > 0]
+        known_ends = [dag_id for dag_id in ends if dag_id > 0]
+        yield {'ztr_zorgtrajectnummer': zorgtrajectnummer,
+               'ztr_zorgtrajectnummer_parent': parent,
+               'ztr_zorgtrajectnummer_root': None,
+               'ztr_ketendiepte': None,
+               'dag_id_eerste_begindatum_subtraject':
+                   min(known_begins or begins or [-4]),
+               'dag_id_laatste_einddatum_subtraject':
+                   max(known_ends) if known_ends else min(ends or [-4]),
+               'fct_aantal_subtrajecten': count,
+               'fct_omzet_ziekenhuis': omzet_ziekenhuis,
+               'fct_omzet_honorarium_totaal': omzet_honorarium}
+
+
+def main():
+    """ Main routine for aggregating WOB ZZ zorgtrajecten."""
+    pool = get_pool(config)
+    cnx = pool.connect()
+    cur = cnx.cursor()
+    connection = etl.ConnectionWrapper(cnx)
+    connection.setasdefault()
+    FCT_ZORGTRAJECT = zorgtraject_table(cur)
+
+    start_s = time.time()
+    sorter = ExternalSorter(
+        key=itemgetter(0),
+        run_size=config.getint('fct_zorgtraject', 'run_size', fallback=1000000),
+        tempdir=config.get('fct_zorgtraject', 'sort_path', fallback=None))
+    try:
+        # spill all subtrajecten into sorted runs before writing, so the
+        # connection is free for the bulk load
+        sorter.extend(source_records(cur))
+        print('Sorted {} subtrajecten in {} runs'.
+              format(sorter.records, sorter.runs))
+
+        cur.execute("truncate table FCT.ZORGTRAJECT")
+        zorgtrajecten = 0
+        skipped = 0
+        for row in aggregate_zorgtrajecten(sorter):
+            if not row['ztr_zorgtrajectnummer']:
+                skipped += row['fct_aantal_subtrajecten']
+                continue
+            FCT_ZORGTRAJECT.insert(row)
+            zorgtrajecten += 1
+        connection.commit()
+    finally:
+        sorter.close()
+
+    print('Resolving parent chains of {} zorgtrajecten'.format(zorgtrajecten))
+    cur.execute(CHAIN_UPDATE)
+    print("    number of rows affected: {}".format(cur.rowcount))
+    cnx.commit()
+    if config.get('replica', 'path', fallback=''):
+        rows = Replica(config.get('replica', 'path'), table_columns(config)).\
+            copy_table(cur, 'FCT.ZORGTRAJECT')
+        print('Copied {} zorgtrajecten to the replica'.format(rows))
+    if skipped:
+        print('Skipped {} subtrajecten without zorgtrajectnummer'.
+              format(skipped))
+    print('Processing time: %0.2f seconds ' % (time.time() - start_s))
+
+    pool.release(cnx)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,53 +12,167 @@ Beware of MS SQL inferno when working from OSX / Python:
 ?? autocommit on for pymssql connection as solution to earlier bugs??
 
 Use latin-1 as encoding standard since SQL Server does not support utf-8
+
+Staged files with extension .dat are in native format (staging_format =
+native), see native_format, and are loaded without parsing.
+
+With dimension_load = merge the staged file is bulk inserted into a
+temporary staging table and merged into the dimension by business key
+(the unique constraint in create_tables), so only changed codes are
+written and the surrogate keys that facts refer to are kept:
+- members whose attributes differ are updated in place
+- new members get keys after the current maximum, in staged order
+- members that are no longer staged are retired by setting their
+  einddatum to the merge date, if the dimension has one; they are never
+  deleted, since facts may refer to them
 """
 
-import pymssql as sql
 import configparser
 import os
+from wob_zz.create_tables import table_columns, table_keys
+from wob_zz.connections import get_pool
 
 __author__ = 'Daniel Kapitan'
 __maintainer__ = 'Daniel Kapitan'
 __version__ = '0.1'
 
+def bulk_insert_statement(source_file, target_table):
+    if source_file.endswith('.dat'):
+        stmt = ('''bulk insert {}
+                   from '{}'
+                   with (datafiletype='native')''').\
+            format(target_table, source_file)
+    else:
+        stmt = ('''bulk insert {}
+                   from '{}'
+                   with (firstrow=2,
+                         fieldterminator=';',
+                         rowterminator='0x0a',
+                         codepage='1252')''').\
+            format(target_table, source_file)
+    return stmt
+
+def execute(cursor, stmt, label=None):
+    if label:
+        print(label)
+    print("    sql> " + ' '.join(stmt.split()))
+    cursor.execute(stmt)
+    print("    number of rows affected: {}".format(cursor.rowcount))
+    return cursor.rowcount
+
 def load_staged_dimension(source_file, target_table, cursor):
     print("Truncating {}:".format(target_table))
     print("    sql> truncate table {}".format(target_table))
     cursor.execute("truncate table {}".format(target_table))
     print("    number of rows affected: {}".format(cursor.rowcount))
-    stmt = ('''bulk insert {}
-               from '{}'
-               with (firstrow=2,
-                     fieldterminator=';',
-                     rowterminator='0x0a',
-                     codepage='1252')''').\
-        format(target_table, source_file)
+    stmt = bulk_insert_statement(source_file, target_table)
     print("Loading {} ...".format(target_table))
     print("    sql> " + stmt)
     cursor.execute(stmt)
     print("    number of rows affected: {}".format(cursor.rowcount))
 
+def merge_staged_dimension(source_file, target_table, cursor, columns, keys):
+    """ Merge a staged file into a dimension by business key.
+
+    Arguments:
+    - columns: (name, data type, nullable) of target_table, in table order
+    - keys: (surrogate key, business key columns) of target_table
+
+    Returns the number of updated, inserted and retired members.
+    """
+    key, business = keys
+    names = [name for name, data_type, nullable in columns]
+    attributes = [name for name in names if name != key and name not in business]
+    einddatum = [name for name, data_type, nullable in columns
+                 if name.endswith('_einddatum') and data_type == 'date']
+
+    execute(cursor, "if object_id('tempdb..#stage') is not null drop table #stage")
+    execute(cursor, "select * into #stage from {} where 1 = 0".format(target_table),
+            "Staging {} ...".format(target_table))
+    execute(cursor, bulk_insert_statement(source_file, '#stage'))
+
+    # the connection is in autocommit, apply the merge as one transaction
+    cursor.execute("begin transaction")
+    try:
+        changes = merge_stage(target_table, cursor, key, business, names,
+                              attributes, einddatum)
+        cursor.execute("commit transaction")
+    except Exception:
+        cursor.execute("rollback transaction")
+        raise
+    execute(cursor, "drop table #stage")
+    return changes
+
+def merge_stage(target_table, cursor, key, business, names, attributes,
+                einddatum):
+    """ Update, insert and retire members of target_table from #stage."""
+    same_member = ' and '.join(['t.{0} = s.{0}'.format(name) for name in business])
+
+    # attributes are compared with except, which treats nulls as equal
+    updated = 0
+    if attributes:
+        updated = execute(cursor, '''
+            update t set {}
+            from {} t join #stage s on {}
+            where exists (select {} except select {})
+            '''.format(', '.join(['{0} = s.{0}'.format(name) for name in attributes]),
+                       target_table, same_member,
+                       ', '.join(['s.' + name for name in attributes]),
+                       ', '.join(['t.' + name for name in attributes])),
+            "Updating changed members of {} ...".format(target_table))
+
+    # unknown members keep their staged (negative) keys, new codes are
+    # numbered after the current maximum in the order of the staged keys
+    inserted = execute(cursor, '''
+        insert into {0} ({1})
+        select {2} from #stage s
+        where s.{3} < 0 and not exists (select 1 from {0} t where t.{3} = s.{3})
+        and not exists (select 1 from {0} t where {4})
+        '''.format(target_table, ', '.join(names),
+                   ', '.join(['s.' + name for name in names]), key, same_member),
+        "Inserting unknown members of {} ...".format(target_table))
+    inserted += execute(cursor, '''
+        insert into {0} ({1})
+        select m.max_key + row_number() over (order by s.{3}), {2}
+        from #stage s
+        cross join (select coalesce(max({3}), 0) as max_key from {0}) m
+        where s.{3} >= 0 and not exists (select 1 from {0} t where {4})
+        '''.format(target_table, ', '.join(names),
+                   ', '.join(['s.' + name for name in names if name != key]),
+                   key, same_member),
+        "Inserting new members of {} ...".format(target_table))
+
+    retired = 0
+    if einddatum:
+        retired = execute(cursor, '''
+            update t set {1} = cast(getdate() as date)
+            from {0} t
+            where t.{2} >= 0
+            and (t.{1} is null or t.{1} > cast(getdate() as date))
+            and not exists (select 1 from #stage s where {3})
+            '''.format(target_table, einddatum[0], key, same_member),
+            "Retiring members of {} ...".format(target_table))
+    return updated, inserted, retired
+
 def main():
     config = configparser.ConfigParser()
     config.read('/opt/projects/wob_zz/config.ini')
-    login = {
-        'user': config.get('local_mssql', 'user'),
-        'password': config.get('local_mssql', 'password'),
-        'server': config.get('local_mssql', 'server'),
-        'port': config.get('local_mssql', 'port'),
-        'database': config.get('wob_zz', 'database')}
-
-    cnx = sql.connect(**login)
+    pool = get_pool(config)
+    cnx = pool.connect()
 
     # turn autocommit on
     cnx.autocommit(True)
     cursor = cnx.cursor()
 
+    # truncate and reload, or merge changes into the current dimensions
+    mode = config.get('wob_zz', 'dimension_load', fallback='truncate')
+    columns = table_columns(config)
+    keys = table_keys(config)
+
     # get all staging file names in staging_path
     staging_path = config.get('wob_zz', 'staging_path')
     csv_files = [fn for fn in os.listdir(staging_path)
-                 if any([fn.endswith(ext) for ext in ['csv']])]
+                 if any([fn.endswith(ext) for ext in ['csv', 'dat']])]
 
     # format staging path for Windows OS with escaped backslashes
     # \\psf is mountpoint for OSX
@@ -66,7 +180,15 @@ def main():
     for file in csv_files:
         table = '.'.join(file.split('.')[0:2])
         windows_source = windows_path + file
-        load_staged_dimension(windows_source, table, cursor)
+        if mode == 'merge' and table in keys:
+            updated, inserted, retired = merge_staged_dimension(
+                windows_source, table, cursor, columns[table], keys[table])
+            print("Merged {}: {} updated, {} inserted, {} retired".
+                  format(table, updated, inserted, retired))
+        else:
+            load_staged_dimension(windows_source, table, cursor)
+
+    pool.release(cnx)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,310 @@
+""" Memory budget with spill-to-disk for the caches of the fact load.
+
+The per-subtraject structures of the loader (change capture state,
+issued hash keys, ...) grow with the number of subtrajecten until the
+OS kills the process. MemoryBudget keeps track of the registered
+structures and of the resident size of the process. When the process
+exceeds the budget, the coldest spillable structures (fewest accesses
+since the previous check) are moved to disk, and the load continues
+more slowly instead of crashing.
+
+SpillableDict is a dict that can move its contents into an embedded
+sqlite3 key-value file. After spilling, new and recently written items
+are kept in memory and the rest is read from disk on demand.
+
+Structures that can't be spilled, e.g. the caches of pygrametl
+dimensions, are registered as SizeEstimate: they count in the report and
+show what else takes the memory. sizeof_items() estimates the size of a
+dict or list from a sample of its items.
+"""
+
+import itertools
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+MB = 1048576.0
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+_MISSING = object()
+
+
+def resident_size():
+    """Resident set size of this process in bytes, None if unknown."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import resource
+        # peak size; kilobytes on Linux, bytes on OSX
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return None
+
+
+def _sizeof(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum([sys.getsizeof(item) for item in value])
+    elif isinstance(value, dict):
+        size += sum([sys.getsizeof(item) for item in value.values()])
+    return size
+
+
+def sizeof_items(items, sample=100):
+    """Estimated bytes of a dict or list with its items, extrapolated
+    from the first sample items; tuples, lists and dicts in it are
+    counted with their elements."""
+    total = sys.getsizeof(items)
+    if not items:
+        return total
+    if isinstance(items, dict):
+        sizes = [_sizeof(key) + _sizeof(value) for key, value
+                 in itertools.islice(items.items(), sample)]
+    else:
+        sizes = [_sizeof(item) for item in itertools.islice(items, sample)]
+    return total + int(sum(sizes) / float(len(sizes)) * len(items))
+
+
+class SizeEstimate(object):
+    """Tracked structure that can't be spilled.
+
+    Arguments:
+    - nbytes: function that returns the estimated bytes in memory
+    """
+
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+
+
+class SpillableDict(object):
+    """Dict that can spill its items to a sqlite3 file.
+
+    Arguments:
+    - items: initial items
+    - tempdir: directory of the spill file, default the system temp dir
+    - entry_size: estimated bytes per item in memory, for nbytes()
+    """
+
+    def __init__(self, items=None, tempdir=None, entry_size=200):
+        self.tempdir = tempdir
+        self.entry_size = entry_size
+        self.accesses = 0
+        self.__memory = dict(items or {})
+        self.__db = None
+        self.__path = None
+        self.__ondisk = 0
+
+    @property
+    def spilled(self):
+        return self.__db is not None
+
+    def nbytes(self):
+        """Estimated memory footprint of the items kept in memory."""
+        return len(self.__memory) * self.entry_size
+
+    def __open(self):
+        if self.tempdir and not os.path.exists(self.tempdir):
+            os.makedirs(self.tempdir)
+        handle, self.__path = tempfile.mkstemp(suffix='.spill',
+                                               dir=self.tempdir)
+        os.close(handle)
+        self.__db = sqlite3.connect(self.__path)
+        self.__db.execute('pragma journal_mode = off')
+        self.__db.execute('pragma synchronous = off')
+        self.__db.execute('create table kv (k blob primary key, v blob)')
+
+    def spill(self):
+        """Move all items in memory to disk, return the estimated bytes freed."""
+        if not self.__memory:
+            return 0
+        freed = self.nbytes()
+        if self.__db is None:
+            self.__open()
+        self.__db.executemany(
+            'insert or replace into kv values (?, ?)',
+            [(pickle.dumps(key, PROTOCOL), pickle.dumps(value, PROTOCOL))
+             for key, value in self.__memory.items()])
+        self.__db.commit()
+        self.__ondisk = self.__db.execute('select count(*) from kv').\
+            fetchone()[0]
+        self.__memory = {}
+        return freed
+
+    def __disk_get(self, key):
+        row = self.__db.execute('select v from kv where k = ?',
+                                (pickle.dumps(key, PROTOCOL),)).fetchone()
+        return _MISSING if row is None else pickle.loads(row[0])
+
+    def __disk_has(self, key):
+        return self.__db.execute('select 1 from kv where k = ?',
+                                 (pickle.dumps(key, PROTOCOL),)).\
+            fetchone() is not None
+
+    def __disk_delete(self, key):
+        cursor = self.__db.execute('delete from kv where k = ?',
+                                   (pickle.dumps(key, PROTOCOL),))
+        self.__ondisk -= cursor.rowcount
+
+    def get(self, key, default=None):
+        self.accesses += 1
+        value = self.__memory.get(key, _MISSING)
+        if value is _MISSING and self.__db is not None:
+            value = self.__disk_get(key)
+        return default if value is _MISSING else value
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __setitem__(self, key, value):
+        self.accesses += 1
+        if self.__db is not None and key not in self.__memory and \
+                self.__disk_has(key):
+            # keep a single copy: the new value lives in memory
+            self.__disk_delete(key)
+        self.__memory[key] = value
+
+    def pop(self, key, default=None):
+        self.accesses += 1
+        if key in self.__memory:
+            return self.__memory.pop(key)
+        if self.__db is None:
+            return default
+        value = self.__disk_get(key)
+        if value is _MISSING:
+            return default
+        self.__disk_delete(key)
+        return value
+
+    def update(self, items):
+        for key, value in items.items():
+            self[key] = value
+
+    def __len__(self):
+        return len(self.__memory) + self.__ondisk
+
+    def items(self):
+        for item in self.__memory.items():
+            yield item
+        if self.__db is not None:
+            for key, value in self.__db.execute('select k, v from kv'):
+                yield pickle.loads(key), pickle.loads(value)
+
+    def keys(self):
+        for key, value in self.items():
+            yield key
+
+    def values(self):
+        for key, value in self.items():
+            yield value
+
+    def close(self):
+        """Remove the spill file."""
+        self.__memory = {}
+        if self.__db is not None:
+            self.__db.close()
+            os.remove(self.__path)
+            self.__db = None
+            self.__ondisk = 0
+
+
+class MemoryBudget(object):
+    """Track registered structures and spill the coldest over budget.
+
+    Arguments:
+    - budget: maximum resident size of the process in bytes, 0 for no
+      limit (tracking and reporting only)
+
+    Structures have nbytes() and optionally spill() (e.g. SpillableDict)
+    and an accesses counter used to find the coldest one.
+    """
+
+    def __init__(self, budget=0):
+        self.budget = budget
+        self.structures = {}
+        self.spills = 0
+        self.peak = 0
+        self.__accesses = {}
+        self.__spilled_at = 0
+
+    def register(self, name, structure):
+        self.structures[name] = structure
+        self.__accesses[name] = getattr(structure, 'accesses', 0)
+
+    def unregister(self, name):
+        self.structures.pop(name, None)
+        self.__accesses.pop(name, None)
+
+    def usage(self):
+        """Resident size, or the tracked size if the former is unknown."""
+        rss = resident_size()
+        if rss is None:
+            rss = sum([structure.nbytes() for structure
+                       in self.structures.values()])
+        self.peak = max(self.peak, rss)
+        return rss
+
+    def check(self):
+        """Spill the coldest structures while usage exceeds the budget.
+
+        Freed memory is reused by Python rather than returned to the OS,
+        so after a spill the process only counts as over budget again
+        once it grows beyond the size at that spill.
+        """
+        if not self.budget:
+            return
+        usage = self.usage()
+        excess = usage - max(self.budget, self.__spilled_at)
+        if excess <= 0:
+            self.__reset_accesses()
+            return
+        self.__spilled_at = usage
+        excess = usage - self.budget
+        # coldest first: fewest accesses since the previous check
+        candidates = sorted(
+            [(getattr(structure, 'accesses', 0) - self.__accesses[name], name)
+             for name, structure in self.structures.items()
+             if hasattr(structure, 'spill') and structure.nbytes() > 0])
+        for accesses, name in candidates:
+            freed = self.structures[name].spill()
+            self.spills += 1
+            print('    memory: spilled {} ({:.0f} MB) to disk, {:.0f} MB over '
+                  'budget'.format(name, freed / MB, excess / MB))
+            excess -= freed
+            if excess <= 0:
+                break
+        self.__reset_accesses()
+
+    def __reset_accesses(self):
+        for name, structure in self.structures.items():
+            self.__accesses[name] = getattr(structure, 'accesses', 0)
+
+    def report(self):
+        usage = self.usage()
+        parts = ['{:.0f} MB'.format(usage / MB)]
+        if self.budget:
+            parts[0] += ' of {:.0f} MB budget ({:.0%})'.format(
+                self.budget / MB, usage / float(self.budget))
+        parts.append('peak {:.0f} MB'.format(self.peak / MB))
+        for name in sorted(self.structures):
+            structure = self.structures[name]
+            parts.append('{} {:.1f} MB{}'.format(
+                name, structure.nbytes() / MB,
+                ' (spilled)' if getattr(structure, 'spilled', False) else ''))
+        if self.spills:
+            parts.append('{} spills'.format(self.spills))
+        return ', '.join(parts)
@@ -0,0 +1,336 @@
+""" Typed binary bulk files in the style of the bcp native format.
+
+Text bulk files have to be parsed field by field by SQL Server, and
+since MS SQL can't deal with text delimiters, a ';' or tab in a field
+silently shifts all following columns. Native files store each value
+in its binary representation with a length prefix, so there is nothing
+to parse and no delimiter that can collide.
+
+Encoding per column, based on the column definitions in create_tables:
+- tinyint, smallint, int, bigint, bit: little-endian integer; nullable
+  columns get a 1 byte length prefix, 0xFF for NULL
+- datetime: days since 1900-01-01 and 1/300 seconds since midnight
+  (2 x int32), prefixed like the integers
+- date: 1 byte prefix (3, 0xFF for NULL), days since 0001-01-01 (3 bytes)
+- decimal(p,s): 1 byte prefix (19, 0xFF for NULL), precision, scale,
+  sign (1 = positive) and the unscaled value as 16 byte integer
+- nvarchar: 2 byte prefix with the length in bytes (0xFFFF for NULL),
+  UTF-16LE; varchar: the same with single byte encoding
+
+For numbers, dates and bits both None and '' are written as NULL, for
+strings only None. Files are loaded with bulk insert ... with
+(datafiletype='native'); NativeReader reads them back for round-trip
+tests.
+
+NB: experimental. The layout follows the documentation of bcp's native
+format without format file, but has not been compared byte for byte with
+a file exported with 'bcp ... out -n'; do that (e.g. for a small table
+with every column type and NULLs) before using it for production loads.
+"""
+
+import datetime
+import os
+import re
+import struct
+import tempfile
+from decimal import Decimal, ROUND_HALF_UP
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+INTEGERS = {'tinyint': struct.Struct('<B'), 'smallint': struct.Struct('<h'),
+            'int': struct.Struct('<i'), 'bigint': struct.Struct('<q'),
+            'bit': struct.Struct('<B')}
+DATETIME = struct.Struct('<ii')
+NULL1 = b'\xff'
+NULL2 = b'\xff\xff'
+DATE_BASE = datetime.date(1, 1, 1).toordinal()
+DATETIME_BASE = datetime.date(1900, 1, 1).toordinal()
+
+
+def _split_type(data_type):
+    """'decimal(9,2)' -> ('decimal', [9, 2])"""
+    match = re.match(r'(\w+)(?:\((\d+)(?:,(\d+))?\))?', data_type)
+    args = [int(arg) for arg in match.groups()[1:] if arg is not None]
+    return match.group(1).lower(), args
+
+
+def _isnull(value):
+    return value is None or value == ''
+
+
+def _toint(value):
+    if isinstance(value, str):
+        if value.lower() in ('true', 'false'):
+            return int(value.lower() == 'true')
+        return int(float(value)) if '.' in value else int(value)
+    return int(value)
+
+
+def _todate(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    value = str(value)
+    return datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+
+
+def _todatetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    value = str(value)
+    return datetime.datetime(int(value[0:4]), int(value[5:7]),
+                             int(value[8:10]), int(value[11:13] or 0),
+                             int(value[14:16] or 0), int(value[17:19] or 0))
+
+
+def _encoder(data_type, nullable, encoding):
+    """Function that converts a value into its native bytes."""
+    name, args = _split_type(data_type)
+
+    if name in INTEGERS:
+        pack = INTEGERS[name].pack
+        if not nullable:
+            return lambda value: pack(_toint(value))
+        prefix = bytes([INTEGERS[name].size])
+        return lambda value: NULL1 if _isnull(value) \
+            else prefix + pack(_toint(value))
+
+    if name == 'datetime':
+        def encode(value):
+            if _isnull(value):
+                return NULL1
+            value = _todatetime(value)
+            days = value.toordinal() - DATETIME_BASE
+            ticks = (value.hour * 3600 + value.minute * 60 + value.second) \
+                * 300 + int(round(value.microsecond * 0.0003))
+            return b'\x08' + DATETIME.pack(days, ticks)
+        return encode
+
+    if name == 'date':
+        return lambda value: NULL1 if _isnull(value) else \
+            b'\x03' + (_todate(value).toordinal() - DATE_BASE).\
+            to_bytes(3, 'little')
+
+    if name in ('decimal', 'numeric'):
+        precision, scale = (args + [18, 0])[0:2] if args else (18, 0)
+        exponent = Decimal(1).scaleb(-scale)
+
+        def encode(value):
+            if _isnull(value):
+                return NULL1
+            unscaled = int(Decimal(str(value)).quantize(
+                exponent, ROUND_HALF_UP).scaleb(scale))
+            return bytes([19, precision, scale, 1 if unscaled >= 0 else 0]) \
+                + abs(unscaled).to_bytes(16, 'little')
+        return encode
+
+    if name in ('nvarchar', 'nchar', 'varchar', 'char'):
+        codec = 'utf-16-le' if name.startswith('n') else encoding
+
+        def encode(value):
+            if value is None:
+                return NULL2
+            data = str(value).encode(codec)
+            return struct.pack('<H', len(data)) + data
+        return encode
+
+    raise ValueError('no native encoding for data type {}'.format(data_type))
+
+
+def _decoder(data_type, nullable, encoding):
+    """Function that reads one value of a column from a binary file."""
+    name, args = _split_type(data_type)
+
+    if name in INTEGERS:
+        unpack, size = INTEGERS[name].unpack, INTEGERS[name].size
+        if not nullable:
+            return lambda file: unpack(file.read(size))[0]
+
+        def decode(file):
+            if file.read(1) == NULL1:
+                return None
+            return unpack(file.read(size))[0]
+        return decode
+
+    if name == 'datetime':
+        def decode(file):
+            if file.read(1) == NULL1:
+                return None
+            days, ticks = DATETIME.unpack(file.read(8))
+            value = datetime.datetime.fromordinal(days + DATETIME_BASE)
+            return value + datetime.timedelta(seconds=ticks / 300.0)
+        return decode
+
+    if name == 'date':
+        def decode(file):
+            if file.read(1) == NULL1:
+                return None
+            days = int.from_bytes(file.read(3), 'little')
+            return datetime.date.fromordinal(days + DATE_BASE)
+        return decode
+
+    if name in ('decimal', 'numeric'):
+        def decode(file):
+            if file.read(1) == NULL1:
+                return None
+            data = file.read(19)
+            scale, sign = data[1], data[2]
+            unscaled = int.from_bytes(data[3:], 'little')
+            return Decimal(unscaled if sign else -unscaled).scaleb(-scale)
+        return decode
+
+    if name in ('nvarchar', 'nchar', 'varchar', 'char'):
+        codec = 'utf-16-le' if name.startswith('n') else encoding
+
+        def decode(file):
+            prefix = file.read(2)
+            if prefix == NULL2:
+                return None
+            return file.read(struct.unpack('<H', prefix)[0]).decode(codec)
+        return decode
+
+    raise ValueError('no native encoding for data type {}'.format(data_type))
+
+
+class NativeWriter(object):
+    """Write rows as typed binary records.
+
+    Arguments:
+    - fileobj: file opened in binary mode
+    - columns: (name, data type, nullable) per column in table order,
+      e.g. create_tables.table_columns(config)['FCT.SUBTRAJECT']
+    - encoding: codepage for varchar/char columns
+    """
+
+    def __init__(self, fileobj, columns, encoding='cp1252'):
+        self.fileobj = fileobj
+        self.names = [name for name, data_type, nullable in columns]
+        self.__encoders = [_encoder(data_type, nullable, encoding)
+                           for name, data_type, nullable in columns]
+        self.rows = 0
+
+    def writerow(self, values):
+        """Write a sequence of values in column order."""
+        self.fileobj.write(b''.join([encode(value) for encode, value
+                                     in zip(self.__encoders, values)]))
+        self.rows += 1
+
+    def writedict(self, row, namemapping={}):
+        """Write a dict-like row with values under the column names."""
+        self.writerow([row[namemapping.get(name) or name]
+                       for name in self.names])
+
+
+class NativeReader(object):
+    """Iterate over the rows of a native file as tuples."""
+
+    def __init__(self, fileobj, columns, encoding='cp1252'):
+        self.fileobj = fileobj
+        self.names = [name for name, data_type, nullable in columns]
+        self.__decoders = [_decoder(data_type, nullable, encoding)
+                           for name, data_type, nullable in columns]
+
+    def __iter__(self):
+        fileobj, decoders = self.fileobj, self.__decoders
+        size = os.fstat(fileobj.fileno()).st_size
+        while fileobj.tell() < size:
+            yield tuple([decode(fileobj) for decode in decoders])
+
+
+def write_dataframe(data, path, columns, encoding='cp1252', na_rep=None):
+    """Write a pandas DataFrame with the table's columns as native file.
+
+    NaN values are written as NULL, or as na_rep in string columns.
+    """
+    strings = [data_type.startswith(('varchar', 'nvarchar', 'char', 'nchar'))
+               for name, data_type, nullable in columns]
+    with open(path, 'wb') as fileobj:
+        writer = NativeWriter(fileobj, columns, encoding)
+        names = [name for name, data_type, nullable in columns]
+        for values in data[names].itertuples(index=False):
+            writer.writerow([value if value == value else
+                             (na_rep if string else None)
+                             for value, string in zip(values, strings)])
+    return writer.rows
+
+
+def stage_dataframe(data, staging_path, table, config, **csv_options):
+    """Write a staged dimension as native file or as .csv.
+
+    With staging_format = native in [wob_zz] the DataFrame is written to
+    <staging_path>/<table>.dat with the columns of the table definition,
+    otherwise to <staging_path>/<table>.csv with the given to_csv options.
+    """
+    native = config.get('wob_zz', 'staging_format', fallback='csv') == 'native'
+    # remove the file of the other format, else the table is loaded twice
+    stale = '{}/{}.{}'.format(staging_path, table, 'csv' if native else 'dat')
+    if os.path.exists(stale):
+        os.remove(stale)
+    if native:
+        from wob_zz.create_tables import table_columns
+        return write_dataframe(data, '{}/{}.dat'.format(staging_path, table),
+                               table_columns(config)[table],
+                               na_rep=csv_options.get('na_rep'))
+    data.to_csv('{}/{}.csv'.format(staging_path, table), **csv_options)
+    return len(data)
+
+
+class NativeBulkFactTable(object):
+    """Bulk fact table that writes native files instead of text.
+
+    Same usage as pygrametl's BulkFactTable: insert(), _bulkloadnow()
+    and endload(). It is not registered with pygrametl, so call
+    endload() before committing the connection.
+
+    Arguments:
+    - name: table name, e.g. 'FCT.SUBTRAJECT'
+    - columns: (name, data type, nullable) per column in table order
+    - bulkloader: function(name, attributes, fieldsep, rowsep, nullsubst,
+      tempdest) as for pygrametl; fieldsep, rowsep and nullsubst are None
+    - bulksize: rows per bulk load
+    - tempdest: directory for the temporary files, shared with SQL Server
+    """
+
+    def __init__(self, name, columns, bulkloader, bulksize=500000,
+                 tempdest=None, encoding='cp1252'):
+        self.name = name
+        self.columns = list(columns)
+        self.all = [name for name, data_type, nullable in self.columns]
+        self.bulkloader = bulkloader
+        self.bulksize = bulksize
+        self.tempdest = tempdest
+        self.encoding = encoding
+        self.__file = None
+        self.__writer = None
+
+    def __open(self):
+        self.__file = tempfile.NamedTemporaryFile(
+            dir=self.tempdest, suffix='.dat', delete=False)
+        self.__writer = NativeWriter(self.__file, self.columns, self.encoding)
+
+    def insert(self, row, namemapping={}):
+        if self.__writer is None:
+            self.__open()
+        self.__writer.writedict(row, namemapping)
+        if self.__writer.rows >= self.bulksize:
+            self._bulkloadnow()
+
+    def _bulkloadnow(self):
+        if self.__writer is None or self.__writer.rows == 0:
+            return
+        self.__file.close()
+        try:
+            self.bulkloader(self.name, self.all, None, None, None,
+                            self.__file.name)
+        finally:
+            os.remove(self.__file.name)
+            self.__file = None
+            self.__writer = None
+
+    def endload(self):
+        self._bulkloadnow()
@@ -0,0 +1,125 @@
+""" Sampling profiler for the fact load.
+
+cProfile traces every call, which slows the row loop down several times
+and is not something to leave on in production. SamplingProfiler takes
+the stack of the running thread every interval of CPU time instead
+(SIGPROF via setitimer), so the overhead is a few hundred stack walks
+per second, independent of the number of rows.
+
+Sampling stops after max_rows rows or max_seconds, whichever comes
+first, and write() produces:
+- <name>.functions.txt: samples per function, self and cumulative
+- <name>.lines.txt: samples per source line
+- <name>.folded: folded stacks for flamegraph.pl / speedscope
+
+Only works on POSIX in the main thread.
+"""
+
+import os
+import signal
+import time
+from collections import Counter
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+
+class SamplingProfiler(object):
+    """Statistical profiler bounded by rows and/or time.
+
+    Arguments:
+    - interval: seconds of CPU time between samples
+    - max_rows: stop after this many calls of row(), 0 for no limit
+    - max_seconds: stop after this many seconds, 0 for no limit
+    - max_depth: maximum number of frames per sampled stack
+    """
+
+    def __init__(self, interval=0.005, max_rows=0, max_seconds=0,
+                 max_depth=64):
+        self.interval = interval
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.max_depth = max_depth
+        self.active = False
+        self.rows = 0
+        self.samples = 0
+        self.functions = Counter()
+        self.cumulative = Counter()
+        self.lines = Counter()
+        self.stacks = Counter()
+        self.__handler = None
+        self.__start = None
+        self.elapsed = 0.0
+
+    def start(self):
+        self.__handler = signal.signal(signal.SIGPROF, self.__sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.__start = time.time()
+        self.active = True
+
+    def stop(self):
+        if not self.active:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.__handler or signal.SIG_DFL)
+        self.elapsed = time.time() - self.__start
+        self.active = False
+
+    def row(self):
+        """Count a processed row and stop when the sample is complete."""
+        self.rows += 1
+        if self.max_rows and self.rows >= self.max_rows:
+            self.stop()
+        elif self.max_seconds and self.rows % 1000 == 0 and \
+                time.time() - self.__start >= self.max_seconds:
+            self.stop()
+
+    def __sample(self, signum, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append(('{}:{}'.format(os.path.basename(code.co_filename),
+                                         code.co_name), frame.f_lineno))
+            frame = frame.f_back
+        if not stack:
+            return
+        self.samples += 1
+        function, line = stack[0]
+        self.functions[function] += 1
+        self.lines['{}:{}'.format(function, line)] += 1
+        for name in set([name for name, line in stack]):
+            self.cumulative[name] += 1
+        self.stacks[';'.join([name for name, line in reversed(stack)])] += 1
+
+    def write(self, directory, name):
+        """Write the function, line and folded stack reports."""
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        base = os.path.join(directory, name)
+        total = float(self.samples or 1)
+        with open(base + '.functions.txt', 'w') as report:
+            report.write('{} samples, {} rows, {:.1f} seconds, interval {}s\n'.
+                         format(self.samples, self.rows, self.elapsed,
+                                self.interval))
+            report.write('{:>8} {:>7} {:>8} {:>7}  function\n'.format(
+                'self', '%', 'cumul', '%'))
+            for function, count in self.cumulative.most_common():
+                own = self.functions.get(function, 0)
+                report.write('{:>8} {:>6.1%} {:>8} {:>6.1%}  {}\n'.format(
+                    own, own / total, count, count / total, function))
+        with open(base + '.lines.txt', 'w') as report:
+            for line, count in self.lines.most_common():
+                report.write('{:>8} {:>6.1%}  {}\n'.format(
+                    count, count / total, line))
+        with open(base + '.folded', 'w') as report:
+            for stack, count in self.stacks.most_common():
+                report.write('{} {}\n'.format(stack, count))
+        return base
+
+    def summary(self, n=5):
+        """Most expensive functions by self samples as one line."""
+        total = float(self.samples or 1)
+        return ', '.join(['{} {:.0%}'.format(function, count / total)
+                          for function, count
+                          in self.functions.most_common(n)])
@@ -0,0 +1,279 @@
+""" Local columnar replica of the star schema for ad-hoc analysis.
+
+Queries on FCT.SUBTRAJECT compete with the ETL for the same SQL Server.
+The loaders can also write every table to a local replica of Parquet
+files, typed after the column definitions in create_tables and with the
+same resolved keys as the warehouse:
+
+    <path>/FCT.SUBTRAJECT/jaar=2012/maand=01/part.parquet
+    <path>/DIM.SUBTRAJECTNUMMER/jaar=2012/maand=01/part.parquet
+    <path>/DIM.ZORGPRODUCT/part.parquet
+
+The facts of a month are written while they are loaded, together with
+the subtrajectnummers they refer to, into temporary files that replace
+the partition of the month only after the warehouse committed the load.
+Months loaded with change data capture only see the changed rows, so
+their partitions are copied from the warehouse with refresh_month().
+The other dimensions are small and are copied as a whole after each
+month.
+
+connect() returns an embedded DuckDB database with a view per table
+(e.g. FCT.SUBTRAJECT), so analysts can run the warehouse queries on the
+replica:
+
+    con = Replica(path, table_columns(config)).connect()
+    con.execute('select zpr_id, sum(fct_omzet_ziekenhuis) '
+                'from FCT.SUBTRAJECT group by zpr_id').fetchdf()
+
+Requires pyarrow; connect() requires duckdb.
+"""
+
+import os
+from decimal import Decimal, ROUND_HALF_UP
+from wob_zz.native_format import _split_type, _isnull, _toint, _todate, \
+    _todatetime
+from wob_zz.memory_budget import sizeof_items
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+# tables written per month of the source file, the rest as a whole
+PARTITIONED = ['FCT.SUBTRAJECT', 'DIM.SUBTRAJECTNUMMER']
+
+
+def arrow_type(data_type):
+    """Arrow type of a column definition, e.g. 'decimal(9,2)'."""
+    name, args = _split_type(data_type)
+    if name in ('tinyint', 'smallint', 'int', 'bigint'):
+        # tinyint is unsigned in MS SQL
+        return {'tinyint': pa.uint8(), 'smallint': pa.int16(),
+                'int': pa.int32(), 'bigint': pa.int64()}[name]
+    if name == 'bit':
+        return pa.bool_()
+    if name in ('decimal', 'numeric'):
+        precision, scale = (args + [18, 0])[0:2] if args else (18, 0)
+        return pa.decimal128(precision, scale)
+    if name == 'date':
+        return pa.date32()
+    if name == 'datetime':
+        return pa.timestamp('ms')
+    if name in ('nvarchar', 'nchar', 'varchar', 'char'):
+        return pa.string()
+    raise ValueError('no replica type for data type {}'.format(data_type))
+
+
+def _converter(data_type):
+    """Function that converts a row value into its Python value."""
+    name, args = _split_type(data_type)
+    if name in ('tinyint', 'smallint', 'int', 'bigint'):
+        return lambda value: None if _isnull(value) else _toint(value)
+    if name == 'bit':
+        return lambda value: None if _isnull(value) else bool(_toint(value))
+    if name in ('decimal', 'numeric'):
+        scale = args[1] if len(args) > 1 else 0
+        exponent = Decimal(1).scaleb(-scale)
+        return lambda value: None if _isnull(value) else \
+            Decimal(str(value)).quantize(exponent, ROUND_HALF_UP)
+    if name == 'date':
+        return lambda value: None if _isnull(value) else _todate(value)
+    if name == 'datetime':
+        return lambda value: None if _isnull(value) else _todatetime(value)
+    return lambda value: None if value is None else str(value)
+
+
+class ParquetTableWriter(object):
+    """Write rows of one table to a Parquet file in batches.
+
+    Rows are written to path + '.tmp'; close() moves the file to path,
+    so readers never see a partially written file.
+
+    Arguments:
+    - path: Parquet file
+    - columns: (name, data type, nullable) as in create_tables
+    - batch_size: rows per row group
+    """
+
+    def __init__(self, path, columns, batch_size=100000):
+        if pa is None:
+            raise ImportError('the replica requires pyarrow')
+        self.path = path
+        self.names = [name for name, data_type, nullable in columns]
+        self.converters = [_converter(data_type)
+                           for name, data_type, nullable in columns]
+        self.schema = pa.schema([pa.field(name, arrow_type(data_type),
+                                          nullable)
+                                 for name, data_type, nullable in columns])
+        self.batch_size = batch_size
+        self.rows = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.__writer = pq.ParquetWriter(path + '.tmp', self.schema,
+                                         compression='snappy')
+        self.__buffer = [[] for name in self.names]
+
+    def write(self, row):
+        """Append a row as dict."""
+        for values, name, convert in zip(self.__buffer, self.names,
+                                         self.converters):
+            values.append(convert(row[name]))
+        self.rows += 1
+        if len(self.__buffer[0]) >= self.batch_size:
+            self.flush()
+
+    def write_tuples(self, rows):
+        """Append rows as tuples in column order."""
+        for row in rows:
+            for values, value, convert in zip(self.__buffer, row,
+                                              self.converters):
+                values.append(convert(value))
+            self.rows += 1
+            if len(self.__buffer[0]) >= self.batch_size:
+                self.flush()
+
+    def nbytes(self):
+        """Estimated memory of the rows not yet written."""
+        return sum([sizeof_items(values) for values in self.__buffer])
+
+    def flush(self):
+        if not self.__buffer[0]:
+            return
+        self.__writer.write_batch(pa.record_batch(
+            [pa.array(values, type=field.type) for values, field
+             in zip(self.__buffer, self.schema)], schema=self.schema))
+        self.__buffer = [[] for name in self.names]
+
+    def close(self):
+        self.flush()
+        self.__writer.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    def abort(self):
+        self.__writer.close()
+        os.remove(self.path + '.tmp')
+
+
+class Replica(object):
+    """Parquet replica of the star schema under path.
+
+    Arguments:
+    - path: root directory of the replica
+    - columns: columns per table, see create_tables.table_columns
+    - batch_size: rows per row group
+    """
+
+    def __init__(self, path, columns, batch_size=100000):
+        if pa is None:
+            raise ImportError('the replica requires pyarrow')
+        self.path = path
+        self.columns = columns
+        self.batch_size = batch_size
+        self.__writers = {}
+
+    def table_path(self, table, month=None):
+        """Parquet file of a table, or of one month ('YYYYMM') of it."""
+        if month is None:
+            return os.path.join(self.path, table, 'part.parquet')
+        return os.path.join(self.path, table, 'jaar=' + month[0:4],
+                            'maand=' + month[4:6], 'part.parquet')
+
+    def begin(self, month):
+        """Start writing the partitions of a month."""
+        self.abort()
+        for table in PARTITIONED:
+            self.__writers[table] = ParquetTableWriter(
+                self.table_path(table, month), self.columns[table],
+                self.batch_size)
+
+    def add(self, table, row):
+        """Add a row with resolved keys to the partition being written."""
+        self.__writers[table].write(row)
+
+    def nbytes(self):
+        """Estimated memory of the batches of the partitions being written."""
+        return sum([writer.nbytes() for writer in self.__writers.values()])
+
+    def finish(self):
+        """Replace the partitions of the month, after the load committed."""
+        for writer in self.__writers.values():
+            writer.close()
+        self.__writers = {}
+
+    def abort(self):
+        for writer in self.__writers.values():
+            writer.abort()
+        self.__writers = {}
+
+    def copy_table(self, cursor, table, month=None, query=None, params=(),
+                   arraysize=10000):
+        """Copy a table, or the rows of one month of it, from the warehouse."""
+        names = [name for name, data_type, nullable in self.columns[table]]
+        cursor.execute(query or 'select {} from {}'.format(', '.join(names),
+                                                            table), params)
+        writer = ParquetTableWriter(self.table_path(table, month),
+                                    self.columns[table], self.batch_size)
+        try:
+            while True:
+                rows = cursor.fetchmany(arraysize)
+                if not rows:
+                    break
+                writer.write_tuples(rows)
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+        return writer.rows
+
+    def refresh_month(self, cursor, month):
+        """Copy the partitions of a month from the warehouse."""
+        facts = [name for name, data_type, nullable
+                 in self.columns['FCT.SUBTRAJECT']]
+        self.copy_table(
+            cursor, 'FCT.SUBTRAJECT', month,
+            'select {} from FCT.SUBTRAJECT f join DIM.BRONBESTAND b '
+            'on f.bbs_id = b.bbs_id where b.bbs_jaar_maand = %s'.
+            format(', '.join(['f.' + name for name in facts])), (month,))
+        members = [name for name, data_type, nullable
+                   in self.columns['DIM.SUBTRAJECTNUMMER']]
+        self.copy_table(
+            cursor, 'DIM.SUBTRAJECTNUMMER', month,
+            'select {} from DIM.SUBTRAJECTNUMMER s where exists '
+            '(select 1 from FCT.SUBTRAJECT f join DIM.BRONBESTAND b '
+            'on f.bbs_id = b.bbs_id where f.stn_id = s.stn_id '
+            'and b.bbs_jaar_maand = %s)'.
+            format(', '.join(['s.' + name for name in members])), (month,))
+
+    def copy_dimensions(self, cursor):
+        """Copy all dimensions that are not partitioned by month."""
+        for table in sorted(self.columns):
+            if table.startswith('DIM.') and table not in PARTITIONED:
+                self.copy_table(cursor, table)
+
+    def connect(self, database=':memory:'):
+        """DuckDB connection with a view per table of the replica."""
+        if duckdb is None:
+            raise ImportError('querying the replica requires duckdb')
+        con = duckdb.connect(database)
+        for table in sorted(self.columns):
+            directory = os.path.join(self.path, table)
+            if not os.path.exists(directory):
+                continue
+            schema = table.split('.')[0]
+            con.execute('create schema if not exists {}'.format(schema))
+            con.execute("create or replace view {} as select * from "
+                        "read_parquet('{}', hive_partitioning = {})".format(
+                            table, os.path.join(directory, '**', '*.parquet'),
+                            'true' if table in PARTITIONED else 'false'))
+        return con
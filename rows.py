@@ -0,0 +1,136 @@
+""" Low-allocation positional rows for the fact load.
+
+csv.DictReader builds a fresh dict for every source row, which is then
+extended with the derived dimension ids. The row classes created here
+store the values in __slots__ at precomputed positions instead, while
+still supporting the dict-style access that pygrametl uses
+(row[name], row.get(name), row.copy(), ...), so they can be passed to
+ensure(), lookup() and insert() unchanged.
+
+Latin1Reader reads the bz2 source files in binary mode and decodes each
+line in one step with latin-1, which maps bytes one-to-one onto code
+points, instead of going through the incremental text decoder.
+"""
+
+import csv
+import io
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+
+class SlotsRow(object):
+    """Base class for rows with a fixed set of fields in __slots__."""
+
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        try:
+            setattr(self, name, value)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return hasattr(self, name)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def keys(self):
+        return [name for name in self.__slots__ if hasattr(self, name)]
+
+    def values(self):
+        return [getattr(self, name) for name in self.keys()]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.keys()]
+
+    def copy(self):
+        """Return the row as a plain dict, e.g. for pygrametl.copy()."""
+        return dict(self.items())
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, self.copy())
+
+
+def make_row_class(name, fields, extra_fields=()):
+    """Create a SlotsRow subclass.
+
+    Arguments:
+    - fields: positional fields, filled by the constructor
+    - extra_fields: fields that are assigned later, e.g. dimension ids
+    """
+    fields = list(fields)
+    # generate __init__ with one assignment per field, avoiding a loop
+    # over setattr() for every row
+    source = 'def __init__(self, {}):\n'.format(', '.join(fields)) + \
+        ''.join(['    self.{0} = {0}\n'.format(field) for field in fields])
+    namespace = {}
+    exec(source, namespace)
+    return type(name, (SlotsRow,), {
+        '__slots__': tuple(fields) + tuple(extra_fields),
+        '__init__': namespace['__init__'],
+        'fields': tuple(fields)})
+
+
+class Latin1Reader(object):
+    """Iterate over a binary file with delimited latin-1 text as rows.
+
+    Lines without quote characters are split directly; lines with quotes
+    are handed to the csv module. A line with an odd number of quote
+    characters has a quoted field with a line break, so the following
+    lines are added until the quotes are balanced. Missing trailing
+    fields are filled with None, like csv.DictReader does, and blank
+    lines are skipped.
+
+    Arguments:
+    - fileobj: file opened in binary mode, e.g. bz2.open(path, 'rb')
+    - rowclass: class created with make_row_class()
+    """
+
+    def __init__(self, fileobj, rowclass, delimiter=';', quotechar='"'):
+        self.fileobj = fileobj
+        self.rowclass = rowclass
+        self.width = len(rowclass.fields)
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+
+    def __iter__(self):
+        rowclass, width = self.rowclass, self.width
+        delimiter, quotechar = self.delimiter, self.quotechar
+        quote = quotechar.encode('latin-1')
+        lines = iter(self.fileobj)
+        for line in lines:
+            if quote in line:
+                # quoted line breaks: read on until the quotes are balanced
+                while line.count(quote) % 2:
+                    following = next(lines, None)
+                    if following is None:
+                        break
+                    line += following
+            line = line.rstrip(b'\r\n')
+            if not line:
+                continue
+            if quote in line:
+                values = next(csv.reader(io.StringIO(line.decode('latin-1'),
+                                                     newline=''),
+                                         delimiter=delimiter,
+                                         quotechar=quotechar))
+            else:
+                values = line.decode('latin-1').split(delimiter)
+            if len(values) != width:
+                values = (values + [None] * width)[:width]
+            yield rowclass(*values)
@@ -14,8 +14,10 @@ __version__ = '0.1'
 if __name__  == '__main__':
     wob_zz.create_tables.main()
     wob_zz.stage_date_dimensions.main()
+    wob_zz.stage_dbc_tarieventabel.main()
     wob_zz.stage_dbc_typeringslijst.main()
     wob_zz.stage_dbc_zorgproduct.main()
     wob_zz.stage_vektis_codelijsten.main()
     wob_zz.load_staged_dimensions.main()
     wob_zz.load_fct_subtraject.main()
+    wob_zz.load_fct_zorgtraject.main()
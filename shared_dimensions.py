@@ -0,0 +1,186 @@
+""" Shared-memory dimension lookup tables for multi-process fact loads.
+
+Every loader process prefills its own CachedDimension objects, so the
+startup cost and memory use grow with the number of workers. Instead,
+the resolved lookup tables are published once into shared memory as
+compact arrays, and the workers attach to them read-only without
+copying any data.
+
+Layout of a segment (little-endian):
+- header: magic, number of members, number of hash slots, blob length
+- slots: open addressing hash table with member index or -1 (int32)
+- ids: surrogate key per member (int32)
+- offsets: start of each lookup key in the blob (uint32, n + 1)
+- blob: utf-8 encoded lookup keys, attributes separated by 0x1f
+
+NB: requires Python 3.8+ for multiprocessing.shared_memory
+"""
+
+import struct
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+MAGIC = b'WZDM'
+HEADER = struct.Struct('<4sIII')
+SEPARATOR = '\x1f'
+
+
+def lookup_key(values):
+    """Encode the values of the lookup attributes as one bytes key."""
+    return SEPARATOR.join([str(value) for value in values]).encode('utf-8')
+
+
+def _open_segment(name):
+    """Attach to an existing segment without resource tracking.
+
+    The resource tracker would otherwise unlink the segment as soon as
+    the first worker process exits.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no track argument
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+class SharedLookup(object):
+    """Read-only lookup table from bytes key to surrogate key."""
+
+    def __init__(self, segment):
+        self.segment = segment
+        buf = segment.buf.toreadonly()
+        magic, n, nslots, bloblen = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a dimension lookup segment'.
+                             format(segment.name))
+        pos = HEADER.size
+        self.__slots = buf[pos:pos + 4 * nslots].cast('i')
+        pos += 4 * nslots
+        self.__ids = buf[pos:pos + 4 * n].cast('i')
+        pos += 4 * n
+        self.__offsets = buf[pos:pos + 4 * (n + 1)].cast('I')
+        pos += 4 * (n + 1)
+        self.__blob = buf[pos:pos + bloblen]
+        self.__mask = nslots - 1
+        self.size = n
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to a published segment by name."""
+        return cls(_open_segment(name))
+
+    def get(self, key, default=None):
+        """Return surrogate key for bytes key, or default if unknown."""
+        slots, offsets, blob = self.__slots, self.__offsets, self.__blob
+        slot = zlib.crc32(key) & self.__mask
+        while True:
+            member = slots[slot]
+            if member < 0:
+                return default
+            if blob[offsets[member]:offsets[member + 1]] == key:
+                return self.__ids[member]
+            slot = (slot + 1) & self.__mask
+
+    def close(self):
+        """Detach from the segment; the data stays published."""
+        self.__slots.release()
+        self.__ids.release()
+        self.__offsets.release()
+        self.__blob.release()
+        self.segment.close()
+
+
+def publish(name, members):
+    """Publish (surrogate key, bytes key) pairs into a new segment.
+
+    Returns the SharedMemory object; the caller is responsible for
+    unlinking it when all workers are done.
+    """
+    members = list(members)
+    n = len(members)
+    nslots = 1
+    while nslots < 2 * n:
+        nslots *= 2
+    slots = [-1] * nslots
+    offsets = [0]
+    for index, (id, key) in enumerate(members):
+        offsets.append(offsets[-1] + len(key))
+        slot = zlib.crc32(key) & (nslots - 1)
+        while slots[slot] >= 0:
+            slot = (slot + 1) & (nslots - 1)
+        slots[slot] = index
+    blob = b''.join([key for id, key in members])
+
+    size = HEADER.size + 4 * nslots + 4 * n + 4 * (n + 1) + len(blob)
+    segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+    # the publisher decides when the segment is unlinked, not the tracker
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    buf = segment.buf
+    HEADER.pack_into(buf, 0, MAGIC, n, nslots, len(blob))
+    pos = HEADER.size
+    struct.pack_into('<{}i'.format(nslots), buf, pos, *slots)
+    pos += 4 * nslots
+    struct.pack_into('<{}i'.format(n), buf, pos, *[id for id, key in members])
+    pos += 4 * n
+    struct.pack_into('<{}I'.format(n + 1), buf, pos, *offsets)
+    pos += 4 * (n + 1)
+    buf[pos:pos + len(blob)] = blob
+    return segment
+
+
+def publish_dimension(dimension, cursor, name):
+    """Publish all members of a pygrametl dimension from the database."""
+    stmt = 'select {}, {} from {}'.format(
+        dimension.key, ', '.join(dimension.lookupatts), dimension.name)
+    cursor.execute(stmt)
+    members = [(row[0], lookup_key(row[1:])) for row in cursor.fetchall()]
+    return publish(name, members)
+
+
+def unlink(name):
+    """Remove a published segment."""
+    segment = _open_segment(name)
+    segment.close()
+    segment.unlink()
+
+
+class SharedDimension(object):
+    """Dimension with lookups served from a shared-memory segment.
+
+    Lookups that miss the shared table (e.g. members added after
+    publishing) fall through to the wrapped pygrametl dimension, which
+    should be created with prefill=False. The row is passed on as a copy,
+    since the DB-API only accepts dicts as query parameters.
+    """
+
+    def __init__(self, dimension, name):
+        self.dimension = dimension
+        self.name = dimension.name
+        self.key = dimension.key
+        self.lookupatts = dimension.lookupatts
+        self.shared = SharedLookup.attach(name)
+
+    def __key(self, row, namemapping):
+        return lookup_key([row[namemapping.get(att) or att]
+                           for att in self.lookupatts])
+
+    def lookup(self, row, namemapping={}):
+        keyvalue = self.shared.get(self.__key(row, namemapping))
+        if keyvalue is None:
+            return self.dimension.lookup(row.copy(), namemapping)
+        return keyvalue
+
+    def ensure(self, row, namemapping={}):
+        keyvalue = self.shared.get(self.__key(row, namemapping))
+        if keyvalue is None:
+            return self.dimension.ensure(row.copy(), namemapping)
+        return keyvalue
+
+    def close(self):
+        self.shared.close()
@@ -0,0 +1,275 @@
+""" Mergeable streaming sketches for profiling source columns.
+
+Dimension caches are sized and delivery anomalies detected with
+count(distinct ...) queries after the load. The same figures are kept
+while the source file is read, per profiled column:
+- HyperLogLog: estimate of the number of distinct values (~1.6% error
+  with the default 4096 registers)
+- count-min sketch with a small heavy-hitter list: most frequent codes
+  and their (over)estimated counts
+- counters of rows, nulls (blank) and values that fall back to the
+  default of the column (e.g. '_?_' or '??' after parse_codes)
+
+All sketches of a column merge by register max / element-wise sum, so
+profiles of files and of worker processes can be combined afterwards.
+Profiles are saved as JSON.
+
+While a file is read, each row only counts its values in a Counter
+per column. The distinct values are hashed (64-bit blake2b) and fed into
+the sketches once, with their counts, when the profile is saved. Code
+columns have few distinct values, so this costs a dict update per row
+and column. Columns with a distinct value per row (subtraject_id, ...)
+grow a Counter entry per row, so don't profile them.
+"""
+
+import hashlib
+import json
+import os
+from array import array
+from collections import Counter
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+def hash64(value):
+    """64-bit hash of a value as string."""
+    return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'),
+                                          digest_size=8).digest(), 'little')
+
+
+class HyperLogLog(object):
+    """Distinct count estimate with 2 ** precision registers."""
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.registers = bytearray(registers) if registers is not None \
+            else bytearray(1 << precision)
+
+    def add_hash(self, h):
+        p = self.precision
+        index = h >> (64 - p)
+        rest = (h << p) & MASK64
+        rank = min(64 - rest.bit_length() + 1, 64 - p + 1)
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum([2.0 ** -r for r in self.registers])
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting for small cardinalities
+            from math import log
+            estimate = m * log(m / float(zeros))
+        return int(round(estimate))
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def to_dict(self):
+        return {'precision': self.precision, 'registers': self.registers.hex()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['precision'], bytes.fromhex(data['registers']))
+
+
+class CountMinSketch(object):
+    """Frequency estimate with depth x width counters and a top-k list.
+
+    Counts are never underestimated; the top-k list holds the values
+    with the highest estimates seen so far.
+    """
+
+    def __init__(self, width=2048, depth=4, k=20):
+        self.width = width
+        self.depth = depth
+        self.k = k
+        self.table = [array('q', [0]) * width for i in range(depth)]
+        self.top = {}
+        self.__floor = 0
+
+    def __indexes(self, h):
+        h1, h2 = h & 0xFFFFFFFF, h >> 32
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add_hash(self, h, value, count=1):
+        estimate = None
+        for row, i in zip(self.table, self.__indexes(h)):
+            row[i] += count
+            if estimate is None or row[i] < estimate:
+                estimate = row[i]
+        if value in self.top or len(self.top) < self.k:
+            self.top[value] = estimate
+        elif estimate > self.__floor:
+            self.top[value] = estimate
+            del self.top[min(self.top, key=self.top.get)]
+            self.__floor = min(self.top.values())
+
+    def estimate(self, value):
+        h = hash64(value)
+        return min([row[i] for row, i in zip(self.table, self.__indexes(h))])
+
+    def merge(self, other):
+        for row, other_row in zip(self.table, other.table):
+            for i, count in enumerate(other_row):
+                if count:
+                    row[i] += count
+        candidates = set(self.top) | set(other.top)
+        estimates = dict([(value, self.estimate(value))
+                          for value in candidates])
+        self.top = dict(sorted(estimates.items(), key=lambda item: -item[1])
+                        [:self.k])
+        self.__floor = min(self.top.values()) if len(self.top) >= self.k else 0
+
+    def most_common(self, n=None):
+        return sorted(self.top.items(), key=lambda item: -item[1])[:n]
+
+    def to_dict(self):
+        return {'width': self.width, 'depth': self.depth, 'k': self.k,
+                'table': [list(row) for row in self.table],
+                'top': self.top}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['width'], data['depth'], data['k'])
+        sketch.table = [array('q', row) for row in data['table']]
+        sketch.top = dict(data['top'])
+        if len(sketch.top) >= sketch.k:
+            sketch._CountMinSketch__floor = min(sketch.top.values())
+        return sketch
+
+
+class ColumnProfile(object):
+    """Sketches and counters of one source column.
+
+    add() only counts the value in a Counter; flush() feeds every distinct
+    value once into the sketches, with its count.
+
+    Arguments:
+    - fallbacks: raw values that end up as the column default
+    """
+
+    def __init__(self, fallbacks=(), precision=12, width=2048, depth=4, k=20):
+        self.fallbacks = frozenset(fallbacks)
+        self.hll = HyperLogLog(precision)
+        self.cms = CountMinSketch(width, depth, k)
+        self.rows = 0
+        self.nulls = 0
+        self.defaults = 0
+        self.counts = Counter()
+
+    def add(self, value):
+        self.counts[value] += 1
+
+    def flush(self):
+        """Feed the counted values into the sketches."""
+        for value, count in self.counts.items():
+            self.rows += count
+            if value is None or value == '':
+                self.nulls += count
+            if value in self.fallbacks:
+                self.defaults += count
+            h = hash64(value)
+            self.hll.add_hash(h)
+            self.cms.add_hash(h, value, count)
+        self.counts.clear()
+
+    def merge(self, other):
+        self.flush()
+        other.flush()
+        self.rows += other.rows
+        self.nulls += other.nulls
+        self.defaults += other.defaults
+        self.hll.merge(other.hll)
+        self.cms.merge(other.cms)
+
+    def to_dict(self):
+        self.flush()
+        return {'rows': self.rows, 'nulls': self.nulls,
+                'defaults': self.defaults, 'fallbacks': sorted(self.fallbacks),
+                'distinct': self.hll.count(), 'hll': self.hll.to_dict(),
+                'cms': self.cms.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        profile = cls(data['fallbacks'])
+        profile.rows, profile.nulls = data['rows'], data['nulls']
+        profile.defaults = data['defaults']
+        profile.hll = HyperLogLog.from_dict(data['hll'])
+        profile.cms = CountMinSketch.from_dict(data['cms'])
+        return profile
+
+
+class SourceProfile(object):
+    """Column profiles of a source file.
+
+    Arguments:
+    - columns: {column: raw values that fall back to the default}
+    """
+
+    def __init__(self, columns, **options):
+        self.columns = dict([(column, ColumnProfile(fallbacks, **options))
+                             for column, fallbacks in columns.items()])
+
+    def add(self, row):
+        for column, profile in self.columns.items():
+            profile.counts[row[column]] += 1
+
+    def flush(self):
+        for profile in self.columns.values():
+            profile.flush()
+
+    def merge(self, other):
+        for column, profile in other.columns.items():
+            if column in self.columns:
+                self.columns[column].merge(profile)
+            else:
+                self.columns[column] = profile
+
+    def report(self, n=3):
+        self.flush()
+        lines = []
+        for column in sorted(self.columns):
+            profile = self.columns[column]
+            lines.append('{}: ~{} distinct, {} null, {} default, top {}'.format(
+                column, profile.hll.count(), profile.nulls, profile.defaults,
+                ', '.join(['{}={}'.format(value, count) for value, count
+                           in profile.cms.most_common(n)])))
+        return lines
+
+    def save(self, path):
+        self.flush()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path + '.tmp', 'w') as profile:
+            json.dump(dict([(column, profile.to_dict()) for column, profile
+                            in self.columns.items()]), profile)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as data:
+            columns = json.load(data)
+        profile = cls({})
+        profile.columns = dict([(column, ColumnProfile.from_dict(data))
+                                for column, data in columns.items()])
+        return profile
+
+
+def merge_profiles(paths):
+    """One SourceProfile of several saved profiles, e.g. all months."""
+    merged = None
+    for path in paths:
+        profile = SourceProfile.load(path)
+        if merged is None:
+            merged = profile
+        else:
+            merged.merge(profile)
+    return merged
@@ -9,6 +9,7 @@ from datetime import date
 from dateutil.rrule import rrule, DAILY
 import pandas as pd
 import configparser
+from wob_zz.native_format import stage_dataframe
 
 __author__ = 'Daniel Kapitan'
 __maintainer__ = 'Daniel Kapitan'
@@ -72,9 +73,9 @@ def main():
     stg_dag = stg_dag[['dag_id', 'dag_datum', 'dag_jaar', 'dag_kwartaal',
                        'dag_maand', 'dag_week', 'dag_jaar_maand',
                        'dag_jaar_week']]
-    stg_dag.to_csv(staging_path + '/DIM.DAG.csv', sep=';',
-                   header=True, index=False, encoding='utf-8',
-                   line_terminator='\r\n')
+    stage_dataframe(stg_dag, staging_path, 'DIM.DAG', config,
+                    sep=';', header=True, index=False, encoding='utf-8',
+                    line_terminator='\r\n')
 
 if __name__ == '__main__':
     main()
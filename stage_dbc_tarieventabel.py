@@ -3,17 +3,20 @@ for ETL in WOB_ZZ.
 
 Following dimension tables are generated:
 
-    DIM_ZORGPRODUCT
+    DIM_DECLARATIE
 
 DIM.DECLARATIE is defined as slowly changing type 2 dimension
+
+The Tarieven Tabel is the largest table of DBC Onderhoud, so it is read
+in chunks. The maximum tarief per declaratiecode, validity period and
+specialisme_uitvoerend is aggregated incrementally per chunk, such that
+memory is bounded by the number of distinct groups instead of the size
+of the file. The output is the same as a pivot_table over the whole file.
 """
 
 import configparser
-import pymssql as sql
 import pandas as pd
-import numpy as np
-from decimal import Decimal
-from wob_zz import parse_dates
+from wob_zz import parse_dates_series, zfill_series
 
 
 __author__ = 'Daniel Kapitan'
@@ -21,26 +24,6 @@ __maintainer__ = 'Daniel Kapitan'
 __version__ = '0.1'
 
 
-# setup database connection
-config = configparser.ConfigParser()
-config.read('/opt/projects/wob_zz/config.ini')
-login = {
-    'user': config.get('local_mssql', 'user'),
-    'password': config.get('local_mssql', 'password'),
-    'server': config.get('local_mssql', 'server'),
-    'port': config.get('local_mssql', 'port'),
-    'database': config.get('wob_zz', 'database')}
-cnx = sql.connect(**login)
-cursor = cnx.cursor()
-
-# configure files
-paths = {'data_path': config.get('wob_zz', 'dbco_path'),
-         'staging_path': config.get('wob_zz', 'staging_path')}
-data_file = paths['data_path'] \
-    + '/20140601 Totaalbestand uitlevering v20140501' \
-    + '/20140601 Tarieven Tabel 20140501.csv'
-data = pd.read_csv(data_file, sep=';',dtype=str, encoding='latin1')
-
 mapping = {
     'AGB Uitvoerder'                : 'dcl_dbc_specialisme_uitvoerend',
     'Declaratiecode'                : 'dcl_dbc_declaratie_code',
@@ -57,34 +40,71 @@ mapping = {
     'Einddatum'                     : 'dcl_dbc_einddatum'
 }
 
-data = data.drop(['AGB Specialisme', 'Mutatie Toelichting',
-                  'Declaratie regel', 'Mutatie'], axis=1)
-data.rename(columns=mapping, inplace=True)
-
-# reformat columns
-data['dcl_dbc_begindatum'] = data['dcl_dbc_begindatum'].apply(lambda x: parse_dates(x) + (' 00:00:00'))
-data['dcl_dbc_einddatum'] = data['dcl_dbc_einddatum'].apply(lambda x: parse_dates(x) + (' 00:00:00'))
-data['dcl_dbc_specialisme_uitvoerend'] = \
-    data['dcl_dbc_specialisme_uitvoerend'].apply(lambda x: x.zfill(4))
-data['dcl_dbc_tarief'] = data['dcl_dbc_tarief'].apply(lambda x: (1.0*int(x))/100)
-
-# pivot table such that only unique specialisme_uitvoerend, declaractie_code
+# pivot such that only unique specialisme_uitvoerend, declaractie_code
 # items remain (with separate entries from-to date)
-
-data = data.pivot_table(
-    rows=['dcl_dbc_declaratie_code', 'dcl_dbc_omschrijving',
-           'dcl_dbc_kostensoort', 'dcl_dbc_tarieftype',
-           'dcl_dbc_declaratie_eenheid', 'dcl_dbc_tariefsoort',
-           'dcl_dbc_segment_aanduiding', 'dcl_dbc_honorariumsoort',
-           'dcl_dbc_begindatum', 'dcl_dbc_einddatum'],
-    cols=['dcl_dbc_specialisme_uitvoerend'],
-    values='dcl_dbc_tarief',
-    aggfunc=np.max)
-
-data = data.reset_index()
-
-
-# write output to .csv
-data.to_csv(paths['staging_path'] + '/DIM.DECLARATIE.csv', sep=';',
-            header=True, index = False, encoding='latin-1',
-            quoting=None, na_rep='_?_')
\ No newline at end of file
+rows = ['dcl_dbc_declaratie_code', 'dcl_dbc_omschrijving',
+        'dcl_dbc_kostensoort', 'dcl_dbc_tarieftype',
+        'dcl_dbc_declaratie_eenheid', 'dcl_dbc_tariefsoort',
+        'dcl_dbc_segment_aanduiding', 'dcl_dbc_honorariumsoort',
+        'dcl_dbc_begindatum', 'dcl_dbc_einddatum']
+cols = ['dcl_dbc_specialisme_uitvoerend']
+values = 'dcl_dbc_tarief'
+
+
+def prepare_chunk(data):
+    """Rename and reformat the columns of one chunk of the Tarieven Tabel."""
+    data = data.drop(['AGB Specialisme', 'Mutatie Toelichting',
+                      'Declaratie regel', 'Mutatie'], axis=1)
+    data.rename(columns=mapping, inplace=True)
+
+    # reformat columns
+    data['dcl_dbc_begindatum'] = parse_dates_series(data['dcl_dbc_begindatum']) + ' 00:00:00'
+    data['dcl_dbc_einddatum'] = parse_dates_series(data['dcl_dbc_einddatum']) + ' 00:00:00'
+    data['dcl_dbc_specialisme_uitvoerend'] = \
+        zfill_series(data['dcl_dbc_specialisme_uitvoerend'], 4)
+    data['dcl_dbc_tarief'] = data['dcl_dbc_tarief'].astype(int) / 100.0
+    return data
+
+
+def combine_maxima(maxima, partial):
+    """Merge two partial max-aggregates with the same group levels."""
+    if maxima is None:
+        return partial
+    levels = list(range(partial.index.nlevels))
+    return pd.concat([maxima, partial]).groupby(level=levels).max()
+
+
+def main(chunksize=None):
+    config = configparser.ConfigParser()
+    config.read('/opt/projects/wob_zz/config.ini')
+    if chunksize is None:
+        chunksize = config.getint('wob_zz', 'chunksize', fallback=100000)
+
+    # configure files
+    paths = {'data_path': config.get('wob_zz', 'dbco_path'),
+             'staging_path': config.get('wob_zz', 'staging_path')}
+    data_file = paths['data_path'] \
+        + '/20140601 Totaalbestand uitlevering v20140501' \
+        + '/20140601 Tarieven Tabel 20140501.csv'
+    reader = pd.read_csv(data_file, sep=';', dtype=str, encoding='latin1',
+                         chunksize=chunksize)
+
+    # max tarief per group, combined chunk by chunk
+    maxima = None
+    for chunk in reader:
+        chunk = prepare_chunk(chunk)
+        partial = chunk.groupby(rows + cols)[values].max()
+        maxima = combine_maxima(maxima, partial)
+
+    # same layout as pivot_table(rows, cols, values, aggfunc=np.max)
+    data = maxima.unstack(cols)
+    data = data.reset_index()
+
+    # write output to .csv
+    data.to_csv(paths['staging_path'] + '/DIM.DECLARATIE.csv', sep=';',
+                header=True, index = False, encoding='latin-1',
+                quoting=None, na_rep='_?_')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,9 @@
 
 Reference tables from DBC Onderhoud - totaalbestand contain different
 version of the same code. For the datawarehouse, the latest c.q. most
-recent version is kept and all previous versions are ignored.
+recent version is kept and all previous versions are ignored, unless
+historize is set in config: then all versions are kept as slowly
+changing type 2 dimension, valid from begindatum to einddatum.
 
 Following dimension tables are generated:
 
@@ -21,9 +23,10 @@ Following dimension tables are generated:
 """
 
 import configparser
-import pymssql as sql
 import pandas as pd
 from wob_zz import *
+from wob_zz.native_format import stage_dataframe
+from wob_zz.connections import get_pool
 
 __author__ = 'Daniel Kapitan'
 __maintainer__ = 'Daniel Kapitan'
@@ -32,17 +35,11 @@ __version__ = '0.1'
 
 def main():
 
-    # setup database connection
+    # setup config and shared schema metadata
     config = configparser.ConfigParser()
     config.read('/opt/projects/wob_zz/config.ini')
-    login = {
-        'user': config.get('local_mssql', 'user'),
-        'password': config.get('local_mssql', 'password'),
-        'server': config.get('local_mssql', 'server'),
-        'port': config.get('local_mssql', 'port'),
-        'database': config.get('wob_zz', 'database')}
-    cnx = sql.connect(**login)
-    cursor = cnx.cursor()
+    metadata = get_pool(config).metadata
+    historize = config.getboolean('wob_zz', 'historize', fallback=False)
 
     # configure files
     paths = {'data_path': config.get('wob_zz', 'dbco_path'),
@@ -82,20 +79,22 @@ def main():
     df.rename(columns=mapping, inplace=True)
 
     # format fields
-    df['beh_dbc_specialisme_code'] = df['beh_dbc_specialisme_code'].apply(lambda x: str(x).zfill(4))
-    df['beh_dbc_behandeling_code'] = df['beh_dbc_behandeling_code'].apply(lambda x: str(x).zfill(4))
-    df['beh_dbc_hoofdgroep_code'] = df['beh_dbc_hoofdgroep_code'].apply(lambda x: parse_nulls(x))
-    df['beh_dbc_begindatum'] = df['beh_dbc_begindatum'].apply(lambda x: datetime_to_mssql_string(x))
-    df['beh_dbc_einddatum'] = df['beh_dbc_einddatum'].apply(lambda x: datetime_to_mssql_string(x))
+    df['beh_dbc_specialisme_code'] = zfill_series(df['beh_dbc_specialisme_code'], 4)
+    df['beh_dbc_behandeling_code'] = zfill_series(df['beh_dbc_behandeling_code'], 4)
+    df['beh_dbc_hoofdgroep_code'] = parse_nulls_series(df['beh_dbc_hoofdgroep_code'])
+    df['beh_dbc_begindatum'] = datetime_to_mssql_string_series(df['beh_dbc_begindatum'])
+    df['beh_dbc_einddatum'] = datetime_to_mssql_string_series(df['beh_dbc_einddatum'])
 
     # drop duplicates, take latest c.q. most current verion
-    df.drop_duplicates(cols=['beh_dbc_specialisme_code',
-                             'beh_dbc_behandeling_code'],
-                       take_last=True,
-                       inplace=True)
+    # or keep all versions when historized
+    if not historize:
+        df.drop_duplicates(cols=['beh_dbc_specialisme_code',
+                                 'beh_dbc_behandeling_code'],
+                           take_last=True,
+                           inplace=True)
     # add id and reorder
     df['beh_id'] = range(1,len(df)+1,1)
-    target_columns = get_columns(login['database'], 'DIM', 'BEHANDELING', cursor)
+    target_columns = metadata.columns('DIM', 'BEHANDELING')
     for column in target_columns:
         if column not in df.columns:
             df[column] = ''
@@ -113,10 +112,10 @@ def main():
     df = df[target_columns]
     df = df.sort(columns='beh_id')
 
-    # write output to .csv
-    df.to_csv(paths['staging_path'] + '/DIM.BEHANDELING.csv', sep=';',
-              header=True, index = False, encoding='cp1252',
-              quoting=None, na_rep='_?_')
+    # write output to .csv or native file
+    stage_dataframe(df, paths['staging_path'], 'DIM.BEHANDELING', config,
+                    sep=';', header=True, index=False, encoding='cp1252',
+                    quoting=None, na_rep='_?_')
 
 
 
@@ -140,17 +139,19 @@ def main():
     df.rename(columns=mapping, inplace=True)
 
     # format fields
-    df['dia_dbc_specialisme_code'] = df['dia_dbc_specialisme_code'].apply(lambda x: str(x).zfill(4))
-    df['dia_dbc_diagnose_code'] = df['dia_dbc_diagnose_code'].apply(lambda x: str(x).zfill(4))
-    df['dia_dbc_hoofdgroep_code'] = df['dia_dbc_hoofdgroep_code'].apply(lambda x: parse_nulls(x))
-    df['dia_dbc_subgroep_code'] = df['dia_dbc_subgroep_code'].apply(lambda x: parse_nulls(x))
-    df['dia_dbc_begindatum'] = df['dia_dbc_begindatum'].apply(lambda x: datetime_to_mssql_string(x))
-    df['dia_dbc_einddatum'] = df['dia_dbc_einddatum'].apply(lambda x: datetime_to_mssql_string(x))
+    df['dia_dbc_specialisme_code'] = zfill_series(df['dia_dbc_specialisme_code'], 4)
+    df['dia_dbc_diagnose_code'] = zfill_series(df['dia_dbc_diagnose_code'], 4)
+    df['dia_dbc_hoofdgroep_code'] = parse_nulls_series(df['dia_dbc_hoofdgroep_code'])
+    df['dia_dbc_subgroep_code'] = parse_nulls_series(df['dia_dbc_subgroep_code'])
+    df['dia_dbc_begindatum'] = datetime_to_mssql_string_series(df['dia_dbc_begindatum'])
+    df['dia_dbc_einddatum'] = datetime_to_mssql_string_series(df['dia_dbc_einddatum'])
 
     # drop duplicates, take latest c.q. most current verion
-    df.drop_duplicates(cols=['dia_dbc_specialisme_code',
-                             'dia_dbc_diagnose_code'],
-                       take_last=True, inplace=True)
+    # or keep all versions when historized
+    if not historize:
+        df.drop_duplicates(cols=['dia_dbc_specialisme_code',
+                                 'dia_dbc_diagnose_code'],
+                           take_last=True, inplace=True)
 
     # enrich diagnose codes with most recent zorgproductgroep ('beslisbomen') if available
     zpg_file = paths['data_path'] \
@@ -165,7 +166,7 @@ def main():
                         'Diagnose code': 'dia_dbc_diagnose_code',
                         'Zorgproductgroep code': 'dia_dbc_zorgproductgroep_code'},
                inplace=True)
-    zpg['dia_dbc_diagnose_code'] = zpg['dia_dbc_diagnose_code'].apply(lambda x: str(x).zfill(4))
+    zpg['dia_dbc_diagnose_code'] = zfill_series(zpg['dia_dbc_diagnose_code'], 4)
     zpg.drop_duplicates(cols=['dia_dbc_specialisme_code', 'dia_dbc_diagnose_code'],
                         take_last=True, inplace=True)
     zpg = zpg.drop(['Ingangsdatum', 'Einddatum'], axis=1)
@@ -190,7 +191,7 @@ def main():
 
     # add id and reorder
     df['dia_id'] = range(1,len(df)+1,1)
-    target_columns = get_columns(login['database'], 'DIM', 'DIAGNOSE', cursor)
+    target_columns = metadata.columns('DIM', 'DIAGNOSE')
     for column in target_columns:
         if column not in df.columns:
             df[column] = ''
@@ -210,10 +211,10 @@ def main():
     df = df[target_columns]
     df = df.sort(columns='dia_id')
 
-    # write output to .csv
-    df.to_csv(paths['staging_path'] + '/DIM.DIAGNOSE.csv', sep=';',
-              header=True, index=False, encoding='cp1252',
-              quoting=None, na_rep='_?_')
+    # write output to .csv or native file
+    stage_dataframe(df, paths['staging_path'], 'DIM.DIAGNOSE', config,
+                    sep=';', header=True, index=False, encoding='cp1252',
+                    quoting=None, na_rep='_?_')
 
 
     #########################
@@ -236,20 +237,22 @@ def main():
     df.rename(columns=mapping, inplace=True)
 
     # format fields
-    df['zgt_dbc_specialisme_code'] = df['zgt_dbc_specialisme_code'].apply(lambda x: str(x).zfill(4))
-    df['zgt_dbc_zorgtype_code'] = df['zgt_dbc_zorgtype_code'].apply(lambda x: str(x).zfill(2))
-    df['zgt_dbc_hoofdgroep_code'] = df['zgt_dbc_hoofdgroep_code'].apply(lambda x: str(x).zfill(4))
-    df['zgt_dbc_begindatum'] = df['zgt_dbc_begindatum'].apply(lambda x: datetime_to_mssql_string(x))
-    df['zgt_dbc_einddatum'] = df['zgt_dbc_einddatum'].apply(lambda x: datetime_to_mssql_string(x))
+    df['zgt_dbc_specialisme_code'] = zfill_series(df['zgt_dbc_specialisme_code'], 4)
+    df['zgt_dbc_zorgtype_code'] = zfill_series(df['zgt_dbc_zorgtype_code'], 2)
+    df['zgt_dbc_hoofdgroep_code'] = zfill_series(df['zgt_dbc_hoofdgroep_code'], 4)
+    df['zgt_dbc_begindatum'] = datetime_to_mssql_string_series(df['zgt_dbc_begindatum'])
+    df['zgt_dbc_einddatum'] = datetime_to_mssql_string_series(df['zgt_dbc_einddatum'])
 
     # drop duplicates, take latest c.q. most current verion
-    df.drop_duplicates(cols=['zgt_dbc_specialisme_code',
-                             'zgt_dbc_zorgtype_code'],
-                       take_last=True, inplace=True)
+    # or keep all versions when historized
+    if not historize:
+        df.drop_duplicates(cols=['zgt_dbc_specialisme_code',
+                                 'zgt_dbc_zorgtype_code'],
+                           take_last=True, inplace=True)
 
     # add id and reorder
     df['zgt_id'] = range(1,len(df)+1,1)
-    target_columns = get_columns(login['database'], 'DIM', 'ZORGTYPE', cursor)
+    target_columns = metadata.columns('DIM', 'ZORGTYPE')
     for column in target_columns:
         if column not in df.columns:
             df[column] = ''
@@ -267,10 +270,10 @@ def main():
     df = df[target_columns]
     df = df.sort(columns='zgt_id')
 
-    # write output to .csv
-    df.to_csv(paths['staging_path'] + '/DIM.ZORGTYPE.csv', sep=';',
-              header=True, index=False, encoding='cp1252',
-              quoting=None, na_rep= '_?_')
+    # write output to .csv or native file
+    stage_dataframe(df, paths['staging_path'], 'DIM.ZORGTYPE', config,
+                    sep=';', header=True, index=False, encoding='cp1252',
+                    quoting=None, na_rep='_?_')
 
 
     #########################
@@ -293,18 +296,20 @@ def main():
     df.rename(columns=mapping, inplace=True)
 
     # format fields
-    df['zgv_dbc_specialisme_code'] = df['zgv_dbc_specialisme_code'].apply(lambda x: str(x).zfill(4))
-    df['zgv_dbc_zorgvraag_code'] = df['zgv_dbc_zorgvraag_code'].apply(lambda x: str(x).zfill(4))
-    df['zgv_dbc_hoofdgroep_code'] = df['zgv_dbc_hoofdgroep_code'].apply(lambda x: str(x).zfill(4))
-    df['zgv_dbc_begindatum'] = df['zgv_dbc_begindatum'].apply(lambda x: datetime_to_mssql_string(x))
-    df['zgv_dbc_einddatum'] = df['zgv_dbc_einddatum'].apply(lambda x: datetime_to_mssql_string(x))
+    df['zgv_dbc_specialisme_code'] = zfill_series(df['zgv_dbc_specialisme_code'], 4)
+    df['zgv_dbc_zorgvraag_code'] = zfill_series(df['zgv_dbc_zorgvraag_code'], 4)
+    df['zgv_dbc_hoofdgroep_code'] = zfill_series(df['zgv_dbc_hoofdgroep_code'], 4)
+    df['zgv_dbc_begindatum'] = datetime_to_mssql_string_series(df['zgv_dbc_begindatum'])
+    df['zgv_dbc_einddatum'] = datetime_to_mssql_string_series(df['zgv_dbc_einddatum'])
 
     # drop duplicates, take latest c.q. most current verion
-    df.drop_duplicates(cols=['zgv_dbc_specialisme_code', 'zgv_dbc_zorgvraag_code'], take_last=True, inplace=True)
+    # or keep all versions when historized
+    if not historize:
+        df.drop_duplicates(cols=['zgv_dbc_specialisme_code', 'zgv_dbc_zorgvraag_code'], take_last=True, inplace=True)
 
     # add id and reorder
     df['zgv_id'] = range(1,len(df)+1,1)
-    target_columns = get_columns(login['database'], 'DIM', 'ZORGVRAAG', cursor)
+    target_columns = metadata.columns('DIM', 'ZORGVRAAG')
     for column in target_columns:
         if column not in df.columns:
             df[column] = ''
@@ -322,10 +327,10 @@ def main():
     df = df[target_columns]
     df = df.sort(columns='zgv_id')
 
-    # write output to .csv
-    df.to_csv(paths['staging_path'] + '/DIM.ZORGVRAAG.csv', sep = ';',
-              header = True, index = False, encoding = 'cp1252',
-              quoting=None, na_rep= '_?_')
+    # write output to .csv or native file
+    stage_dataframe(df, paths['staging_path'], 'DIM.ZORGVRAAG', config,
+                    sep=';', header=True, index=False, encoding='cp1252',
+                    quoting=None, na_rep='_?_')
 
 
 if __name__ == '__main__':
@@ -11,9 +11,10 @@ Following dimension tables are generated:
 """
 
 import configparser
-import pymssql as sql
 import pandas as pd
-from wob_zz import datetime_to_mssql_string, get_columns
+from wob_zz import datetime_to_mssql_string_series
+from wob_zz.native_format import stage_dataframe
+from wob_zz.connections import get_pool
 
 __author__ = 'Daniel Kapitan'
 __maintainer__ = 'Daniel Kapitan'
@@ -21,17 +22,10 @@ __version__ = '0.1'
 
 def main():
 
-    # setup database connection
+    # setup config and shared schema metadata
     config = configparser.ConfigParser()
     config.read('/opt/projects/wob_zz/config.ini')
-    login = {
-        'user': config.get('local_mssql', 'user'),
-        'password': config.get('local_mssql', 'password'),
-        'server': config.get('local_mssql', 'server'),
-        'port': config.get('local_mssql', 'port'),
-        'database': config.get('wob_zz', 'database')}
-    cnx = sql.connect(**login)
-    cursor = cnx.cursor()
+    metadata = get_pool(config).metadata
 
     # configure files
     paths = {'data_path': config.get('wob_zz', 'dbco_path'),
@@ -59,8 +53,8 @@ def main():
     data = data.drop(['zpr_dbc_declaratiecode_verzekerd',
                       'zpr_dbc_declaratiecode_onverzekerd',
                       'Mutatie'], axis=1)
-    data['zpr_dbc_begindatum'] = data['zpr_dbc_begindatum'].apply(lambda x: datetime_to_mssql_string(x))
-    data['zpr_dbc_einddatum'] = data['zpr_dbc_einddatum'].apply(lambda x: datetime_to_mssql_string(x))
+    data['zpr_dbc_begindatum'] = datetime_to_mssql_string_series(data['zpr_dbc_begindatum'])
+    data['zpr_dbc_einddatum'] = datetime_to_mssql_string_series(data['zpr_dbc_einddatum'])
     data.drop_duplicates(cols=['zpr_dbc_zorgproduct_code'],
                          take_last=True, inplace=True)
 
@@ -99,7 +93,7 @@ def main():
 
     # add id, unknown and reorder
     data['zpr_id'] = range(1,len(data)+1,1)
-    target_columns = get_columns(login['database'], 'DIM', 'ZORGPRODUCT', cursor)
+    target_columns = metadata.columns('DIM', 'ZORGPRODUCT')
     for column in target_columns:
         if column not in data.columns:
             data[column] = ''
@@ -122,10 +116,10 @@ def main():
     data = data[target_columns]
     data = data.sort(columns='zpr_id')
 
-    # write output to .csv
-    data.to_csv(paths['staging_path'] + '/DIM.ZORGPRODUCT.csv', sep=';',
-                header=True, index = False, encoding='cp1252',
-                quoting=None, na_rep='_?_')
+    # write output to .csv or native file
+    stage_dataframe(data, paths['staging_path'], 'DIM.ZORGPRODUCT', config,
+                    sep=';', header=True, index=False, encoding='cp1252',
+                    quoting=None, na_rep='_?_')
 
 
 if __name__ == '__main__':
@@ -5,9 +5,10 @@ Manually enriched with abreviations and short descriptions
 """
 
 import configparser
-import pymssql as sql
 import pandas as pd
-from wob_zz import datetime_to_mssql_string, get_columns
+from wob_zz import datetime_to_mssql_string_series
+from wob_zz.native_format import stage_dataframe
+from wob_zz.connections import get_pool
 
 __author__ = 'Daniel Kapitan'
 __maintainer__ = 'Daniel Kapitan'
@@ -16,17 +17,10 @@ __version__ = '0.1'
 
 def main():
 
-    # setup database connection
+    # setup config and shared schema metadata
     config = configparser.ConfigParser()
     config.read('/opt/projects/wob_zz/config.ini')
-    login = {
-        'user': config.get('local_mssql', 'user'),
-        'password': config.get('local_mssql', 'password'),
-        'server': config.get('local_mssql', 'server'),
-        'port': config.get('local_mssql', 'port'),
-        'database': config.get('wob_zz', 'database')}
-    cnx = sql.connect(**login)
-    cursor = cnx.cursor()
+    metadata = get_pool(config).metadata
 
     # configure files
     paths = {'vektis_path': config.get('wob_zz', 'vektis_path'),
@@ -49,9 +43,9 @@ def main():
     }
 
     data.rename(columns=mapping, inplace=True)
-    data['zvs_vektis_mutatiedatum'] = data['zvs_vektis_mutatiedatum'].apply(lambda x: datetime_to_mssql_string(x))
-    data['zvs_vektis_begindatum'] = data['zvs_vektis_begindatum'].apply(lambda x: datetime_to_mssql_string(x, default='1000-01-01 00:00:00'))
-    data['zvs_vektis_einddatum'] = data['zvs_vektis_einddatum'].apply(lambda x: datetime_to_mssql_string(x))
+    data['zvs_vektis_mutatiedatum'] = datetime_to_mssql_string_series(data['zvs_vektis_mutatiedatum'])
+    data['zvs_vektis_begindatum'] = datetime_to_mssql_string_series(data['zvs_vektis_begindatum'], default='1000-01-01 00:00:00')
+    data['zvs_vektis_einddatum'] = datetime_to_mssql_string_series(data['zvs_vektis_einddatum'])
 
     df = [
         ('0100', 'Huisarts, nno', 'HUIS'),
@@ -113,7 +107,7 @@ def main():
 
     # add id
     data['zvs_id'] = range(1,len(data)+1,1)
-    target_columns = get_columns(login['database'], 'DIM', 'ZORGVERLENERSOORT', cursor)
+    target_columns = metadata.columns('DIM', 'ZORGVERLENERSOORT')
     for column in target_columns:
         if column not in data.columns:
             data[column] = ''
@@ -134,10 +128,10 @@ def main():
     data = data[target_columns]
     data = data.sort(columns='zvs_id')
 
-     # write output to .csv
-    data.to_csv(paths['staging_path'] + '/DIM.ZORGVERLENERSOORT.csv', sep=';',
-              header=True, index=False, encoding='cp1252',
-              quoting=None, na_rep='_?_')
+     # write output to .csv or native file
+    stage_dataframe(data, paths['staging_path'], 'DIM.ZORGVERLENERSOORT',
+                    config, sep=';', header=True, index=False,
+                    encoding='cp1252', quoting=None, na_rep='_?_')
 
 
     #stage land_codes
@@ -0,0 +1,162 @@
+""" Deterministic hash-derived surrogate keys.
+
+pygrametl assigns surrogate keys in order of appearance, which requires
+a global, stateful lookup and makes parallel loads depend on shared key
+state. A key derived from the business key with a 64-bit hash can be
+computed by any worker independently and stays the same across
+reloads.
+
+Keys are positive 63-bit integers, so they fit in a bigint column and
+never clash with the negative keys used for unknown members.
+
+HashKeyFinder is the idfinder of a pygrametl dimension, so it is only
+called for members that the dimension's lookup did not find. A derived
+key that is already taken is therefore a collision, with a member in
+the table (see prefill()) or one issued by this process, and is
+resolved by rehashing with an increasing salt; the unique primary key
+in the database guards against collisions between processes.
+
+The fact load still looks up every subtraject_id with ensure(): a
+salted key can't be derived from the business key alone, and existing
+members must not be inserted again. Only the keys are kept, not the
+business keys, which the key map of the dimension already holds.
+
+KeyMapDimension replaces pygrametl's BulkDimension for dimensions with a
+member per fact row, such as DIM.SUBTRAJECTNUMMER. BulkDimension keeps
+every member in dicts of its own. KeyMapDimension keeps only the
+business key -> key mapping, in a mapping that can be spilled to disk
+(a SpillableDict), and writes new members to a bulk loaded table
+without a cache.
+"""
+
+import hashlib
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+MASK = 0x7FFFFFFFFFFFFFFF
+
+
+def hash_key(value, salt=0):
+    """Positive 63-bit key derived from a business key value."""
+    data = str(value) if salt == 0 else '{}\x1f{}'.format(value, salt)
+    key = int.from_bytes(hashlib.blake2b(data.encode('utf-8'),
+                                         digest_size=8).digest(),
+                         'little') & MASK
+    return key or 1
+
+
+class HashKeyFinder(object):
+    """pygrametl idfinder that derives keys from a lookup attribute.
+
+    Arguments:
+    - att: name of the business key attribute, e.g. 'stn_subtraject_id'
+    - issued: mapping for the keys in use, e.g. a SpillableDict; default
+      a dict
+    """
+
+    def __init__(self, att, issued=None):
+        self.att = att
+        self.__issued = {} if issued is None else issued
+        self.collisions = 0
+
+    @property
+    def issued(self):
+        return self.__issued
+
+    def prefill(self, cursor, table, key):
+        """Mark the keys of the members already in table as in use."""
+        cursor.execute('select {} from {} where {} > 0'.format(key, table, key))
+        while True:
+            rows = cursor.fetchmany(100000)
+            if not rows:
+                return
+            for row in rows:
+                self.__issued[row[0]] = True
+
+    def key(self, value):
+        """Return a new key for value, resolving collisions with a salt."""
+        salt = 0
+        while True:
+            key = hash_key(value, salt)
+            if key not in self.__issued:
+                self.__issued[key] = True
+                return key
+            self.collisions += 1
+            salt += 1
+
+    def __call__(self, row, namemapping={}):
+        return self.key(row[namemapping.get(self.att) or self.att])
+
+
+class KeyMapDimension(object):
+    """Bulk loaded dimension with its keys looked up in a key map.
+
+    Arguments:
+    - table: pygrametl bulk table without a cache for the new members,
+      e.g. a BulkFactTable with keyrefs [key] and attributes as measures
+    - key: name of the surrogate key
+    - attributes: attributes of the members, including lookupatt
+    - lookupatt: business key attribute, e.g. 'stn_subtraject_id'
+    - keys: mapping from business key to key, e.g. a SpillableDict;
+      default a dict
+    - idfinder: function(row, namemapping) that returns the key of a new
+      member, e.g. a HashKeyFinder; default the next number after the
+      highest key in the table
+
+    prefill(cursor) fills the key map from the table.
+    """
+
+    def __init__(self, table, key, attributes, lookupatt, keys=None,
+                 idfinder=None):
+        self.table = table
+        self.name = table.name
+        self.key = key
+        self.attributes = list(attributes)
+        self.lookupatt = lookupatt
+        self.lookupatts = [lookupatt]
+        self.keys = {} if keys is None else keys
+        self.idfinder = idfinder
+        self.inserts = 0
+        self.__next = 1
+
+    def prefill(self, cursor):
+        """Map the business keys of the members in the table to their keys."""
+        keys = self.keys
+        cursor.execute('select {}, {} from {}'.format(
+            self.key, self.lookupatt, self.name))
+        while True:
+            rows = cursor.fetchmany(100000)
+            if not rows:
+                return
+            for keyvalue, value in rows:
+                keys[value] = keyvalue
+                if keyvalue >= self.__next:
+                    self.__next = keyvalue + 1
+
+    def lookup(self, row, namemapping={}):
+        return self.keys.get(row[namemapping.get(self.lookupatt) or
+                                 self.lookupatt])
+
+    def ensure(self, row, namemapping={}):
+        value = row[namemapping.get(self.lookupatt) or self.lookupatt]
+        keyvalue = self.keys.get(value)
+        if keyvalue is None:
+            keyvalue = self.insert(row, namemapping)
+        return keyvalue
+
+    def insert(self, row, namemapping={}):
+        """Write a new member and return its key."""
+        if self.idfinder is not None:
+            keyvalue = self.idfinder(row, namemapping)
+        else:
+            keyvalue = self.__next
+            self.__next += 1
+        member = dict([(att, row[namemapping.get(att) or att])
+                       for att in self.attributes])
+        member[self.key] = keyvalue
+        self.table.insert(member)
+        self.keys[member[self.lookupatt]] = keyvalue
+        self.inserts += 1
+        return keyvalue
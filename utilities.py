@@ -6,6 +6,7 @@ Various utilities for:
 """
 
 from decimal import *
+import numpy as np
 import pandas as pd
 
 __author__ = 'Daniel Kapitan'
@@ -25,6 +26,50 @@ def parse_boolean(value, default=''):
         return None
 
 
+# J/N flags of a subtraject in bit order of the packed representation
+FLAGS = ['heeft_oranje_zorgactiviteit', 'heeft_zorgactiviteit_met_machtiging',
+         'is_hoofdtraject', 'is_aanspraak_zvw', 'is_aanspraak_zvw_toegepast',
+         'is_zorgactiviteitvertaling_toegepast']
+
+
+def pack_flags(values):
+    """Method for packing tri-state flags (1, 0 or None) into one integer.
+
+    Bit i holds the value of flag i, bit 6 + i is set when flag i is null,
+    so six flags fit in 12 bits (0..4095).
+    """
+    packed = 0
+    for i, value in enumerate(values):
+        if value is None:
+            packed |= 1 << (6 + i)
+        elif value:
+            packed |= 1 << i
+    return packed
+
+
+def unpack_flags(packed, n=6):
+    """Method for unpacking an integer from pack_flags() into 1/0/None."""
+    return tuple([None if packed >> (6 + i) & 1 else packed >> i & 1
+                  for i in range(n)])
+
+
+def pack_flags_array(values):
+    """Vectorized pack_flags() for an (n x flags) array, -1 for null."""
+    values = np.asarray(values, dtype=np.int16)
+    bits = np.left_shift(1, np.arange(values.shape[1], dtype=np.int16))
+    return (((values == 1) * bits).sum(axis=1)
+            + ((values < 0) * (bits << 6)).sum(axis=1)).astype(np.int16)
+
+
+def unpack_flags_array(packed, n=6):
+    """Vectorized unpack_flags(), returns (len(packed) x n) int8 with -1 for null."""
+    packed = np.asarray(packed, dtype=np.int16)[:, np.newaxis]
+    shifts = np.arange(n, dtype=np.int16)
+    values = (packed >> shifts) & 1
+    nulls = (packed >> (shifts + 6)) & 1
+    return np.where(nulls == 1, -1, values).astype(np.int8)
+
+
 def parse_codes(value, zfill_length, default='?'):
     """Method for parsing varchar codes.
 
@@ -81,27 +126,77 @@ def datetime_to_mssql_string(datetime, default='1000-04-04 00:00:00'):
         return default
 
 
+def zfill_series(series, width):
+    """ Vectorized str(x).zfill(width) for a pandas Series."""
+    series = series.astype(str)
+    # str.zfill keeps a leading sign in front of the zeros
+    signed = series.str[0:1].isin(['+', '-'])
+    padded = series.str.pad(width, side='left', fillchar='0')
+    if signed.any():
+        padded[signed] = series[signed].str[0:1] + \
+            series[signed].str[1:].str.pad(width - 1, side='left', fillchar='0')
+    return padded
+
+
+def parse_nulls_series(series, default='0000'):
+    """ Vectorized parse_nulls() for a pandas Series."""
+    nulls = series.isnull()
+    result = pd.Series(default, index=series.index, dtype=object)
+    result[~nulls] = zfill_series(series[~nulls], 4)
+    return result
+
+
+def parse_dates_series(series, default='10000101'):
+    """ Vectorized parse_dates() for a pandas Series.
+
+    Like parse_dates() only None is replaced by default; NaN is formatted
+    as the string 'nan'.
+    """
+    values = series.values.astype(object)
+    nones = np.equal(values, None)
+    strings = pd.Series(np.where(nones, default, series.astype(str).values),
+                        index=series.index)
+    return strings.str[0:4] + '-' + strings.str[4:6] + '-' + strings.str[6:8]
+
+
+def datetime_to_mssql_string_series(series, default='1000-04-04 00:00:00'):
+    """ Vectorized datetime_to_mssql_string() for a pandas Series.
+
+    Datetime columns are formatted as datetime64[D] strings by NumPy,
+    other columns fall back to the scalar version so results are identical.
+    """
+    if series.dtype.kind != 'M':
+        return series.apply(lambda x: datetime_to_mssql_string(x, default))
+    result = pd.Series(series.values.astype('datetime64[D]').astype(str),
+                       index=series.index) + ' 00:00:00'
+    return result.where(series.notnull(), default)
+
+
 def get_columns(db, schema, table, cursor):
-    """ Get columns in right order from a table."""
-    stmt = ('''select column_name, data_type from information_schema.columns
-               where table_catalog = '{}'
-               and   table_schema = '{}'
-               and   table_name = '{}'
+    """ Get columns in right order from a table.
+
+    Steps of a run should use connections.get_pool(config).metadata,
+    which reads all tables at once.
+    """
+    stmt = ('''select column_name from information_schema.columns
+               where table_catalog = %s
+               and   table_schema = %s
+               and   table_name = %s
+               order by ordinal_position
             ''')
-    cursor.execute(stmt.format(db, schema, table))
-    result = pd.DataFrame(cursor.fetchall())
-    return result[0].tolist()
+    cursor.execute(stmt, (db, schema, table))
+    return [row[0] for row in cursor.fetchall()]
 
 def get_column_types(db, schema, table, cursor):
-    """ Get columns in right order from a table."""
+    """ Get column data types in right order from a table."""
     stmt = ('''select data_type from information_schema.columns
-               where table_catalog = '{}'
-               and   table_schema = '{}'
-               and   table_name = '{}'
+               where table_catalog = %s
+               and   table_schema = %s
+               and   table_name = %s
+               order by ordinal_position
             ''')
-    cursor.execute(stmt.format(db, schema, table))
-    result = pd.DataFrame(cursor.fetchall())
-    return result[0].tolist()
+    cursor.execute(stmt, (db, schema, table))
+    return [row[0] for row in cursor.fetchall()]
 
 
 
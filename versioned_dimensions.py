@@ -0,0 +1,146 @@
+""" Point-in-time lookup of historized (slowly changing type 2) dimensions.
+
+The reference tables of DBC Onderhoud contain several versions of the
+same code, each valid from Ingangsdatum to Einddatum/Afloopdatum. When
+the dimensions are historized, the fact load has to pick the version
+that was valid on the declaratiedatum of each subtraject.
+
+VersionedLookup keeps per business key the versions sorted by begin
+date in parallel arrays, so a lookup is one dict access and a bisect.
+Dates are compared as ISO strings ('YYYY-MM-DD'), which sort in date
+order. Open end dates (blank, i.e. the 1000-xx-xx placeholders from
+staging) are treated as valid until 9999-12-31.
+"""
+
+from bisect import bisect_right
+
+__author__ = 'Daniel Kapitan'
+__maintainer__ = 'Daniel Kapitan'
+__version__ = '0.1'
+
+OPEN_END = '9999-12-31'
+
+
+def _isodate(value):
+    """Date, datetime or string as 'YYYY-MM-DD', None for blanks."""
+    if value is None:
+        return None
+    value = str(value)[0:10]
+    if not value or value.startswith('1000-'):
+        return None
+    return value
+
+
+class VersionedLookup(object):
+    """Interval index from (business key, date) to surrogate key.
+
+    Arguments:
+    - versions: iterable of (key tuple, begin date, end date, id)
+    - nearest: when no version is valid on the date, return the latest
+      version that started before it (or the first version); otherwise
+      return the default
+    """
+
+    def __init__(self, versions, nearest=True):
+        grouped = {}
+        for key, begin, end, id in versions:
+            begin = _isodate(begin) or '0001-01-01'
+            end = _isodate(end) or OPEN_END
+            grouped.setdefault(tuple(key), []).append((begin, end, id))
+        self.__index = {}
+        for key, intervals in grouped.items():
+            intervals.sort()
+            self.__index[key] = ([begin for begin, end, id in intervals],
+                                 [end for begin, end, id in intervals],
+                                 [id for begin, end, id in intervals])
+        self.nearest = nearest
+        self.size = sum([len(ids) for begins, ends, ids
+                         in self.__index.values()])
+
+    def __contains__(self, key):
+        return tuple(key) in self.__index
+
+    def lookup(self, key, date, default=None):
+        """Surrogate key of the version of key valid on date."""
+        entry = self.__index.get(key)
+        if entry is None:
+            return default
+        begins, ends, ids = entry
+        i = bisect_right(begins, date) - 1
+        if i >= 0 and date <= ends[i]:
+            return ids[i]
+        if self.nearest:
+            return ids[i] if i >= 0 else ids[0]
+        return default
+
+    def lookup_many(self, keys, dates, default=None):
+        """Batch form of lookup() for equal length sequences."""
+        index, nearest = self.__index, self.nearest
+        result = []
+        append = result.append
+        for key, date in zip(keys, dates):
+            entry = index.get(key)
+            if entry is None:
+                append(default)
+                continue
+            begins, ends, ids = entry
+            i = bisect_right(begins, date) - 1
+            if i >= 0 and date <= ends[i]:
+                append(ids[i])
+            elif nearest:
+                append(ids[i] if i >= 0 else ids[0])
+            else:
+                append(default)
+        return result
+
+    @classmethod
+    def from_table(cls, cursor, table, key, lookupatts, fromatt, toatt,
+                   nearest=True):
+        """Build the index from all versions in a dimension table."""
+        stmt = 'select {}, {}, {}, {} from {}'.format(
+            ', '.join(lookupatts), fromatt, toatt, key, table)
+        cursor.execute(stmt)
+        n = len(lookupatts)
+        versions = [(tuple([str(value) for value in row[:n]]),
+                     row[n], row[n + 1], row[n + 2])
+                    for row in cursor.fetchall()]
+        return cls(versions, nearest)
+
+
+class VersionedDimension(object):
+    """Dimension whose lookups pick the version valid on a row date.
+
+    Members that are unknown altogether fall through to the wrapped
+    pygrametl dimension, which inserts them as new members. It gets a
+    copy of the row as a dict, since rows may be positional (see rows).
+
+    Arguments:
+    - dimension: pygrametl dimension (or a wrapper of one)
+    - versions: VersionedLookup of the dimension
+    - dateatt: name of the row field with the point in time
+    """
+
+    def __init__(self, dimension, versions, dateatt):
+        self.dimension = dimension
+        self.name = dimension.name
+        self.key = dimension.key
+        self.lookupatts = dimension.lookupatts
+        self.versions = versions
+        self.dateatt = dateatt
+
+    def __resolve(self, row, namemapping):
+        key = tuple([row[namemapping.get(att) or att]
+                     for att in self.lookupatts])
+        return self.versions.lookup(key, row[self.dateatt])
+
+    def lookup(self, row, namemapping={}):
+        keyvalue = self.__resolve(row, namemapping)
+        if keyvalue is None:
+            return self.dimension.lookup(row.copy(), namemapping)
+        return keyvalue
+
+    def ensure(self, row, namemapping={}):
+        keyvalue = self.__resolve(row, namemapping)
+        if keyvalue is None:
+            return self.dimension.ensure(row.copy(), namemapping)
+        return keyvalue